@@ -2,11 +2,19 @@
 # Code relating to account management
 #
 
+import random, re, string
 from django import forms
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.core.cache import cache as shared_cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
 import validators
 from models import *
+import agents, bulk, common
 
 # Add a user account
 # TODO - Make this a transaction?
@@ -35,11 +43,17 @@ def register_user(username, password, email, send_email=True):
 # The caller should verify that the agent has not already been claimed
 def request_claim(identity, handle, service, quiet=False):
 
-  # Make sure the agent is in the database
-  agent, created = Agent.objects.get_or_create(handle=handle, service=service)
+  # Make sure the agent is in the database. The agent directory may not know
+  # about agents created by other processes, so when it has no answer, ask
+  # the database.
+  entry = agents.directory.lookup(handle, service)
+  if entry is None:
+    agent, created = Agent.objects.get_or_create(handle=handle,
+                                                 service=service)
+    entry = (agent.id, agent.owner_id)
 
   # The agent should be unknowned
-  if agent.owner != None:
+  if entry[1] != None:
     raise Exception('Trying to claim agent that already has an owner!')
 
   # If there's already a pending claim for us, don't do anything
@@ -74,11 +88,26 @@ def do_claim(ckey):
   # Copy the relevant data for convenience
   (handle, service, identity) = (claim.handle, claim.service, claim.owner)
 
-  # There should already be an agent if there are pending claims. Find it
-  # and set the owner
-  agent = Agent.objects.get(handle=handle, service=service)
-  agent.owner = identity
-  agent.save()
+  # There should already be an agent if there are pending claims, though it
+  # may have been created by another process, unknown to the directory. Find
+  # it and set the owner.
+  entry = agents.directory.lookup(handle, service)
+  if entry is None:
+    found = Agent.objects.filter(handle=handle, service=service) \
+                         .values_list('id', 'owner')
+    if not found:
+      return None
+    entry = found[0]
+
+  # It shouldn't belong to anybody else. The directory may not have seen a
+  # claim by another process, so the database decides, and if the agent is
+  # taken the claim stays as it is.
+  claimed = Agent.objects.filter(Q(owner=None) | Q(owner=identity),
+                                 pk=entry[0]).update(owner=identity)
+  if not claimed:
+    return None
+  agent = Agent(id=entry[0], handle=handle, service=service, owner=identity)
+  agents.directory.saved(agent)
 
   # Delete all pending claims to this agent
   PendingClaim.objects.filter(handle=handle, service=service).delete()
@@ -91,6 +120,223 @@ def do_claim(ckey):
   # All done
   return agent
 
+#
+# Carries out any number of claims given their confirmation keys, as
+# do_claim() does one at a time.
+#
+# Returns a dictionary mapping each key to the id of the agent claimed, or
+# None if the key is unknown or its agent is missing or owned by somebody
+# else, in which case its claims are left alone. As when claiming one at a
+# time, the first of several keys for the same agent wins, and the others
+# come out as unknown.
+#
+# This takes a fixed number of queries per bulk.batch_size keys, and sends
+# no model signals.
+#
+@transaction.commit_on_success
+def do_claims(ckeys):
+
+  outcomes = dict((ckey, None) for ckey in ckeys)
+  taken = set()
+  for start in range(0, len(ckeys), bulk.batch_size):
+    batch = ckeys[start:start + bulk.batch_size]
+
+    # Find the claims, keeping the first for each agent
+    claims = dict((row[0], row[1:]) for row in
+                  PendingClaim.objects.filter(ckey__in=batch)
+                              .values_list('ckey', 'handle', 'service',
+                                           'owner'))
+    winners = {}
+    for ckey in batch:
+      if ckey in claims and claims[ckey][:2] not in taken:
+        taken.add(claims[ckey][:2])
+        winners[claims[ckey][:2]] = (ckey, claims[ckey][2])
+    if not winners:
+      continue
+
+    # There should already be agents for all of them. Set the owners of
+    # those that aren't somebody else's.
+    found = Agent.objects.filter(handle__in=[h for (h, s) in winners]) \
+                         .values_list('handle', 'service', 'id', 'owner')
+    updates = []
+    honoured = {}
+    for (handle, service, pk, current) in found:
+      if (handle, service) not in winners:
+        continue
+      (ckey, owner) = winners[(handle, service)]
+      if current not in (None, owner):
+        continue
+      outcomes[ckey] = pk
+      updates.append((owner, pk))
+      honoured[(handle, service)] = (ckey, owner)
+      agents.directory.saved(Agent(handle=handle, service=service))
+    if not honoured:
+      continue
+    bulk.update_rows(Agent, ['owner_id'], 'id', updates)
+
+    # Delete all pending claims to these agents
+    bulk.delete_rows(PendingClaim, ['handle', 'service'], list(honoured))
+
+    # Activate the users whose registration email addresses were claimed
+    emails = set((owner, handle) for ((handle, service), (ckey, owner))
+                 in honoured.items() if service == 'email')
+    users = [user for (identity, user, email)
+             in Identity.objects.filter(pk__in=[o for (o, h) in emails])
+                                .values_list('id', 'profile__user',
+                                             'profile__user__email')
+             if (identity, email) in emails]
+    User.objects.filter(pk__in=users).update(is_active=True)
+
+  return outcomes
+
+#
+# Generates 'n' distinct confirmation keys that aren't in use, taking one
+# query per round of generation rather than one per key.
+#
+def generate_ckeys(n):
+  chars = string.ascii_letters + string.digits
+  keys = set()
+  while len(keys) < n:
+    fresh = set(''.join(random.choice(chars)
+                        for x in range(common.ckey_length))
+                for i in range(n - len(keys))) - keys
+    taken = PendingClaim.objects.filter(ckey__in=list(fresh)) \
+                                .values_list('ckey', flat=True)
+    keys |= fresh - set(taken)
+  return list(keys)
+
+# Usernames, as accepted by django's own registration forms
+username_re = re.compile(r'^[\w.@+-]{1,30}$')
+
+#
+# Registers many users at once, as register_user() does one at a time
+# without sending email. 'rows' is an iterable of (username, password, email)
+# tuples, which is consumed in batches of 'batch_size' rows.
+#
+# Each batch is written in its own transaction, with a fixed number of
+# queries however big it is. Rows that fail validation are skipped without
+# affecting the rest of their batch.
+#
+# Returns a list of the pending claims created, and a list of (row number,
+# error message) pairs for the rows that failed. Row numbers count from 0.
+#
+def register_users(rows, batch_size=1000):
+  claims, failures = [], []
+  batch = []
+  for (i, row) in enumerate(rows):
+    batch.append((i, row))
+    if len(batch) == batch_size:
+      _register_batch(batch, claims, failures)
+      batch = []
+  if batch:
+    _register_batch(batch, claims, failures)
+  return (claims, sorted(failures))
+
+@transaction.commit_on_success
+def _register_batch(batch, claims, failures):
+
+  # Check each row on its own, then against the database and each other
+  valid = []
+  for (i, row) in batch:
+    try:
+      (username, password, email) = row
+      if not username_re.match(username or ''):
+        raise ValidationError('Invalid username.')
+      if not password:
+        raise ValidationError('Missing password.')
+      validators.validate_email(email or '')
+      valid.append((i, username, password, email))
+    except (ValueError, TypeError):
+      failures.append((i, 'Malformed row.'))
+    except ValidationError as e:
+      failures.append((i, '; '.join(e.messages)))
+
+  usernames = set(User.objects.filter(username__in=[r[1] for r in valid])
+                              .values_list('username', flat=True))
+  emails = set(User.objects.filter(email__in=[r[3] for r in valid],
+                                   is_active=True)
+                           .values_list('email', flat=True))
+  existing = dict(((handle, 'email'), (pk, owner)) for (handle, pk, owner)
+                  in Agent.objects.filter(handle__in=[r[3] for r in valid],
+                                          service='email')
+                                  .values_list('handle', 'id', 'owner'))
+  accepted = []
+  for (i, username, password, email) in valid:
+    owned = existing.get((email, 'email'), (None, None))[1] is not None
+    if username in usernames:
+      failures.append((i, 'Username already exists in the system.'))
+    elif email in emails or owned:
+      failures.append((i, 'The email address provided already exists in ' +
+                          'the system.'))
+    else:
+      usernames.add(username)
+      accepted.append((username, password, email))
+  if not accepted:
+    return
+
+  # Users start inactive, with a default identity that is active
+  users = []
+  for (username, password, email) in accepted:
+    user = User(username=username, email=email, is_active=False)
+    user.set_password(password)
+    users.append(user)
+  bulk.insert(users)
+  profiles = [Profile(user_id=u.pk) for u in users]
+  bulk.insert(profiles)
+  identities = [Identity(label='default', profile_id=p.pk, is_active=True)
+                for p in profiles]
+  bulk.insert(identities)
+
+  # Then claims on the email addresses, creating agents as needed
+  new_agents = []
+  known = set(existing)
+  for (username, password, email) in accepted:
+    if (email, 'email') not in known:
+      known.add((email, 'email'))
+      new_agents.append(Agent(handle=email, service='email'))
+  bulk.insert(new_agents)
+  for agent in new_agents:
+    agents.directory.saved(agent)
+  batch_claims = [PendingClaim(owner_id=i.pk, handle=u.email, service='email',
+                               ckey=ckey)
+                  for (u, i, ckey) in zip(users, identities,
+                                          generate_ckeys(len(users)))]
+  bulk.insert(batch_claims)
+  claims.extend(batch_claims)
+
+#
+# Looks up the active identity of a user, in a single query.
+#
+# If the RAINBEARD_CACHE_IDENTITIES setting is on, the identity is also kept
+# in django's cache, so that later requests don't need to look it up at all.
+# It's dropped from there whenever the user's identities change.
+#
+def active_identity(user):
+
+  caching = getattr(settings, 'RAINBEARD_CACHE_IDENTITIES', False)
+  key = _identity_key(user.pk)
+  if caching:
+    fields = shared_cache.get(key)
+    if fields is not None:
+      return Identity(id=fields[0], label=fields[1], profile_id=fields[2],
+                      is_active=True)
+
+  identity = Identity.objects.get(profile__user=user, is_active=True)
+  if caching:
+    shared_cache.set(key, (identity.id, identity.label, identity.profile_id),
+                     common.identity_cache_timeout)
+  return identity
+
+def _identity_key(user_id):
+  return 'rainbeard.identity.%d' % user_id
+
+def _identity_saved(sender, instance, **kwargs):
+  if getattr(settings, 'RAINBEARD_CACHE_IDENTITIES', False):
+    shared_cache.delete(_identity_key(instance.profile.user_id))
+
+post_save.connect(_identity_saved, sender=Identity,
+                  dispatch_uid='rainbeard.account.identity')
+
 #
 # Form definitions
 #
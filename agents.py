@@ -0,0 +1,217 @@
+#
+# Cached lookups of agents by (handle, service).
+#
+# Most of the agents looked up from the query page are ones that nobody has
+# ever tagged or claimed, and which therefore don't exist. A Bloom filter over
+# the keys of every agent answers those without going to the database, and a
+# bounded LRU cache answers repeated lookups of the agents that do exist.
+#
+# NB: Signals only fire in the process that makes a change, so agents created
+# or claimed by other processes aren't seen until the directory next catches
+# up, which happens every common.agent_cache_timeout seconds. Until then, both
+# the filter's negative answers and the cached owners can be out of date, as
+# can agents whose creation was rolled back. Catching up reads the agents
+# past the highest id seen so far, so an agent whose id was handed out before
+# that one's but committed after it isn't seen until the filter is rebuilt.
+# Lookups are only good for reading; anything that writes has to check the
+# database when the directory has no answer.
+#
+
+import hashlib, math, struct, threading, timeit
+from collections import OrderedDict
+import numpy as np
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete
+from models import *
+import common
+
+#
+# Bloom filter over strings, sized for 'capacity' keys at the given false
+# positive rate. There are no false negatives.
+#
+class BloomFilter(object):
+
+  def __init__(self, capacity, error_rate):
+    self.capacity = capacity
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    self.hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+    self.bits = np.zeros((bits + 7) // 8, dtype=np.uint8)
+    self.size = self.bits.size * 8
+    self.count = 0
+
+  # Bit positions for a key, by double hashing
+  def _positions(self, key):
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    (a, b) = struct.unpack('<QQ', digest)
+    return [(a + i * b) % self.size for i in range(self.hashes)]
+
+  def add(self, key):
+    for p in self._positions(key):
+      self.bits[p >> 3] |= 1 << (p & 7)
+    self.count += 1
+
+  def __contains__(self, key):
+    return all(self.bits[p >> 3] & (1 << (p & 7))
+               for p in self._positions(key))
+
+# Key of an agent in the filter
+def _key(handle, service):
+  return service + ':' + handle
+
+#
+# Directory of agents, mapping (handle, service) pairs to (agent id, owner
+# id) pairs. The owner id is None for agents that haven't been claimed.
+#
+# The filter is built from the database on first use, and rebuilt with more
+# room whenever it fills up. Every 'timeout' seconds, the agents added since
+# are read into the filter and the cached entries are dropped, to pick up
+# changes made by other processes.
+#
+class AgentDirectory(object):
+
+  def __init__(self, max_entries, error_rate, timeout):
+    self.max_entries = max_entries
+    self.error_rate = error_rate
+    self.timeout = timeout
+    self._lock = threading.RLock()
+    self.clear()
+
+  # Drops everything, so that it is reloaded on next use
+  def clear(self):
+    with self._lock:
+      self._filter = None
+      self._last = 0
+      self._expires = 0
+      self._entries = OrderedDict()
+      self.hits = 0
+      self.misses = 0
+      self.filtered = 0
+
+  # Builds the filter from the keys of every agent, with room to grow. The
+  # lock is held throughout, as there is nothing to answer from meanwhile.
+  def _load(self):
+    rows = Agent.objects.values_list('id', 'handle', 'service')
+    bloom = BloomFilter(max(1024, 2 * len(rows)), self.error_rate)
+    for (pk, handle, service) in rows:
+      bloom.add(_key(handle, service))
+      self._last = max(self._last, pk)
+    self._filter = bloom
+
+  # Catches up with agents created by other processes, if it's due, by adding
+  # those past the last one seen to the filter. Lookups carry on against the
+  # filter as it was while the new agents are read.
+  def _update(self):
+    with self._lock:
+      now = timeit.default_timer()
+      if self._filter is None:
+        self._entries = OrderedDict()
+        self._expires = now + self.timeout
+        self._load()
+        return
+      if now <= self._expires:
+        return
+      self._entries = OrderedDict()
+      self._expires = now + self.timeout
+      (bloom, last) = (self._filter, self._last)
+    rows = list(Agent.objects.filter(pk__gt=last)
+                             .values_list('id', 'handle', 'service'))
+    with self._lock:
+      if self._filter is not bloom:
+        return
+      for (pk, handle, service) in rows:
+        bloom.add(_key(handle, service))
+        self._last = max(self._last, pk)
+      if bloom.count > bloom.capacity:
+        self._filter = None
+
+  # Returns whether an agent might exist. If not, it certainly didn't when
+  # the filter last caught up.
+  def may_exist(self, handle, service):
+    self._update()
+    with self._lock:
+      return self._filter is None or _key(handle, service) in self._filter
+
+  # Looks up an agent, returning (agent id, owner id), or None if there is no
+  # such agent.
+  def lookup(self, handle, service):
+    return self.lookup_many([(handle, service)]).get((handle, service))
+
+  #
+  # Looks up any number of agents, returning a dictionary mapping each
+  # (handle, service) pair that exists to (agent id, owner id). This takes at
+  # most one query, and none if every pair is cached or certainly unknown,
+  # besides catching up when it's due.
+  #
+  def lookup_many(self, pairs):
+
+    result = {}
+    wanted = []
+    self._update()
+    with self._lock:
+      for pair in set(pairs):
+        entry = self._entries.pop(pair, None)
+        if entry is not None:
+          self._entries[pair] = entry
+          self.hits += 1
+          result[pair] = entry
+        elif self._filter is None or _key(*pair) in self._filter:
+          self.misses += 1
+          wanted.append(pair)
+        else:
+          self.filtered += 1
+    if not wanted:
+      return result
+
+    match = Q(pk__in=[])
+    for (handle, service) in wanted:
+      match |= Q(handle=handle, service=service)
+    rows = Agent.objects.filter(match).values_list('handle', 'service', 'id',
+                                                   'owner')
+    with self._lock:
+      for (handle, service, pk, owner) in rows:
+        result[(handle, service)] = (pk, owner)
+        self._put((handle, service), (pk, owner))
+    return result
+
+  def _put(self, pair, entry):
+    self._entries.pop(pair, None)
+    self._entries[pair] = entry
+    while len(self._entries) > self.max_entries:
+      self._entries.popitem(last=False)
+
+  # Notes that an agent has been saved, whether created or claimed
+  def saved(self, agent):
+    pair = (agent.handle, agent.service)
+    with self._lock:
+      self._entries.pop(pair, None)
+      if self._filter is not None:
+        self._filter.add(_key(*pair))
+        if self._filter.count > self._filter.capacity:
+          self._filter = None
+
+  # Notes that an agent has been deleted. It stays in the filter, where it is
+  # a false positive.
+  def deleted(self, agent):
+    with self._lock:
+      self._entries.pop((agent.handle, agent.service), None)
+
+  # Counters, for sizing the cache
+  def stats(self):
+    return {'entries': len(self._entries), 'hits': self.hits,
+            'misses': self.misses, 'filtered': self.filtered}
+
+# The process-wide agent directory
+directory = AgentDirectory(common.agent_cache_entries,
+                           common.agent_filter_error,
+                           common.agent_cache_timeout)
+
+def _agent_saved(sender, instance, **kwargs):
+  directory.saved(instance)
+
+def _agent_deleted(sender, instance, **kwargs):
+  directory.deleted(instance)
+
+post_save.connect(_agent_saved, sender=Agent,
+                  dispatch_uid='rainbeard.agents.agent')
+post_delete.connect(_agent_deleted, sender=Agent,
+                    dispatch_uid='rainbeard.agents.agent')
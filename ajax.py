@@ -1,5 +1,9 @@
-from django.http import HttpResponse
+import hashlib
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
 from rainbeard.models import *
+from rainbeard import agents, cache, common, graph, query, stats
 from django.utils import simplejson as json
 
 #
@@ -7,6 +11,18 @@ from django.utils import simplejson as json
 #
 
 
+# Parameters of an ajax request. Requests that only read may be GETs, so that
+# their responses can be revalidated (see conditional); anything else is a
+# POST.
+def params(request):
+  return request.GET if request.method == 'GET' else request.POST
+
+# The (handle, service) pairs of agents that a request is about, given as
+# parallel lists of handles and services.
+def agent_pairs(request):
+  return zip(params(request).getlist('handle'),
+             params(request).getlist('service'))
+
 # Handy decorator to make sure the user is logged in and do various
 # checking. Accepts a set of the parameters the function expects.
 class check_ajax(object):
@@ -24,48 +40,172 @@ class check_ajax(object):
         return HttpResponse('Not logged in!')
 
       # Make sure that the request looks right
-      if not request.is_ajax() or request.method != 'POST':
+      if not request.is_ajax() or request.method not in ('GET', 'POST'):
         return HttpResponse('Wrong kind of request!')
 
       # Make sure that we have the parameters we want
-      if not this.paramset <= request.POST:
-        return HttResponse(json.dump({'error': 'Wrong ajax parameters!'}))
+      if not self.paramset <= set(params(request)):
+        return HttpResponse(json.dumps({'error': 'Wrong ajax parameters!'}))
 
       # Make sure that the request validates
       try:
-        validate_ajax_params(request.POST)
+        validate_ajax_params(params(request))
       except ValidationError:
-        return HttResponse(json.dump({'error': 'Ajax parameters failed to validate!'}))
+        return HttpResponse(json.dumps({'error': 'Ajax parameters failed to validate!'}))
 
-      # Call through
-      self.f();
+      # Call through, measuring the call. If asked to, report the measurements
+      # in a response header.
+      with stats.measure('ajax.' + f.__name__) as record:
+        response = f(*args)
+      if getattr(settings, 'RAINBEARD_STATS_HEADER', False):
+        response['X-Rainbeard-Stats'] = json.dumps(record, sort_keys=True)
+      return response
 
     return wrapped_f
 
+# Decorator for views whose GET responses can be revalidated by ETag, rather
+# than fetched again. 'etag' is called with the request, and returns the ETag
+# of the response, or None if it shouldn't have one. If the request's
+# If-None-Match header already holds the ETag, the response is an empty 304
+# and the view isn't called at all.
+class conditional(object):
+  def __init__(self, etag):
+    self.etag = etag
+  def __call__(self, f):
+
+    def wrapped_f(request):
+
+      tag = self.etag(request) if request.method == 'GET' else None
+      if tag is None:
+        return f(request)
+      try:
+        known = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+      except ValueError:
+        known = []
+      if tag in known:
+        stats.note(not_modified=1)
+        response = HttpResponseNotModified()
+      else:
+        response = f(request)
+      response['ETag'] = quote_etag(tag)
+      response['Cache-Control'] = 'private, no-cache'
+      return response
+
+    wrapped_f.__name__ = f.__name__
+    return wrapped_f
+
+# ETag for a response about the agents a request is about. Responses only
+# change when the logged in user switches identities, when those agents
+# change hands, or when the graph changes in a way that reaches them: a
+# change to the links within the identity's horizon, or to the tags given
+# about one of the agents' owners (see cache.Versions).
+def agents_etag(request):
+  pairs = agent_pairs(request)
+  owners = agents.directory.lookup_many(pairs)
+  g = graph.snapshot()
+  source = request.identity.id
+  key = [source, cache.horizon_versions.get(g, source)]
+  for pair in pairs:
+    owner = owners.get(pair, (None, None))[1]
+    key.append([pair, owners.get(pair),
+                owner and cache.tag_versions.get(g, owner)])
+  return hashlib.md5(json.dumps(key).encode('utf-8')).hexdigest()
+
+# Gets the tags the logged in user has given any number of agents, given as
+# parallel lists of handles and services. The response maps 'service:handle'
+# strings to dictionaries of tag names and confidences.
 @check_ajax(set(('handle', 'service')))
+@conditional(agents_etag)
 def get_givens(request):
 
+  # One query for everybody
+  givens = query.givens(request.user, agent_pairs(request))
+
+  # Send the response
+  return HttpResponse(json.dumps({'givens': dict((service + ':' + handle, tags)
+                                                 for ((handle, service), tags)
+                                                 in givens.items())}))
+
+# Gets tag clouds for any number of agents, given as parallel lists of handles
+# and services. If a deadline is given, in milliseconds, the clouds may be
+# estimates, in which case they're marked as incomplete. Estimates can't be
+# revalidated.
+@check_ajax(set(('handle', 'service')))
+@conditional(lambda request: None if 'deadline' in params(request)
+                             else agents_etag(request))
+def query_many(request):
+
   # Parameters
-  handle = request.POST['handle']
-  services = request.POST['service']
+  pairs = agent_pairs(request)
+  deadline = params(request).get('deadline')
+  if deadline is not None:
+    deadline = int(deadline) / 1000.0
 
   # The source is the logged in user
-  source = request.user.get_profile().active_profile
-
-  # The destination is given in the query
-  try:
-    dest = Agent.objects.get(handle=handle,service=service)
-  except Agent.DoesNotExist:
-    return HttpResponse(json.dump({'tags': {}}))
+  source = request.identity
 
-  # Get our connection
-  try:
-    connections = Connection.objects.get(src=source,dst=dest)
-  except Connection.DoesNotExist:
-    return HttResponse(json.dump({'tags': {}}))
+  # Look up the owners of all the agents at once. Tags are only ever attached
+  # to identities, so unclaimed agents have nothing to show. Querying only
+  # needs the owners' ids.
+  owners = dict((pair, Identity(id=owner)) for (pair, (pk, owner))
+                in agents.directory.lookup_many(pairs).items()
+                if owner is not None)
 
-  # Get all the tags
-  tags = Tag.objects.filter(connection=connection).values(['name', 'confidence'])
+  # Run the query once for everybody
+  targets = [owners[pair] for pair in pairs if pair in owners]
+  clouds = dict(zip(targets, query.do_query_many(source, targets,
+                                                 deadline=deadline)))
 
   # Send the response
-  return HttpResponse(json.dump({'tags': tags}))
+  results = []
+  for (handle, service) in pairs:
+    cloud = clouds.get(owners.get((handle, service)), {})
+    results.append({'handle': handle, 'service': service, 'tags': cloud,
+                    'complete': getattr(cloud, 'complete', True)})
+  return HttpResponse(json.dumps({'results': results}))
+
+#
+# Streams the tag cloud for one agent, given by handle and service, as
+# server-sent events. Each event carries a JSON object with the tag strengths
+# estimated so far as 'tags', the number of hops they cover as 'hops', and
+# whether they're final as 'complete'. The first estimate goes out as soon as
+# the first hop of propagation is done, and the last is always complete.
+#
+# EventSource can only make plain GET requests, so this does its own checking
+# rather than going through check_ajax.
+#
+def query_stream(request):
+
+  # Make sure that we're authenticated
+  if not request.user.is_authenticated():
+    return HttpResponse('Not logged in!')
+
+  # Make sure that we have the parameters we want
+  if request.method != 'GET' or set(request.GET) != set(('handle', 'service')):
+    return HttpResponse(json.dumps({'error': 'Wrong ajax parameters!'}))
+  try:
+    validate_ajax_params(request.GET)
+  except ValidationError:
+    return HttpResponse(json.dumps({'error': 'Ajax parameters failed to validate!'}))
+
+  # Unclaimed agents have nothing to show. The clouds are worked out while
+  # the response is being sent, which is after the request has finished, so
+  # anything that needs the database, including the lazily resolved identity,
+  # is fetched now, and the clouds only use the snapshot and the caches.
+  entry = agents.directory.lookup(request.GET['handle'], request.GET['service'])
+  if entry is None or entry[1] is None:
+    clouds = [query.TagCloud()]
+    clouds[0].hops = common.query_hops
+    clouds[0].complete = True
+  else:
+    clouds = query.stream_query(Identity(id=request.identity.id),
+                                Identity(id=entry[1]), g=graph.snapshot())
+
+  def events():
+    for cloud in clouds:
+      yield 'data: %s\n\n' % json.dumps({'tags': cloud, 'hops': cloud.hops,
+                                         'complete': cloud.complete})
+
+  response = HttpResponse(events(), mimetype='text/event-stream')
+  response['Cache-Control'] = 'no-cache'
+  return response
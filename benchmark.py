@@ -0,0 +1,138 @@
+#
+# Benchmark harness for the query path and account management.
+#
+# Each benchmark writes one JSON record per line, so that results from
+# different versions can be collected and compared mechanically. Records look
+# like:
+#
+# {"label": "v0.2", "timestamp": 1300000000, "benchmark": "do_query",
+#  "identities": 1000, "links": 7900, "tags": 9500, "count": 100,
+#  "mean_ms": 1.2, "p50_ms": 1.1, "p95_ms": 2.0, "max_ms": 3.4}
+#
+# NB: The harness wipes all users and rainbeard data before generating each
+# graph, so it must only be pointed at a scratch database. The benchmark
+# management command takes care of that.
+#
+
+import os, shutil, tempfile, time, timeit
+import numpy as np
+from django.contrib.auth.models import User
+from django.test.client import Client
+from django.utils import simplejson as json
+from models import *
+import account, bulk, cache, changes, graph, query, synthetic
+
+# Graph sizes, in identities, that are benchmarked by default
+default_sizes = [1000, 10000, 100000]
+
+# Wipes all users and rainbeard data, along with any process-wide state
+# derived from them.
+def clear():
+  bulk.delete_all([Reputation, Tag, TagSet, ConfidantLink, PendingClaim, Agent,
+                   Identity, Profile, User])
+  changes.record_reload()
+  query.reset()
+
+# Times each call of f(x) for x in xs, returning the timings in milliseconds
+def timings(f, xs):
+  result = []
+  for x in xs:
+    start = timeit.default_timer()
+    f(x)
+    result.append((timeit.default_timer() - start) * 1000.0)
+  return result
+
+#
+# Generates a graph of each of the given sizes and times the query path and
+# account management on it, writing JSON records to 'out'.
+#
+# 'queries' is the number of random (source, target) pairs queried, and
+# 'accounts' the number of accounts registered and claimed.
+#
+def run(out, sizes=None, queries=100, accounts=20, label='', seed=0):
+
+  for n in sizes or default_sizes:
+
+    clear()
+    ids = synthetic.generate(n, seed=seed)
+    base = {'label': label, 'timestamp': int(time.time()), 'identities': n,
+            'links': ConfidantLink.objects.count(),
+            'tags': Tag.objects.count()}
+
+    def record(name, ms):
+      ms = np.asarray(ms)
+      entry = dict(base, benchmark=name, count=len(ms),
+                   mean_ms=float(ms.mean()),
+                   p50_ms=float(np.percentile(ms, 50)),
+                   p95_ms=float(np.percentile(ms, 95)),
+                   max_ms=float(ms.max()))
+      out.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    # Random query pairs
+    rng = np.random.RandomState(seed)
+    indices = rng.randint(0, n, size=(queries, 2)).tolist()
+    identities = Identity.objects.in_bulk(ids)
+    pairs = [(identities[ids[s]], identities[ids[t]]) for (s, t) in indices]
+
+    # Loading the graph, then querying it with and without the cache
+    record('snapshot_load', timings(lambda x: query.reset() or
+                                              graph.snapshot(), [None]))
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'graph')
+      graph.snapshot().save(path)
+      record('snapshot_open', timings(graph.Graph.open, [path]))
+    finally:
+      shutil.rmtree(directory)
+    def uncached(f):
+      def wrapped(args):
+        cache.clear()
+        f(*args)
+      return wrapped
+    record('do_query', timings(uncached(query.do_query), pairs))
+    def from_horizon(pair):
+      cache.clouds.clear()
+      query.do_query(*pair)
+    record('do_query_horizon', timings(from_horizon, pairs))
+    for pair in pairs:
+      query.do_query(*pair)
+    record('do_query_cached', timings(lambda pair: query.do_query(*pair), pairs))
+    record('do_query_sampled',
+           timings(lambda pair: query.do_query_sampled(*pair, seed=seed),
+                   pairs))
+    targets = [t for (s, t) in pairs]
+    record('do_query_many', timings(uncached(query.do_query_many),
+                                    [(s, targets) for (s, t) in pairs[:10]]))
+
+    # Registering and claiming accounts
+    names = ['bench%d' % i for i in range(accounts)]
+    record('register_user', timings(
+      lambda name: account.register_user(name, 'pass', name + '@example.com',
+                                         send_email=False), names))
+    ckeys = [PendingClaim.objects.get(handle=name + '@example.com').ckey
+             for name in names]
+    record('do_claim', timings(account.do_claim, ckeys))
+    rows = [('bulk%d' % i, 'pass', 'bulk%d@example.com' % i)
+            for i in range(accounts * 10)]
+    claims = []
+    record('register_users', timings(
+      lambda rows: claims.extend(account.register_users(rows)[0]), [rows]))
+    record('do_claims', timings(account.do_claims,
+                                [[claim.ckey for claim in claims]]))
+
+    # Ajax endpoints, as the first benchmarked user
+    client = Client()
+    client.login(username=names[0], password='pass')
+    post = lambda url, data: client.post(url, data,
+                                         HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    handles = ['synth%d@example.com' % t for (s, t) in indices]
+    record('ajax_query_many', timings(
+      lambda handle: post('/ajax/query/many', {'handle': handle,
+                                               'service': 'email'}),
+      handles))
+    record('ajax_givens', timings(
+      lambda handle: post('/ajax/givens/get', {'handle': handle,
+                                               'service': 'email'}),
+      handles))
+
+  clear()
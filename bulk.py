@@ -0,0 +1,140 @@
+#
+# Bulk database operations.
+#
+# Django doesn't give us a way to write many rows in one go, so these build
+# the statements by hand. None of them send model signals, so callers are
+# responsible for anything that listens to those (see query.reset()), and
+# for noting bulk changes to the graph in the change log (see changes.py).
+#
+
+from django.db import connection, transaction
+from django.db.models import Max
+from django.core.management.color import no_style
+
+# Number of rows per statement
+batch_size = 300
+
+# Most parameters a single statement can take (SQLite's default limit)
+max_params = 999
+
+# Returns the next free primary key for a model
+def next_pk(model):
+  last = model.objects.aggregate(last=Max('pk'))['last']
+  return (last or 0) + 1
+
+#
+# Inserts rows into a model's table. 'names' are the attribute names of the
+# columns (e.g. 'owner_id' for a foreign key), and 'rows' are tuples of values
+# that are already in database form.
+#
+def insert_rows(model, names, rows):
+
+  qn = connection.ops.quote_name
+  column = _columns(model)
+  sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+          qn(model._meta.db_table),
+          ', '.join(qn(column[name]) for name in names),
+          ', '.join(['%s'] * len(names)))
+
+  cursor = _execute(sql, rows)
+
+  # If we supplied primary keys, the database's sequence needs to catch up
+  if model._meta.pk.attname in names:
+    for statement in connection.ops.sequence_reset_sql(no_style(), [model]):
+      cursor.execute(statement)
+  transaction.commit_unless_managed()
+
+#
+# Updates rows of a model's table. Each of 'rows' holds new values for the
+# columns with the attribute names 'names', followed by the value that picks
+# out the row to update in the column named 'key'. Each batch of rows is
+# updated by a single statement, choosing each row's values with CASE.
+#
+def update_rows(model, names, key, rows):
+  qn = connection.ops.quote_name
+  column = _columns(model)
+  rows = list(rows)
+  cursor = connection.cursor()
+  size = _statement_rows(2 * len(names) + 1)
+  for start in range(0, len(rows), size):
+    batch = rows[start:start + size]
+    cases = ' '.join(['WHEN %s THEN %s'] * len(batch))
+    sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table),
+            ', '.join('%s = CASE %s %s END' % (qn(column[name]),
+                                               qn(column[key]), cases)
+                      for name in names),
+            qn(column[key]), ', '.join(['%s'] * len(batch)))
+    params = []
+    for i in range(len(names)):
+      for row in batch:
+        params.extend((row[-1], row[i]))
+    cursor.execute(sql, params + [row[-1] for row in batch])
+  transaction.commit_unless_managed()
+
+#
+# Deletes the rows of a model's table that match any of 'rows' in the columns
+# with the attribute names 'keys', a batch of rows per statement.
+#
+def delete_rows(model, keys, rows):
+  qn = connection.ops.quote_name
+  column = _columns(model)
+  match = '(%s)' % ' AND '.join('%s = %%s' % qn(column[key]) for key in keys)
+  rows = list(rows)
+  cursor = connection.cursor()
+  size = _statement_rows(len(keys))
+  for start in range(0, len(rows), size):
+    batch = rows[start:start + size]
+    sql = 'DELETE FROM %s WHERE %s' % (qn(model._meta.db_table),
+                                       ' OR '.join([match] * len(batch)))
+    cursor.execute(sql, [value for row in batch for value in row])
+  transaction.commit_unless_managed()
+
+# Number of rows that fit in a statement taking 'params' parameters per row
+def _statement_rows(params):
+  return max(1, min(batch_size, max_params // params))
+
+# Maps attribute names to column names for a model
+def _columns(model):
+  return dict((f.attname, f.column) for f in model._meta.local_fields)
+
+# Executes a statement for each of 'rows', a batch at a time, returning the
+# cursor
+def _execute(sql, rows):
+  cursor = connection.cursor()
+  rows = list(rows)
+  for start in range(0, len(rows), batch_size):
+    cursor.executemany(sql, rows[start:start + batch_size])
+  return cursor
+
+#
+# Inserts unsaved instances of a single model. Instances without a primary key
+# are given fresh ones, which are set on the instances.
+#
+# NB: Fresh keys are allocated by looking at the largest key in the table, so
+# concurrent inserts into the same table need to be serialized by the caller.
+#
+def insert(objects):
+
+  if not objects:
+    return
+  model = type(objects[0])
+  missing = [o for o in objects if o.pk is None]
+  start = next_pk(model) if missing else 0
+  for (i, o) in enumerate(missing):
+    o.pk = start + i
+
+  fields = model._meta.local_fields
+  insert_rows(model, [f.attname for f in fields],
+              [[f.get_db_prep_save(f.pre_save(o, True), connection=connection)
+                for f in fields] for o in objects])
+
+#
+# Deletes every row of the given models' tables, in order.
+#
+def delete_all(models):
+  cursor = connection.cursor()
+  for model in models:
+    cursor.execute('DELETE FROM %s' %
+                   connection.ops.quote_name(model._meta.db_table))
+  transaction.commit_unless_managed()
@@ -0,0 +1,267 @@
+#
+# Caching of query results, and of the trust horizons they're computed from.
+#
+
+import threading, weakref
+from collections import OrderedDict
+from django.db.models.signals import post_save, post_delete
+from models import *
+import changes, common
+import graph
+
+# Rough size of a tag cloud in memory, in bytes
+def cloud_size(cloud):
+  return 280 + sum(100 + len(name) for name in cloud)
+
+#
+#
+# Bounded LRU cache of tag clouds, keyed by (source, target) identity pairs.
+#
+# The cache is bounded both by entry count and by the approximate number of
+# bytes held. When either bound is exceeded, the least recently used entries
+# are evicted.
+#
+# Entries are invalidated precisely when the graph changes. A change to the
+# confidant links out of identity u affects only the sources that can reach u
+# in fewer than common.query_hops hops, and a change to the tags given by
+# identity v about identity t affects only the (source, t) entries whose
+# source can reach v within common.query_hops hops.
+#
+#
+class CloudCache(object):
+
+  def __init__(self, max_entries, max_bytes):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    self.clear()
+
+  # Drops all entries and resets the counters
+  def clear(self):
+    with self._lock:
+      self._entries = OrderedDict()
+      self._by_source = {}
+      self.bytes = 0
+      self.hits = 0
+      self.misses = 0
+      self.evictions = 0
+      self.invalidations = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  # Returns a copy of the cached cloud for (source, target), or None.
+  def get(self, source, target):
+    key = (source, target)
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self.misses += 1
+        return None
+      self._entries[key] = entry
+      self.hits += 1
+      return self._copy(entry[0])
+
+  # Caches the cloud for (source, target).
+  def put(self, source, target, cloud):
+    key = (source, target)
+    size = self._size(cloud)
+    with self._lock:
+      self._discard(key)
+      self._entries[key] = (self._copy(cloud), size)
+      self._by_source.setdefault(source, set()).add(key)
+      self.bytes += size
+
+      # Evict from the LRU end
+      while (len(self._entries) > self.max_entries or
+             self.bytes > self.max_bytes):
+        self._discard(next(iter(self._entries)))
+        self.evictions += 1
+
+  # Copies an entry, so that callers can't modify what's cached
+  def _copy(self, cloud):
+    return dict(cloud)
+
+  def _size(self, cloud):
+    return cloud_size(cloud)
+
+  def _discard(self, key):
+    entry = self._entries.pop(key, None)
+    if entry is None:
+      return False
+    self.bytes -= entry[1]
+    keys = self._by_source[key[0]]
+    keys.discard(key)
+    if not keys:
+      del self._by_source[key[0]]
+    return True
+
+  # Invalidates the entries for the given sources. If 'target' is given, only
+  # entries for that target are invalidated.
+  def invalidate(self, sources, target=None):
+    with self._lock:
+      for source in sources:
+        for key in list(self._by_source.get(source, ())):
+          if target is None or key[1] == target:
+            self.invalidations += self._discard(key)
+
+  # Counters, for sizing the cache
+  def stats(self):
+    return {'entries': len(self._entries), 'bytes': self.bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations}
+
+#
+#
+# Bounded LRU cache of trust horizons, keyed by (source, hops) pairs.
+#
+# The trust horizon of a source is the trust it places in each identity
+# within so many hops, as sorted arrays of identity primary keys and trust
+# values (see query.horizon()). Tags don't come into it, so only changes to
+# confidant links invalidate horizons. The arrays are shared, and read-only.
+#
+#
+class HorizonCache(CloudCache):
+
+  def _copy(self, horizon):
+    return horizon
+
+  def _size(self, horizon):
+    return 200 + horizon[0].nbytes + horizon[1].nbytes
+
+#
+# Versions of the last change to something about each identity, as numbered
+# by the change log, for telling whether a response can have changed (see
+# ajax.agents_etag). Identities that haven't changed since the snapshot was
+# loaded have the version it was loaded at, so there is one entry per
+# identity that has.
+#
+class Versions(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._graph = None
+    self._base = 0
+    self._versions = {}
+
+  # Starts afresh whenever the snapshot is reloaded
+  def _check(self, g):
+    if self._graph is None or self._graph() is not g:
+      self._graph = weakref.ref(g)
+      self._base = g.version
+      self._versions = {}
+
+  # Notes that the given identities changed in 'version' of snapshot 'g'
+  def stamp(self, g, ids, version):
+    with self._lock:
+      self._check(g)
+      for pk in ids:
+        self._versions[pk] = max(self._versions.get(pk, self._base), version)
+
+  # Returns the version of the last change to an identity in snapshot 'g'
+  def get(self, g, pk):
+    with self._lock:
+      self._check(g)
+      return self._versions.get(pk, self._base)
+
+# The process-wide caches of tag clouds and trust horizons
+clouds = CloudCache(common.cloud_cache_entries, common.cloud_cache_bytes)
+horizons = HorizonCache(common.horizon_cache_entries,
+                        common.horizon_cache_bytes)
+
+# Versions of the last change to each source's horizon, and to the tags given
+# about each target, kept by the signal handlers below
+horizon_versions = Versions()
+tag_versions = Versions()
+
+# Drops every cached cloud and horizon
+def clear():
+  clouds.clear()
+  horizons.clear()
+
+#
+# Signal handlers to invalidate cached clouds and horizons when the graph
+# changes. These look at the snapshot, which is only missing if it has been
+# dropped, in which case anything cached is suspect.
+#
+
+# Invalidates the entries in 'caches' for every source that can reach one of
+# 'indices' within 'hops' hops, optionally including the identities
+# themselves. Returns the ids of the sources.
+def _invalidate_reaching(caches, g, indices, hops, target=None,
+                         inclusive=False):
+  mask = g.reaching(indices, hops)
+  if inclusive:
+    mask[indices] = True
+  sources = g.ids[mask].tolist()
+  for c in caches:
+    c.invalidate(sources, target)
+  return sources
+
+# Horizons are only cached for common.query_hops hops, so links change the
+# same entries in both caches
+def _link_changed(sender, instance, **kwargs):
+  g = graph.loaded()
+  if g is None:
+    return clear()
+  src = g.index(instance.src_id)
+  if src is not None:
+    sources = _invalidate_reaching([clouds, horizons], g, [src],
+                                   common.query_hops - 1, inclusive=True)
+    horizon_versions.stamp(g, sources, changes.last_written())
+
+def _tag_changed(sender, instance, **kwargs):
+  g = graph.loaded()
+  if g is None:
+    return clouds.clear()
+  tagset = g.tagset(instance.tagset_id)
+  if tagset is not None:
+    tagger, target = tagset
+    _invalidate_reaching([clouds], g, [tagger], common.query_hops,
+                         target=int(g.ids[target]))
+    tag_versions.stamp(g, [int(g.ids[target])], changes.last_written())
+
+# Invalidates the entries affected by the changes made by other processes,
+# when the snapshot catches up with them. Tagsets are only deleted with their
+# tags, by which time the snapshot doesn't know whose tags they were, so the
+# tagset changes stand in for them.
+def _caught_up(sender, entries, local, **kwargs):
+  g = kwargs['graph']
+  if entries is None:
+    return clear()
+  entries = [e for e in entries if e.pk not in local]
+  if not entries:
+    return
+  version = entries[-1].pk
+
+  srcs = [g.index(e.src) for e in entries if e.kind == 'link']
+  srcs = [src for src in srcs if src is not None]
+  if srcs:
+    sources = _invalidate_reaching([clouds, horizons], g, srcs,
+                                   common.query_hops - 1, inclusive=True)
+    horizon_versions.stamp(g, sources, version)
+
+  taggers = {}
+  for e in entries:
+    tagset = None
+    if e.kind == 'tagset':
+      tagset = (g.index(e.src), g.index(e.dst))
+    elif e.kind == 'tag':
+      tagset = g.tagset(e.src)
+    if tagset is not None and None not in tagset:
+      taggers.setdefault(int(g.ids[tagset[1]]), set()).add(tagset[0])
+  for (target, indices) in taggers.items():
+    _invalidate_reaching([clouds], g, list(indices), common.query_hops,
+                         target=target)
+  tag_versions.stamp(g, list(taggers), version)
+
+post_save.connect(_link_changed, sender=ConfidantLink,
+                  dispatch_uid='rainbeard.cache.link')
+post_delete.connect(_link_changed, sender=ConfidantLink,
+                    dispatch_uid='rainbeard.cache.link')
+post_save.connect(_tag_changed, sender=Tag,
+                  dispatch_uid='rainbeard.cache.tag')
+post_delete.connect(_tag_changed, sender=Tag,
+                    dispatch_uid='rainbeard.cache.tag')
+graph.caught_up.connect(_caught_up, dispatch_uid='rainbeard.cache.caught_up')
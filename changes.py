@@ -0,0 +1,118 @@
+#
+# The log of changes to the trust graph.
+#
+# Every save or delete of a ConfidantLink, TagSet or Tag appends a GraphChange
+# in the same transaction. The log's primary keys make a global graph version
+# number, so anything derived from the graph can record the version it
+# reflects, and later catch up by reading just the changes since then, rather
+# than rescanning whole tables.
+#
+# Each process's snapshot of the graph catches up with the log regularly (see
+# graph.refresh()), and passes the changes on to the caches and the result
+# store. Those already handle the changes made by their own process through
+# signals, so the log also keeps track of which changes those are.
+#
+# NB: Writes made in bulk (see bulk.py) send no signals, so they aren't
+# logged individually. Whoever makes them should call record_reload().
+#
+# NB: Versions are allocated when a change is written, not when it commits, so
+# with concurrent writers a change can become visible after ones with higher
+# versions. Readers that need every change should stay a little behind the
+# latest version. Some databases also reuse the versions of changes that were
+# rolled back.
+#
+
+import threading
+from django.db.models import Max
+from django.db.models.signals import post_save, post_delete
+from models import *
+
+# Versions of the changes written by this process that haven't been read back
+# from the log yet, and the version of the last change written by each thread
+_written = set()
+_written_lock = threading.Lock()
+_last = threading.local()
+
+# Returns the current graph version, which is 0 before anything changes
+def current_version():
+  return GraphChange.objects.aggregate(version=Max('pk'))['version'] or 0
+
+#
+# Returns the changes after 'version', in order, as a list of GraphChanges.
+# At most 'limit' are returned, if given, in which case there may be more to
+# read after the last.
+#
+def since(version, limit=None):
+  changes = GraphChange.objects.filter(pk__gt=version).order_by('pk')
+  if limit is not None:
+    changes = changes[:limit]
+  return list(changes)
+
+# Notes that the graph has been changed in bulk
+def record_reload():
+  GraphChange(kind='reload').save()
+
+# Returns the version of the last change written by this thread, or None
+def last_written():
+  return getattr(_last, 'version', None)
+
+#
+# Returns the set of versions among 'entries', as read from the log in order,
+# of the changes written by this process. Each change is only reported once.
+#
+# Changes written by this process that are older than the last of 'entries'
+# but aren't among them won't be read (see above), or were rolled back, so
+# they're forgotten too.
+#
+def written_here(entries):
+  with _written_lock:
+    found = set(e.pk for e in entries if e.pk in _written)
+    if entries:
+      last = entries[-1].pk
+      _written.difference_update([v for v in _written if v <= last])
+  return found
+
+# Forgets the changes written by this process, as when its state derived from
+# the graph is dropped
+def reset():
+  with _written_lock:
+    _written.clear()
+
+# Writes a change to the log
+def _write(change):
+  change.save()
+  _last.version = change.pk
+  with _written_lock:
+    _written.add(change.pk)
+
+#
+# Signal handlers to write the log.
+#
+
+def _link_changed(sender, instance, **kwargs):
+  _write(GraphChange(kind='link', deleted=kwargs['signal'] is post_delete,
+                     object_id=instance.id, src=instance.src_id,
+                     dst=instance.dst_id, value=instance.prop_coef))
+
+def _tagset_changed(sender, instance, **kwargs):
+  _write(GraphChange(kind='tagset', deleted=kwargs['signal'] is post_delete,
+                     object_id=instance.id, src=instance.tagger_id,
+                     dst=instance.target_id))
+
+def _tag_changed(sender, instance, **kwargs):
+  _write(GraphChange(kind='tag', deleted=kwargs['signal'] is post_delete,
+                     object_id=instance.id, src=instance.tagset_id,
+                     name=instance.name, value=instance.confidence))
+
+post_save.connect(_link_changed, sender=ConfidantLink,
+                  dispatch_uid='rainbeard.changes.link')
+post_delete.connect(_link_changed, sender=ConfidantLink,
+                    dispatch_uid='rainbeard.changes.link')
+post_save.connect(_tagset_changed, sender=TagSet,
+                  dispatch_uid='rainbeard.changes.tagset')
+post_delete.connect(_tagset_changed, sender=TagSet,
+                    dispatch_uid='rainbeard.changes.tagset')
+post_save.connect(_tag_changed, sender=Tag,
+                  dispatch_uid='rainbeard.changes.tag')
+post_delete.connect(_tag_changed, sender=Tag,
+                    dispatch_uid='rainbeard.changes.tag')
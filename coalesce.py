@@ -0,0 +1,165 @@
+#
+# Coalescing of identical concurrent computations.
+#
+# When many requests want the same expensive result at once, only the first
+# computes it, and the rest wait for it and share it. Within a process, that's
+# done by tracking the computations in flight. Across the processes on a
+# host, it's done with a lock file per computation in the directory given by
+# the RAINBEARD_COALESCE_DIR setting: whoever gets the lock first computes
+# the result and leaves it next to the lock, where the processes that were
+# waiting for the lock pick it up. Results and locks are removed once they
+# fall out of use.
+#
+# Locking across processes needs fcntl, so it's only available on POSIX
+# systems.
+#
+
+import os, threading, time
+import numpy as np
+from django.conf import settings
+import common
+import stats
+import store
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# A computation in flight
+class _Call(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.ok = False
+    self.result = None
+
+#
+#
+# Tracks computations in flight in this process, so that callers asking for
+# the same one at the same time share a single run of it.
+#
+#
+class SingleFlight(object):
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+
+  #
+  # Returns compute(), unless a computation with the same key is already in
+  # flight, in which case this waits for it and returns its result instead.
+  # If that computation fails, the exception goes to its own caller, and the
+  # callers that were waiting for it compute the result themselves.
+  #
+  def do(self, key, compute):
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _Call()
+
+    if not leader:
+      call.done.wait()
+      if call.ok:
+        stats.note(coalesced=1)
+        return call.result
+      return compute()
+
+    try:
+      call.result = compute()
+      call.ok = True
+      return call.result
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+# The process-wide computations in flight
+flights = SingleFlight()
+
+# Returns the directory for coalescing across processes, or None if that
+# isn't set up
+def directory():
+  if fcntl is None:
+    return None
+  return getattr(settings, 'RAINBEARD_COALESCE_DIR', None)
+
+#
+# Coalesces a computation across the processes using directory(). Runs
+# compute() under an exclusive lock on the file for 'name', unless another
+# process finished the same computation for the same 'version' within the
+# last 'window' seconds (by default, common.coalesce_window), in which case
+# its result is returned instead. Results are dictionaries of numpy arrays.
+#
+# The version should be that of the graph snapshot the computation reads, so
+# that a process whose snapshot is behind can't pass off its result as
+# current.
+#
+def across_processes(name, version, compute, window=None):
+
+  if window is None:
+    window = common.coalesce_window
+  _sweep(window)
+  path = os.path.join(directory(), name)
+  with open(path + '.lock', 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+      os.utime(path + '.lock', None)
+      result = _recent(path + '.npz', version, window)
+      if result is not None:
+        stats.note(coalesced=1)
+        return result
+      result = compute()
+      store.write_atomic(path + '.npz',
+                         lambda f: np.savez(f, version=version, **result))
+      return result
+    finally:
+      fcntl.flock(lock, fcntl.LOCK_UN)
+
+# Reads a result left by across_processes(), if it's for 'version' and no
+# more than 'window' seconds old. Returns None otherwise, removing the result
+# if it's too old or for an older version.
+def _recent(path, version, window):
+  try:
+    stale = time.time() - os.path.getmtime(path) > window
+    if not stale:
+      with np.load(path) as f:
+        found = int(f['version'])
+        if found == version:
+          return dict((key, f[key]) for key in f.files if key != 'version')
+        stale = found < version
+    if stale:
+      os.remove(path)
+  except (IOError, OSError, KeyError, ValueError):
+    pass
+  return None
+
+# When this process last swept the directory
+_swept = 0
+
+#
+# Removes the results and locks in directory() that are more than 'window'
+# seconds old, at most once every 'window' seconds. Locks that are held are
+# left alone. A lock removed just as another process opens it can let two
+# processes run the same computation, which only costs the time.
+#
+def _sweep(window):
+  global _swept
+  now = time.time()
+  if now - _swept < window:
+    return
+  _swept = now
+  root = directory()
+  for name in os.listdir(root):
+    path = os.path.join(root, name)
+    try:
+      if now - os.path.getmtime(path) <= window:
+        continue
+      if not name.endswith('.lock'):
+        os.remove(path)
+        continue
+      with open(path, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.remove(path)
+    except (IOError, OSError):
+      pass
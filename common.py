@@ -7,3 +7,48 @@ services = ['facebook', 'email']
 
 # Length of confirmation keys
 ckey_length = 20
+
+# Maximum number of confidant hops that trust propagates across in a query
+query_hops = 3
+
+# Number of seconds between catching each process's snapshot of the graph up
+# with the changes made by other processes (see graph.refresh())
+catch_up_interval = 1.0
+
+# Bounds on the tag cloud cache, in entries and (approximate) bytes
+cloud_cache_entries = 10000
+cloud_cache_bytes = 16 * 1024 * 1024
+
+# Bounds on the trust horizon cache, in entries and (approximate) bytes
+horizon_cache_entries = 10000
+horizon_cache_bytes = 64 * 1024 * 1024
+
+# Default bound on the error in tag strengths for bounded queries
+query_epsilon = 0.01
+
+# Memory to use for the blocks of trust vectors that are propagated from many
+# sources at once (see query.propagate_block()), in bytes
+block_bytes = 256 * 1024 * 1024
+
+# Number of seconds a result computed by one process is shared with others
+# asking for the same computation (see coalesce.py)
+coalesce_window = 1.0
+
+# Most random walks that sampled queries take, and how many are taken at a
+# time
+sample_walks = 100000
+sample_batch = 4096
+
+# Bound on the agent lookup cache, in entries, and the false positive rate of
+# the filter of known agents
+agent_cache_entries = 100000
+agent_filter_error = 0.01
+
+# Number of seconds between the agent directory catching up with agents
+# created by other processes and dropping its cached owners, which bounds how
+# long those agents and claims can go unseen
+agent_cache_timeout = 60
+
+# Number of seconds active identities are cached for, when they are (see
+# account.active_identity())
+identity_cache_timeout = 3600
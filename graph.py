@@ -0,0 +1,745 @@
+#
+# In-memory representation of the trust graph, as used by the query engine.
+#
+# Each process keeps a single snapshot of the graph, built from the database
+# the first time it is needed. From then on, the snapshot is kept current by
+# signal handlers on the models it mirrors, so that queries never need to go
+# back to the database.
+#
+# NB: Signals only fire in the process that makes a change. Other processes
+# with a snapshot loaded see the change when they next catch up with the
+# change log (see below), which happens every common.catch_up_interval
+# seconds.
+#
+# A snapshot can also be saved to a file, and mapped into memory from there
+# (see Graph.save() and Graph.open()). Every process on a host that maps the
+# same file shares one copy of it in the page cache, and mapping it is much
+# quicker than building the snapshot from the database.
+#
+# Snapshots know the version of the graph they were built at (see
+# changes.py), and can catch up with the changes made since by reading the
+# change log, whether they were made by this process or not.
+#
+
+import json, mmap, os, struct, threading, timeit
+import numpy as np
+from scipy import sparse
+from django.conf import settings
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import Signal
+from models import *
+import changes
+import common
+
+#
+#
+# Compact, array-backed view of the confidant links and tags in the database.
+#
+# Identities are addressed by their row index in 'ids', which holds the
+# primary keys of all known identities in ascending order.
+#
+# Confidant links are held in CSR form: the links out of the identity at index
+# i go to indices[indptr[i]:indptr[i+1]], with prop_coefs (in quarters) in the
+# same positions of 'coefs'.
+#
+# Tags are grouped by the identity they describe. The tags describing the
+# identity at index t occupy positions tag_ptr[t]:tag_ptr[t+1] of the
+# 'tag_ids', 'tag_tagger', 'tag_name_id' and 'tag_conf' arrays. Taken together,
+# such a slice is a sparse matrix of taggers by tag names holding confidences.
+#
+# Tag names are interned: each distinct name is stored once, in 'names', and
+# tags refer to it by its position there. Names are added as they're first
+# seen, and never removed, so a name's id never changes.
+#
+# Changes reported through the update methods are queued, and folded into the
+# arrays in one vectorized pass the next time the arrays are read.
+#
+#
+class Graph(object):
+
+  def __init__(self, ids, links, tagsets, tags, version=0):
+
+    # Identities
+    self.ids = np.asarray(ids, dtype=np.int32)
+
+    # Links, as (src index, dst index, prop_coef) columns
+    self._set_links(*links)
+
+    # Tagsets, as (id, tagger index, target index) columns
+    self._set_tagsets(*tagsets)
+
+    # Tags, as (id, tagger index, target index, name, confidence) columns
+    self.names = np.zeros(0, dtype=object)
+    self._name_ids = {}
+    (pk, tagger, target, name, conf) = tags
+    self._set_tags(pk, tagger, target, self.intern(name), conf)
+
+    self._init_changes()
+    self.version = version
+
+  # Sets up the queues of changes and the state derived from the arrays
+  def _init_changes(self):
+
+    # Queued changes, in terms of primary keys
+    self._lock = threading.RLock()
+    self._new_ids = set()
+    self._links = {}
+    self._tagsets = {}
+    self._tags = {}
+    self._links_op = None
+    self._in_links = None
+    self._cumcoefs = None
+    self._bounds = {}
+
+  # Stores link columns in CSR form
+  def _set_links(self, src, dst, coef):
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    order = np.lexsort((dst, src))
+    counts = np.bincount(src, minlength=len(self.ids))
+    self.indptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+    self.indices = dst[order].astype(np.int32)
+    self.coefs = np.asarray(coef, dtype=np.uint8)[order]
+
+  # Stores tagset columns, sorted by id
+  def _set_tagsets(self, pk, tagger, target):
+    pk = np.asarray(pk, dtype=np.int32)
+    order = np.argsort(pk)
+    self.tagset_ids = pk[order]
+    self.tagset_tagger = np.asarray(tagger, dtype=np.int32)[order]
+    self.tagset_target = np.asarray(target, dtype=np.int32)[order]
+
+  # Stores tag columns, sorted by target. Names are given by id.
+  def _set_tags(self, pk, tagger, target, name_id, conf):
+    target = np.asarray(target, dtype=np.int64)
+    order = np.argsort(target, kind='mergesort')
+    self.tag_ids = np.asarray(pk, dtype=np.int32)[order]
+    self.tag_tagger = np.asarray(tagger, dtype=np.int32)[order]
+    self.tag_name_id = np.asarray(name_id, dtype=np.int32)[order]
+    self.tag_conf = np.asarray(conf, dtype=np.uint8)[order]
+    counts = np.bincount(target, minlength=len(self.ids))
+    self.tag_ptr = np.concatenate(([0], np.cumsum(counts))).astype(np.int32)
+
+  # Returns the ids of the given tag names, as an array, adding any names not
+  # seen before to the vocabulary.
+  def intern(self, names):
+    ids = self._name_ids
+    new = [name for name in set(names) if name not in ids]
+    if new:
+      new.sort()
+      for name in new:
+        ids[name] = len(ids)
+      self.names = np.concatenate((self.names, np.array(new, dtype=object)))
+    return np.array([ids[name] for name in names], dtype=np.int32)
+
+  # Number of identities in the graph
+  def __len__(self):
+    self.sync()
+    return len(self.ids)
+
+  # Size of the arrays backing the graph, in bytes
+  def nbytes(self):
+    self.sync()
+    return sum(a.nbytes for a in (self.ids, self.indptr, self.indices,
+                                  self.coefs, self.tagset_ids,
+                                  self.tagset_tagger, self.tagset_target,
+                                  self.tag_ids, self.tag_tagger,
+                                  self.tag_name_id, self.tag_conf,
+                                  self.tag_ptr))
+
+  # Maps an identity primary key to its row index, or None if the identity is
+  # unknown.
+  def index(self, pk):
+    self.sync()
+    return self._index(pk)
+
+  def _index(self, pk):
+    i = np.searchsorted(self.ids, pk)
+    if i == len(self.ids) or self.ids[i] != pk:
+      return None
+    return int(i)
+
+  # Returns the transpose of the link matrix. Information flows along links
+  # from dst to src, so this is the operator that propagation runs over.
+  def links_t(self):
+    self.sync()
+    with self._lock:
+      if self._links_op is None:
+        n = len(self.ids)
+        links = sparse.csr_matrix((self.coefs, self.indices, self.indptr),
+                                  shape=(n, n))
+        self._links_op = links.T
+      return self._links_op
+
+  # Returns the link matrix itself.
+  def links(self):
+    return self.links_t().T
+
+  # Returns the prop_coef of the link from index 'src' to index 'dst', or 0 if
+  # there is no such link.
+  def coef(self, src, dst):
+    self.sync()
+    with self._lock:
+      lo, hi = self.indptr[src], self.indptr[src + 1]
+      k = lo + np.searchsorted(self.indices[lo:hi], dst)
+      return int(self.coefs[k]) if k < hi and self.indices[k] == dst else 0
+
+  # Returns the trust that the identity at index i places in others over paths
+  # of exactly 0, 1, ..., 'hops' links, as a list of sparse vectors. Each is a
+  # pair of arrays of indices and trust values. This only touches the links
+  # within reach, so it's cheap for small neighbourhoods.
+  def trust_from(self, i, hops):
+    self.sync()
+    with self._lock:
+      return _walk(self.indptr, self.indices, self.coefs, i, hops)
+
+  # Returns the trust that others place in the identity at index i over paths
+  # of exactly 0, 1, ..., 'hops' links, in the same form as trust_from(). This
+  # walks the links backwards, indexed by destination.
+  def trust_in(self, i, hops):
+    links_t = self.links_t()
+    with self._lock:
+      if self._in_links is None:
+        self._in_links = links_t.tocsr()
+      return _walk(self._in_links.indptr, self._in_links.indices,
+                   self._in_links.data, i, hops)
+
+  # Moves random walkers at the indices 'nodes' one link each, picking among
+  # the links out of each node with probability proportional to prop_coef.
+  # Returns the indices moved to, and the total weight (prop_coef / 4) of the
+  # links out of each node. Walkers with nowhere to go stay put, with a weight
+  # of 0. 'rng' is a numpy RandomState.
+  def sample_links(self, nodes, rng):
+    self.sync()
+    with self._lock:
+      if self._cumcoefs is None:
+        self._cumcoefs = np.concatenate(([0], np.cumsum(self.coefs,
+                                                        dtype=np.int64)))
+      (cum, indptr, indices) = (self._cumcoefs, self.indptr, self.indices)
+
+    # Pick a point along each node's run of cumulative coefficients. Links
+    # with a zero coefficient take up none of it.
+    (lo, hi) = (cum[indptr[nodes]], cum[indptr[nodes + 1]])
+    weights = (hi - lo) * 0.25
+    if not len(indices):
+      return (nodes, weights)
+    points = lo + rng.random_sample(len(nodes)) * (hi - lo)
+    k = np.minimum(np.searchsorted(cum, points, side='right') - 1,
+                   len(indices) - 1)
+    return (np.where(hi > lo, indices[k], nodes), weights)
+
+  # Returns a list of 'hops' + 1 vectors. The k'th vector holds, for each
+  # identity, the total trust that one unit of trust arriving there goes on to
+  # place in itself and in the identities up to k further hops away. Cached
+  # until the graph changes.
+  def reach_bounds(self, hops):
+    links = self.links()
+    with self._lock:
+      if hops not in self._bounds:
+        bounds = [np.ones(len(self.ids))]
+        for hop in range(hops):
+          bounds.append(1.0 + links.dot(bounds[-1]) * 0.25)
+        self._bounds[hops] = bounds
+      return self._bounds[hops]
+
+  # Returns a boolean mask of the identities from which trust can reach any of
+  # the identities at 'indices' over a path of between 1 and 'hops' links.
+  def reaching(self, indices, hops):
+    links = self.links()
+    frontier = np.zeros(len(self.ids), dtype=bool)
+    frontier[indices] = True
+    mask = np.zeros(len(self.ids), dtype=bool)
+    for hop in range(hops):
+      frontier = links.dot(frontier.astype(np.float64)) > 0
+      frontier &= ~mask
+      if not frontier.any():
+        break
+      mask |= frontier
+    return mask
+
+  # Returns the (tagger index, target index) of a tagset, or None if the
+  # tagset is unknown.
+  def tagset(self, pk):
+    self.sync()
+    with self._lock:
+      i = np.searchsorted(self.tagset_ids, pk)
+      if i == len(self.tagset_ids) or self.tagset_ids[i] != pk:
+        return None
+      return (int(self.tagset_tagger[i]), int(self.tagset_target[i]))
+
+  # Returns the (tagger indices, name ids, confidences) of the tags describing
+  # the identity at index t.
+  def tags_for(self, t):
+    self.sync()
+    with self._lock:
+      lo, hi = self.tag_ptr[t], self.tag_ptr[t + 1]
+      return (self.tag_tagger[lo:hi], self.tag_name_id[lo:hi],
+              self.tag_conf[lo:hi])
+
+  #
+  # Change notifications, in terms of primary keys. These only queue the
+  # change, so they're cheap.
+  #
+
+  def update_identity(self, pk):
+    with self._lock:
+      self._new_ids.add(pk)
+
+  def update_link(self, src, dst, coef):
+    with self._lock:
+      self._new_ids.update((src, dst))
+      self._links[(src, dst)] = coef
+
+  def delete_link(self, src, dst):
+    self.update_link(src, dst, None)
+
+  def update_tagset(self, pk, tagger, target):
+    with self._lock:
+      self._new_ids.update((tagger, target))
+      self._tagsets[pk] = (tagger, target)
+
+  def delete_tagset(self, pk):
+    with self._lock:
+      self._tagsets[pk] = None
+
+  def update_tag(self, pk, tagset, name, confidence):
+    with self._lock:
+      self._tags[pk] = (tagset, name, confidence)
+
+  def delete_tag(self, pk):
+    with self._lock:
+      self._tags[pk] = None
+
+  #
+  # Brings the graph up to date with the change log, reading up to 'batch'
+  # changes at a time. Changes that were already applied, through signals or
+  # otherwise, are harmlessly applied again.
+  #
+  # Returns False if the graph was changed in bulk in the meantime, in which
+  # case it can't catch up, and has to be loaded afresh.
+  #
+  # If this is the process-wide snapshot, the 'caught_up' signal is sent for
+  # each batch of changes applied.
+  #
+  def catch_up(self, batch=10000):
+    while True:
+      since = self.version
+      entries = changes.since(since, batch)
+      applied = []
+      for e in entries:
+        if e.kind == 'reload':
+          break
+        applied.append(e)
+        if e.kind == 'link' and e.deleted:
+          self.delete_link(e.src, e.dst)
+        elif e.kind == 'link':
+          self.update_link(e.src, e.dst, e.value)
+        elif e.kind == 'tagset' and e.deleted:
+          self.delete_tagset(e.object_id)
+        elif e.kind == 'tagset':
+          self.update_tagset(e.object_id, e.src, e.dst)
+        elif e.kind == 'tag' and e.deleted:
+          self.delete_tag(e.object_id)
+        elif e.kind == 'tag':
+          self.update_tag(e.object_id, e.src, e.name, e.value)
+      if applied:
+        self.version = applied[-1].pk
+        if self is _snapshot:
+          caught_up.send(sender=Graph, graph=self, since=since,
+                         entries=applied,
+                         local=changes.written_here(applied))
+      if len(applied) < len(entries):
+        return False
+      if len(entries) < batch:
+        return True
+
+  #
+  # Folds queued changes into the arrays.
+  #
+  def sync(self):
+
+    # Fast path
+    if not (self._new_ids or self._links or self._tagsets or self._tags):
+      return
+
+    with self._lock:
+      self._sync_ids()
+      self._sync_links()
+      self._sync_tagsets()
+      self._sync_tags()
+      self._links_op = None
+      self._in_links = None
+      self._cumcoefs = None
+      self._bounds = {}
+
+  def _sync_ids(self):
+
+    # Which identities are actually new?
+    pks = np.array(sorted(self._new_ids), dtype=np.int32)
+    self._new_ids = set()
+    pks = pks[~np.isin(pks, self.ids)]
+    if len(pks) == 0:
+      return
+    ids = np.union1d(self.ids, pks).astype(np.int32)
+    remap = np.searchsorted(ids, self.ids)
+    old, n = len(self.ids), len(ids)
+
+    # New identities normally have the highest keys, in which case we can
+    # just append them with empty ranges of links and tags.
+    if (remap == np.arange(old)).all():
+      self.ids = ids
+      self.indptr = np.concatenate((self.indptr,
+                                    np.repeat(self.indptr[-1:], n - old)))
+      self.tag_ptr = np.concatenate((self.tag_ptr,
+                                     np.repeat(self.tag_ptr[-1:], n - old)))
+      return
+
+    # Otherwise, existing indices have to be renumbered.
+    rows = np.repeat(np.arange(old), np.diff(self.indptr))
+    targets = np.repeat(np.arange(old), np.diff(self.tag_ptr))
+    self.ids = ids
+    self._set_links(remap[rows], remap[self.indices], self.coefs)
+    self._set_tagsets(self.tagset_ids, remap[self.tagset_tagger],
+                      remap[self.tagset_target])
+    self._set_tags(self.tag_ids, remap[self.tag_tagger], remap[targets],
+                   self.tag_name_id, self.tag_conf)
+
+  def _sync_links(self):
+
+    if not self._links:
+      return
+    changes, self._links = self._links, {}
+
+    # Identify links by a single sorted key
+    n = len(self.ids)
+    rows = np.repeat(np.arange(n, dtype=np.int64), np.diff(self.indptr))
+    keys = rows * n + self.indices
+    live = [(self._index(s) * n + self._index(d), coef)
+            for (s, d), coef in changes.items() if coef is not None]
+    changed = np.array([self._index(s) * n + self._index(d)
+                        for (s, d) in changes], dtype=np.int64)
+
+    # Drop every changed link, then add back the ones that still exist
+    dropped = ~np.isin(keys, changed)
+    columns = list(zip(*live)) if live else [(), ()]
+    keys = np.concatenate((keys[dropped], np.array(columns[0], dtype=np.int64)))
+    self._set_links(keys // n, keys % n,
+                    np.concatenate((self.coefs[dropped],
+                                    np.array(columns[1], dtype=np.uint8))))
+
+  def _sync_tagsets(self):
+
+    if not self._tagsets:
+      return
+    changes, self._tagsets = self._tagsets, {}
+
+    # Drop every changed tagset, then add back the ones that still exist
+    dropped = ~np.isin(self.tagset_ids, np.array(list(changes), dtype=np.int32))
+    live = [(pk, self._index(c[0]), self._index(c[1]))
+            for pk, c in changes.items() if c is not None]
+    columns = list(zip(*live)) if live else [(), (), ()]
+    self._set_tagsets(np.concatenate((self.tagset_ids[dropped], columns[0])),
+                      np.concatenate((self.tagset_tagger[dropped], columns[1])),
+                      np.concatenate((self.tagset_target[dropped], columns[2])))
+
+  def _sync_tags(self):
+
+    if not self._tags:
+      return
+    changes, self._tags = self._tags, {}
+
+    # Resolve the tagset of each live tag. Tags whose tagset we don't know
+    # about can't be placed, and are dropped.
+    live = []
+    for pk, change in changes.items():
+      if change is None:
+        continue
+      tagset, name, confidence = change
+      i = np.searchsorted(self.tagset_ids, tagset)
+      if i < len(self.tagset_ids) and self.tagset_ids[i] == tagset:
+        live.append((pk, self.tagset_tagger[i], self.tagset_target[i],
+                     name, confidence))
+
+    # Drop every changed tag, then add back the ones that still exist
+    targets = np.repeat(np.arange(len(self.ids)), np.diff(self.tag_ptr))
+    dropped = ~np.isin(self.tag_ids, np.array(list(changes), dtype=np.int32))
+    columns = list(zip(*live)) if live else [()] * 5
+    self._set_tags(np.concatenate((self.tag_ids[dropped], columns[0])),
+                   np.concatenate((self.tag_tagger[dropped], columns[1])),
+                   np.concatenate((targets[dropped], columns[2])),
+                   np.concatenate((self.tag_name_id[dropped],
+                                   self.intern(columns[3]))),
+                   np.concatenate((self.tag_conf[dropped], columns[4])))
+
+  #
+  # Saves the graph to a file, in a form that open() can map into memory.
+  #
+  # The file starts with a magic string, the format version and the length of
+  # a JSON header, all little-endian, followed by the header itself. The
+  # header holds the graph version, the vocabulary of tag names, and the
+  # dtype, length and offset of each array. The arrays follow, each aligned
+  # to 'file_alignment' bytes.
+  #
+  def save(self, path):
+    self.sync()
+    with self._lock:
+      names = self.names.tolist()
+      arrays = [(name, getattr(self, name)) for name in _file_arrays]
+
+    # Lay out the arrays, relative to the end of the header
+    header = {'version': self.version, 'names': names, 'arrays': []}
+    offset = 0
+    for (name, a) in arrays:
+      offset = _align(offset)
+      header['arrays'].append((name, a.dtype.str, len(a), offset))
+      offset += a.nbytes
+    blob = json.dumps(header).encode('utf-8')
+    prefix = file_magic + struct.pack('<II', file_version, len(blob)) + blob
+
+    # Write to a temporary name and rename it into place, so that processes
+    # starting up never map a half written file
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp, 'wb') as f:
+      f.write(prefix)
+      base = _align(len(prefix))
+      for ((name, a), entry) in zip(arrays, header['arrays']):
+        f.write(b'\0' * (base + entry[3] - f.tell()))
+        f.write(np.ascontiguousarray(a).tobytes())
+    os.rename(temp, path)
+
+  #
+  # Maps a graph saved by save() into memory. The arrays are read-only views
+  # of the file, until changes to the graph are folded in, at which point the
+  # arrays that change are copied.
+  #
+  # The graph is as it was when saved, until it catches up (see catch_up()).
+  #
+  @staticmethod
+  def open(path):
+    with open(path, 'rb') as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Check the header
+    start = len(file_magic) + 8
+    if buf[:len(file_magic)] != file_magic:
+      raise ValueError('%s is not a graph snapshot' % path)
+    (version, size) = struct.unpack('<II', buf[len(file_magic):start])
+    if version != file_version:
+      raise ValueError('%s has snapshot format version %d, not %d' %
+                       (path, version, file_version))
+    header = json.loads(buf[start:start + size].decode('utf-8'))
+
+    g = Graph.__new__(Graph)
+    base = _align(start + size)
+    for (name, dtype, length, offset) in header['arrays']:
+      if length:
+        a = np.frombuffer(buf, dtype=np.dtype(str(dtype)), count=length,
+                          offset=base + offset)
+      else:
+        a = np.zeros(0, dtype=np.dtype(str(dtype)))
+      setattr(g, name, a)
+    g.names = np.array(header['names'], dtype=object)
+    g._name_ids = dict((name, i) for (i, name) in enumerate(header['names']))
+    g._init_changes()
+    g.version = header['version']
+    return g
+
+  # Builds a graph from the database. This costs a fixed number of queries
+  # regardless of the size of the graph.
+  @staticmethod
+  def load():
+
+    # Changes made while loading may or may not be picked up, so the graph
+    # is only known to be as of the version beforehand
+    version = changes.current_version()
+
+    # Identities
+    ids = np.fromiter(Identity.objects.order_by('id')
+                                      .values_list('id', flat=True),
+                      dtype=np.int32)
+    index = lambda pks: np.searchsorted(ids, np.asarray(pks, dtype=np.int32))
+
+    # Links
+    rows = list(ConfidantLink.objects.values_list('src', 'dst', 'prop_coef'))
+    src, dst, coef = zip(*rows) if rows else ((), (), ())
+    links = (index(src), index(dst), coef)
+
+    # Tagsets
+    rows = list(TagSet.objects.values_list('id', 'tagger', 'target'))
+    pk, tagger, target = zip(*rows) if rows else ((), (), ())
+    tagsets = (pk, index(tagger), index(target))
+
+    # Tags, joined against their tagsets
+    rows = list(Tag.objects.values_list('id', 'tagset__tagger',
+                                        'tagset__target', 'name',
+                                        'confidence'))
+    pk, tagger, target, name, conf = zip(*rows) if rows else [()] * 5
+    tags = (pk, index(tagger), index(target), name, conf)
+
+    return Graph(ids, links, tagsets, tags, version)
+
+#
+# Snapshot file format (see Graph.save()). Arrays are aligned to
+# 'file_alignment' bytes, which suits any dtype.
+#
+
+file_magic = b'RBGRAPH\0'
+file_version = 3
+file_alignment = 64
+
+# Arrays saved, in order
+_file_arrays = ('ids', 'indptr', 'indices', 'coefs', 'tagset_ids',
+                'tagset_tagger', 'tagset_target', 'tag_ids', 'tag_tagger',
+                'tag_name_id', 'tag_conf', 'tag_ptr')
+
+def _align(offset):
+  return -(-offset // file_alignment) * file_alignment
+
+#
+# Walks CSR links out from index i for 'hops' hops, returning the weight
+# arriving over paths of each length, from 0 to 'hops', as (indices, values).
+#
+def _walk(indptr, indices, coefs, i, hops):
+  walks = [(np.array([i]), np.ones(1))]
+  for hop in range(hops):
+    (nodes, values) = walks[-1]
+
+    # Gather the links out of the frontier, then sum what arrives where
+    counts = indptr[nodes + 1] - indptr[nodes]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                  counts)
+    positions = np.repeat(indptr[nodes], counts) + offsets
+    weights = coefs[positions] * np.repeat(values, counts) * 0.25
+    nodes, which = np.unique(indices[positions], return_inverse=True)
+    values = np.bincount(which, weights=weights, minlength=len(nodes))
+    walks.append((nodes[values > 0], values[values > 0]))
+  return walks
+
+#
+# Process-wide snapshot management.
+#
+
+_snapshot = None
+_snapshot_lock = threading.RLock()
+
+# When the snapshot is next due to catch up with the change log
+_due = 0
+
+#
+# Sent when the process-wide snapshot catches up with the change log, with
+# the snapshot as 'graph', the version it caught up from as 'since', the
+# changes read as 'entries', and the versions of the ones made by this
+# process as 'local'. Those were seen through model signals already. When the
+# snapshot is reloaded instead, 'since' and 'entries' are None.
+#
+# NB: The signal is sent with the snapshot lock held, so that receivers see
+# the changes in order. The lock is reentrant, so receivers may call
+# snapshot() and refresh(), but they hold up every other thread that needs
+# to catch up meanwhile, so should be quick.
+#
+caught_up = Signal(providing_args=['graph', 'since', 'entries', 'local'])
+
+# Returns the process-wide snapshot, loading it if necessary, and catching it
+# up with the change log if it's due to (see refresh()).
+def snapshot():
+  if _snapshot is None or timeit.default_timer() > _due:
+    refresh(force=False)
+  return _snapshot
+
+#
+# Loads the process-wide snapshot if necessary, and otherwise catches it up
+# with the change log, so that it reflects the changes made by other
+# processes, reloading it if the graph was changed in bulk. Unless 'force' is
+# given, catching up only happens every common.catch_up_interval seconds.
+# Returns the snapshot.
+#
+# If the RAINBEARD_GRAPH_SNAPSHOT setting names a snapshot file that exists,
+# the snapshot is loaded by mapping it from there and catching it up, rather
+# than by building it from the database.
+#
+def refresh(force=True):
+  global _snapshot, _due
+  with _snapshot_lock:
+    now = timeit.default_timer()
+    if _snapshot is None:
+      path = getattr(settings, 'RAINBEARD_GRAPH_SNAPSHOT', None)
+      g = None
+      if path and os.path.exists(path):
+        g = Graph.open(path)
+        if not g.catch_up():
+          g = None
+      _snapshot = Graph.load() if g is None else g
+    elif force or now > _due:
+      if not _snapshot.catch_up():
+        _snapshot = Graph.load()
+        caught_up.send(sender=Graph, graph=_snapshot, since=None,
+                       entries=None, local=set())
+    else:
+      return _snapshot
+    _due = now + common.catch_up_interval
+    return _snapshot
+
+# Returns the process-wide snapshot if it has been loaded, None otherwise.
+def loaded():
+  return _snapshot
+
+# Drops the process-wide snapshot. The next call to snapshot() reloads it.
+def reset():
+  global _snapshot
+  _snapshot = None
+
+#
+# Signal handlers to keep the snapshot current. If no snapshot is loaded,
+# there's nothing to do: it will be built from fresh data when it is.
+#
+
+def _identity_saved(sender, instance, created, **kwargs):
+  g = loaded()
+  if g is not None and created:
+    g.update_identity(instance.id)
+
+def _link_saved(sender, instance, **kwargs):
+  g = loaded()
+  if g is not None:
+    g.update_link(instance.src_id, instance.dst_id, instance.prop_coef)
+
+def _link_deleted(sender, instance, **kwargs):
+  g = loaded()
+  if g is not None:
+    g.delete_link(instance.src_id, instance.dst_id)
+
+def _tagset_saved(sender, instance, **kwargs):
+  g = loaded()
+  if g is not None:
+    g.update_tagset(instance.id, instance.tagger_id, instance.target_id)
+
+def _tagset_deleted(sender, instance, **kwargs):
+  g = loaded()
+  if g is not None:
+    g.delete_tagset(instance.id)
+
+def _tag_saved(sender, instance, **kwargs):
+  g = loaded()
+  if g is not None:
+    g.update_tag(instance.id, instance.tagset_id, instance.name,
+                 instance.confidence)
+
+def _tag_deleted(sender, instance, **kwargs):
+  g = loaded()
+  if g is not None:
+    g.delete_tag(instance.id)
+
+post_save.connect(_identity_saved, sender=Identity,
+                  dispatch_uid='rainbeard.graph.identity')
+post_save.connect(_link_saved, sender=ConfidantLink,
+                  dispatch_uid='rainbeard.graph.link')
+post_delete.connect(_link_deleted, sender=ConfidantLink,
+                    dispatch_uid='rainbeard.graph.link')
+post_save.connect(_tagset_saved, sender=TagSet,
+                  dispatch_uid='rainbeard.graph.tagset')
+post_delete.connect(_tagset_deleted, sender=TagSet,
+                    dispatch_uid='rainbeard.graph.tagset')
+post_save.connect(_tag_saved, sender=Tag,
+                  dispatch_uid='rainbeard.graph.tag')
+post_delete.connect(_tag_deleted, sender=Tag,
+                    dispatch_uid='rainbeard.graph.tag')
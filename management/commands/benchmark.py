@@ -0,0 +1,45 @@
+import sys
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rainbeard import benchmark
+
+#
+# Runs the benchmark harness against a scratch copy of the database, writing
+# JSON records to stdout or a file.
+#
+class Command(BaseCommand):
+
+  help = 'Benchmarks rainbeard on synthetic trust graphs.'
+
+  option_list = BaseCommand.option_list + (
+    make_option('--sizes', default=','.join(map(str, benchmark.default_sizes)),
+                help='Comma-separated graph sizes, in identities.'),
+    make_option('--queries', type='int', default=100,
+                help='Number of random queries per graph.'),
+    make_option('--accounts', type='int', default=20,
+                help='Number of accounts registered per graph.'),
+    make_option('--label', default='',
+                help='Label for the records, such as a version.'),
+    make_option('--seed', type='int', default=0,
+                help='Random seed for the generated graphs.'),
+    make_option('--output', default=None,
+                help='File to append records to, instead of stdout.'))
+
+  def handle(self, *args, **options):
+
+    # Never touch real data. This is how the test runner does it, too.
+    settings.DEBUG = False
+    old_name = settings.DATABASES['default']['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    out = open(options['output'], 'a') if options['output'] else sys.stdout
+    try:
+      benchmark.run(out, sizes=[int(n) for n in options['sizes'].split(',')],
+                    queries=options['queries'], accounts=options['accounts'],
+                    label=options['label'], seed=options['seed'])
+    finally:
+      if out is not sys.stdout:
+        out.close()
+      connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,30 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rainbeard import precompute
+
+#
+# Precomputes query results for every active identity into the result store.
+#
+class Command(BaseCommand):
+
+  help = 'Precomputes rainbeard query results for every active identity.'
+
+  option_list = BaseCommand.option_list + (
+    make_option('--path', default=None,
+                help='Store directory, instead of RAINBEARD_RESULT_STORE.'),
+    make_option('--processes', type='int', default=None,
+                help='Number of worker processes (default: one per CPU).'),
+    make_option('--chunk-size', type='int', default=256,
+                help='Number of sources per chunk.'),
+    make_option('--restart', action='store_true', default=False,
+                help='Start over instead of resuming an earlier run.'))
+
+  def handle(self, *args, **options):
+    path = options['path'] or getattr(settings, 'RAINBEARD_RESULT_STORE', None)
+    if not path:
+      raise CommandError('No store given, and RAINBEARD_RESULT_STORE is unset.')
+    count = precompute.precompute(path, processes=options['processes'],
+                                  chunk_size=options['chunk_size'],
+                                  restart=options['restart'])
+    self.stdout.write('Computed %d chunks.\n' % count)
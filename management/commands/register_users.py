@@ -0,0 +1,59 @@
+import csv, json, sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from rainbeard import account
+
+#
+# Registers users in bulk from a CSV or JSONL file, as for onboarding a
+# partner's list. CSV files need a header row naming the username, password
+# and email columns, and JSONL files hold one object per line with those
+# keys. Accounts start out inactive, pending a claim on their email address.
+#
+class Command(BaseCommand):
+
+  args = '<file>'
+  help = 'Registers users in bulk from a CSV or JSONL file ("-" for stdin).'
+
+  option_list = BaseCommand.option_list + (
+    make_option('--format', default=None, choices=['csv', 'jsonl'],
+                help='File format (default: from the file extension).'),
+    make_option('--batch-size', type='int', default=1000,
+                help='Number of accounts registered per transaction.'))
+
+  def handle(self, *args, **options):
+
+    if len(args) != 1:
+      raise CommandError('Expected a single file.')
+    path = args[0]
+    format = options['format'] or ('csv' if path.endswith('.csv') else 'jsonl')
+    f = sys.stdin if path == '-' else open(path, 'rb')
+    try:
+      (claims, failures) = account.register_users(
+        read_rows(f, format), batch_size=options['batch_size'])
+    finally:
+      if f is not sys.stdin:
+        f.close()
+
+    for (i, error) in failures:
+      self.stderr.write('Row %d: %s\n' % (i + 1, error))
+    self.stdout.write('Registered %d accounts, %d failed.\n' %
+                      (len(claims), len(failures)))
+
+#
+# Reads (username, password, email) rows from a file, a line at a time. Rows
+# that can't be parsed come out as None, to be reported by the caller.
+#
+def read_rows(f, format):
+  fields = ('username', 'password', 'email')
+  if format == 'csv':
+    for row in csv.DictReader(f):
+      yield tuple(row.get(field) for field in fields)
+  else:
+    for line in f:
+      if not line.strip():
+        continue
+      try:
+        row = json.loads(line)
+        yield tuple(row.get(field) for field in fields)
+      except (ValueError, AttributeError):
+        yield None
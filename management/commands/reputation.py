@@ -0,0 +1,19 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from rainbeard import reputation
+
+#
+# Recomputes the reputation of every identity.
+#
+class Command(BaseCommand):
+
+  help = 'Recomputes the rainbeard reputation of every identity.'
+
+  option_list = BaseCommand.option_list + (
+    make_option('--block', type='int', default=None,
+                help='Number of sources to propagate from at once (default: '
+                     'as many as fit in memory).'),)
+
+  def handle(self, *args, **options):
+    count = reputation.compute(block=options['block'])
+    self.stdout.write('Computed the reputation of %d identities.\n' % count)
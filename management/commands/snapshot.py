@@ -0,0 +1,26 @@
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from rainbeard import graph
+
+#
+# Saves a snapshot of the trust graph to a file, for processes to map.
+#
+class Command(BaseCommand):
+
+  help = 'Saves a snapshot of the rainbeard trust graph to a file.'
+
+  option_list = BaseCommand.option_list + (
+    make_option('--path', default=None,
+                help='Snapshot file, instead of RAINBEARD_GRAPH_SNAPSHOT.'),)
+
+  def handle(self, *args, **options):
+    path = options['path'] or getattr(settings, 'RAINBEARD_GRAPH_SNAPSHOT',
+                                      None)
+    if not path:
+      raise CommandError('No file given, and RAINBEARD_GRAPH_SNAPSHOT is '
+                         'unset.')
+    g = graph.Graph.load()
+    g.save(path)
+    self.stdout.write('Saved %d identities, %d links and %d tags.\n' %
+                      (len(g), len(g.indices), len(g.tag_ids)))
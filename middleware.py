@@ -0,0 +1,23 @@
+#
+# Request processing middleware.
+#
+
+from django.utils.functional import SimpleLazyObject
+import account
+
+#
+# Makes the active identity of the logged in user available as
+# request.identity, or None for anonymous users. It's looked up when first
+# used, and at most once per request.
+#
+# This needs to come after django's AuthenticationMiddleware.
+#
+class ActiveIdentityMiddleware(object):
+
+  def process_request(self, request):
+    user = request.user
+    if user.is_authenticated():
+      request.identity = SimpleLazyObject(
+        lambda: account.active_identity(user))
+    else:
+      request.identity = None
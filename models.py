@@ -1,5 +1,5 @@
 import random, string
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from validators import *
 import common
@@ -121,6 +121,26 @@ class PendingClaim(AbstractAgent):
   class Meta:
     unique_together = (('handle', 'service', 'owner'))
 
+#
+#
+# Base for the models that make up the trust graph, whose changes are logged
+# as GraphChanges (see changes.py). Saves happen in a transaction of their
+# own, unless one is already being managed, so that the log entry written
+# after the save commits along with it. Deletes always happen in one.
+#
+#
+class GraphModel(models.Model):
+
+  def save(self, *args, **kwargs):
+    if transaction.is_managed():
+      return super(GraphModel, self).save(*args, **kwargs)
+    with transaction.commit_on_success():
+      return super(GraphModel, self).save(*args, **kwargs)
+
+  # Options
+  class Meta:
+    abstract = True
+
 #
 #
 # Confidant relationships.
@@ -135,7 +155,7 @@ class PendingClaim(AbstractAgent):
 # TODO: add validation for the above invariant
 #
 #
-class ConfidantLink(models.Model):
+class ConfidantLink(GraphModel):
 
   # The source and destination of a confidant link are both Identity objects.
   src = models.ForeignKey(Identity, related_name='confidant_out_links')
@@ -150,7 +170,7 @@ class ConfidantLink(models.Model):
 # Set of tags placed on an identity.
 #
 #
-class TagSet(models.Model):
+class TagSet(GraphModel):
 
   # The tagger and target are both Identity objects.
   tagger = models.ForeignKey(Identity, related_name='tagsets_by')
@@ -161,7 +181,7 @@ class TagSet(models.Model):
 # Tag given in a relation.
 #
 #
-class Tag(models.Model):
+class Tag(GraphModel):
 
   # Name of the tag
   name = models.SlugField(max_length=40)
@@ -171,3 +191,57 @@ class Tag(models.Model):
 
   # TagSet this tag corresponds to
   tagset = models.ForeignKey(TagSet)
+
+#
+#
+# Reputation of an identity from everyone's perspective: the trust placed in
+# it by all active identities together, as computed periodically by
+# reputation.py. Identities that nobody places any trust in have no row.
+#
+#
+class Reputation(models.Model):
+
+  # Identity this is the reputation of
+  identity = models.OneToOneField(Identity, related_name='reputation')
+
+  # Total trust placed in the identity by all active identities
+  trust = models.FloatField(db_index=True)
+
+  # Number of active identities that place any trust in it
+  reach = models.PositiveIntegerField()
+
+  # When this was computed
+  computed = models.DateTimeField()
+
+#
+#
+# Entry in the log of changes to the trust graph. The primary key is the
+# version of the graph that the change brings it to.
+#
+# What the other fields hold depends on the kind of change:
+#
+#   kind      object_id   src       dst       name   value
+#   'link'    link id     src id    dst id           prop_coef
+#   'tagset'  tagset id   tagger id target id
+#   'tag'     tag id      tagset id           name   confidence
+#   'reload'
+#
+# A 'reload' entry means that the graph was changed in bulk, without logging
+# the individual changes, so anything that follows the log has to start over.
+#
+#
+class GraphChange(models.Model):
+
+  kind = models.CharField(max_length=10)
+
+  # Whether the object was deleted, rather than saved
+  deleted = models.BooleanField(default=False)
+
+  object_id = models.IntegerField(null=True)
+  src = models.IntegerField(null=True)
+  dst = models.IntegerField(null=True)
+  name = models.CharField(max_length=40, blank=True)
+  value = models.IntegerField(null=True)
+
+# Writes the log as the graph changes
+import changes
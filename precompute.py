@@ -0,0 +1,109 @@
+#
+# Offline precomputation of query results for every active identity.
+#
+# Each source's trust vector is computed independently of every other, so the
+# sources are split into chunks and farmed out to a pool of worker processes.
+# The snapshot is loaded before the pool is started, so the workers share it
+# with the parent (copy-on-write, through fork) rather than each loading their
+# own. Workers write their chunks straight to the store, and chunks that are
+# already there are skipped, so an interrupted run can simply be restarted,
+# as long as the graph hasn't changed in the meantime.
+#
+
+import multiprocessing, os
+import numpy as np
+from models import *
+import common
+import graph
+import query
+import store
+
+# Arguments for the chunks being computed, as (snapshot, store, taggers,
+# hops, block size). This is set before the pool is started, so that the
+# workers inherit it rather than having it pickled to them.
+_job = None
+
+# Computes and writes chunk 'i', returning i
+def _compute_chunk(i):
+  (g, results, taggers, hops, block) = _job
+  sources = [g.index(pk) for pk in
+             results.sources[i * results.chunk_size:
+                             (i + 1) * results.chunk_size]]
+
+  # Propagate from a block of sources at a time. Sources the snapshot doesn't
+  # know about place no trust in anyone.
+  known = [s for s in sources if s is not None]
+  found = {}
+  for start in range(0, len(known), block):
+    trust = query.propagate_block(g, known[start:start + block], hops)
+    for (column, s) in enumerate(known[start:start + block]):
+      keep = np.flatnonzero((trust[:, column] > 0) & taggers)
+      found[s] = (g.ids[keep], trust[keep, column])
+
+  empty = (np.zeros(0, np.int32), np.zeros(0))
+  store.write_chunk(results.chunk_path(i),
+                    [found.get(s, empty) for s in sources])
+  return i
+
+#
+# Precomputes the results for every active identity into the store at 'path',
+# with 'processes' workers (by default, one per CPU). Returns the number of
+# chunks computed.
+#
+# If the store already exists, this resumes computing it, unless 'restart'
+# is given, in which case it starts over with the current set of identities.
+# It also starts over if the graph has changed since the store was begun, as
+# the chunks already computed would be out of date.
+#
+def precompute(path, processes=None, chunk_size=256, restart=False):
+  global _job
+
+  # The store records the version of the graph it's computed from, so bring
+  # the snapshot up to date with the change log first
+  g = graph.refresh()
+  g.sync()
+
+  manifest = os.path.join(path, 'manifest.json')
+  if os.path.exists(manifest) and not restart:
+    restart = store.ResultStore(path).version != g.version
+  if restart and os.path.isdir(path):
+    for name in os.listdir(path):
+      if name == 'manifest.json' or name.startswith('chunk-'):
+        os.remove(os.path.join(path, name))
+  if not os.path.exists(manifest):
+    sources = Identity.objects.filter(is_active=True) \
+                              .order_by('id').values_list('id', flat=True)
+    taggers = np.unique(g.ids[g.tag_tagger]).tolist()
+    store.ResultStore.create(path, sources, taggers, chunk_size,
+                             common.query_hops, g.version)
+  results = store.ResultStore(path)
+  pending = [i for i in range(results.chunk_count())
+             if not os.path.exists(results.chunk_path(i))]
+  if not pending:
+    return 0
+
+  # Only the trust placed in the taggers listed in the manifest is stored.
+  # The workers share the memory for blocks between them.
+  workers = processes or multiprocessing.cpu_count()
+  _job = (g, results, results.covers(g.ids), results.hops,
+          query.block_size(g, common.block_bytes // workers))
+
+  try:
+    if processes == 1:
+      for i in pending:
+        _compute_chunk(i)
+    else:
+      pool = multiprocessing.Pool(processes)
+      try:
+        for i in pool.imap_unordered(_compute_chunk, pending):
+          pass
+        pool.close()
+      finally:
+        pool.terminate()
+        pool.join()
+  finally:
+    _job = None
+
+  # Results in memory are out of date now
+  store.reset()
+  return len(pending)
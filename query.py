@@ -2,11 +2,707 @@
 # Code for performing rainbeard queries.
 #
 
+import heapq, timeit
+import numpy as np
+from models import *
+import agents
+import changes
+import coalesce
+import common
+import graph
+import cache
+import stats
+import store
+
+#
+# Propagates trust outward from the identity at index 'source'.
+#
+# Each hop carries trust from an identity to its confidants, scaled by the
+# prop_coef of the link between them. The trust placed in an identity is the
+# sum over every path of at most 'hops' links from the source, of the product
+# of the coefficients along that path. The source places no trust in itself;
+# its own tags are givens, not query results.
+#
+# Returns a vector of trust values indexed like the graph.
+#
+def propagate(g, source, hops):
+  return propagate_until(g, source, hops, None)[0]
+
+#
+# Propagates trust as propagate() does, from the identity with primary key
+# 'pk' at index 'source', sharing the work with identical propagations already
+# in flight, in this process and in any others coalescing with it (see
+# coalesce.py). The vector returned may be shared, so it mustn't be modified.
+#
+def propagate_shared(g, pk, source, hops):
+  return coalesce.flights.do(('propagate', pk, hops),
+                             lambda: _propagate_across(g, pk, source, hops))
+
+def _propagate_across(g, pk, source, hops):
+  if coalesce.directory() is None:
+    return propagate(g, source, hops)
+
+  # Pass on the trust placed in each identity by primary key, since other
+  # processes' snapshots may index identities differently
+  def compute():
+    trust = propagate(g, source, hops)
+    keep = np.flatnonzero(trust)
+    return {'ids': g.ids[keep], 'trust': trust[keep]}
+  result = coalesce.across_processes('propagate-%d-%d' % (pk, hops),
+                                     g.version, compute)
+  (ids, trust) = (result['ids'], result['trust'])
+  total = np.zeros(len(g))
+  indices = np.minimum(np.searchsorted(g.ids, ids), len(g) - 1)
+  known = g.ids[indices] == ids
+  total[indices[known]] = trust[known]
+  return total
+
+#
+# Propagates trust as propagate() does, but hop by hop, stopping early if the
+# timer passes 'until' (if given). At least one hop is always propagated.
+#
+# Returns the vector of trust values over the paths covered, the number of
+# hops covered, and whether that was everything.
+#
+def propagate_until(g, source, hops, until):
+
+  (total, edges, reached, complete) = (np.zeros(len(g)), 0, 0, True)
+  for (reached, total, edges) in propagate_hops(g, source, hops):
+    if reached < hops and until is not None and timeit.default_timer() > until:
+      complete = False
+      break
+
+  stats.note(nodes=int(np.count_nonzero(total)), edges=edges, hops=reached,
+             deadline_misses=int(not complete))
+  total[source] = 0.0
+  return (total, hops if complete else reached, complete)
+
+#
+# Propagates trust as propagate() does, one hop at a time. After each hop,
+# yields the number of hops covered so far, the vector of trust values over
+# the paths covered, and the number of links followed. Stops early once no
+# more trust arrives.
+#
+# The same vector is updated by every hop, and includes any trust the source
+# comes back around to place in itself.
+#
+def propagate_hops(g, source, hops):
+
+  # The frontier holds the trust arriving over paths of exactly the current
+  # length, and the total accumulates it.
+  links_t = g.links_t()
+  degrees = np.diff(g.indptr)
+  frontier = np.zeros(len(g))
+  frontier[source] = 1.0
+  total = np.zeros(len(g))
+  edges = 0
+  for hop in range(hops):
+    edges += int(degrees[frontier > 0].sum())
+    frontier = links_t.dot(frontier) * 0.25
+    if not frontier.any():
+      return
+    total += frontier
+    yield (hop + 1, total, edges)
+
+#
+# Propagates trust outward from each of the identities at indices 'sources',
+# as propagate() does for one. The sources' trust vectors are stacked as the
+# columns of a matrix, so that each hop is a single product of the link
+# matrix with a dense block, rather than a pass per source.
+#
+# Returns the matrix of trust values, with a row per identity and a column
+# per source.
+#
+def propagate_block(g, sources, hops):
+  dtype = exact_dtype(g, hops)
+  if dtype is not None:
+    return propagate_exact(g, sources, hops, dtype) / float(4 ** hops)
+
+  links_t = g.links_t()
+  columns = np.arange(len(sources))
+  frontier = np.zeros((len(g), len(sources)))
+  frontier[sources, columns] = 1.0
+  total = np.zeros((len(g), len(sources)))
+  for hop in range(hops):
+    frontier = links_t.dot(frontier) * 0.25
+    total += frontier
+  total[sources, columns] = 0.0
+  return total
+
+#
+# Propagates trust from each of the identities at indices 'sources' as
+# propagate_block() does, but in integer arithmetic, with integers of type
+# 'dtype' (see exact_dtype()).
+#
+# Coefficients are whole quarters, so the trust arriving over paths of k links
+# is a whole number of 4^-k units, and scaled by 4^hops, all the trust is a
+# whole number. Integer sums are exact, so the results are the same however
+# the work is split up and whatever order it's summed in, and with 32 bit
+# integers, each hop moves half the memory that it does in floating point.
+#
+# Returns the matrix of trust values scaled by 4^hops.
+#
+def propagate_exact(g, sources, hops, dtype):
+  links_t = g.links_t()
+  columns = np.arange(len(sources))
+  frontier = np.zeros((len(g), len(sources)), dtype)
+  frontier[sources, columns] = 1
+  total = np.zeros_like(frontier)
+  for hop in range(hops):
+    frontier = links_t.dot(frontier).astype(dtype, copy=False)
+    total += frontier * dtype(4 ** (hops - hop - 1))
+  total[sources, columns] = 0
+  return total
+
+#
+# Returns the smallest integer type that propagate_exact() can use on graph
+# 'g' over 'hops' hops without overflowing, or None if even 64 bits might not
+# be enough.
+#
+# Over each hop, the trust arriving at an identity is at most the most that
+# arrived anywhere the hop before, times the largest sum of the coefficients
+# on the links into any one identity.
+#
+def exact_dtype(g, hops):
+  g.sync()
+  into = int(np.bincount(g.indices, weights=g.coefs, minlength=1).max())
+  bound = sum(into ** k * 4 ** (hops - k) for k in range(1, hops + 1))
+  for dtype in (np.int32, np.int64):
+    if bound <= np.iinfo(dtype).max:
+      return dtype
+  return None
+
+# Returns how many sources propagate_block() can take at once on graph 'g'
+# without its blocks going over 'max_bytes' (by default, common.block_bytes).
+# It holds three blocks at a time.
+def block_size(g, max_bytes=None):
+  if max_bytes is None:
+    max_bytes = common.block_bytes
+  return max(1, max_bytes // (3 * 8 * max(1, len(g))))
+
+#
+# Builds the tag cloud for the identity at index 'target', given a vector of
+# trust values from propagate().
+#
+# The strength of a tag is the trust-weighted average of the confidences it
+# was given with, scaled from 1-9 down to 0.1-0.9. Tags given only by
+# identities we place no trust in are left out.
+#
+def tag_cloud(g, trust, target):
+  taggers, name_ids, confs = g.tags_for(target)
+  return aggregate(g, name_ids, confs, trust[taggers])
+
+#
+# Builds a tag cloud from tags given as parallel arrays of name ids (see
+# graph.py), confidences and the trust placed in whoever gave them.
+#
+def aggregate(g, name_ids, confs, weights):
+
+  # Aggregate by name id. Only the names come out as strings.
+  labels, which = np.unique(name_ids, return_inverse=True)
+  weight = np.bincount(which, weights=weights, minlength=len(labels))
+  evidence = np.bincount(which, weights=weights * confs, minlength=len(labels))
+
+  trusted = weight > 0
+  strengths = evidence[trusted] / (10.0 * weight[trusted])
+  return dict(zip(g.names[labels[trusted]].tolist(), strengths.tolist()))
+
+#
+# Tag cloud with information about how it was computed, as attributes.
+#
+class TagCloud(dict):
+  pass
+
+#
+# Builds the tag cloud for the identity at index 'target' by expanding trust
+# from 'source' best-first, rather than hop by hop over the whole graph.
+#
+# Trust that has arrived at an identity but hasn't yet been passed on is held
+# as a residual, per identity and path length. At each step, the largest
+# residual is settled: it is added to the identity's trust and passed on to its
+# confidants. Summed over all paths, this gives the same trust as propagate().
+#
+# The identity's reach bound caps how much trust a residual can go on to
+# place anywhere, so the sum of residuals weighted by reach bounds caps how
+# much more trust any tagger of the target can receive. Expansion stops once
+# that can't move the strength of any tag in the cloud by more than 'epsilon'.
+# Tags not yet in the cloud can still appear, with at most that much trust
+# behind them.
+#
+# If the timer passes 'until' (if given) first, expansion stops there.
+#
+# The cloud carries the number of identities visited, the bound achieved on
+# its error as 'error', and whether that is within epsilon as 'complete'.
+#
+def best_first(g, source, target, hops, epsilon, until=None):
+
+  # The cloud can only hold the target's tags, so work in terms of those
+  taggers, name_ids, confs = g.tags_for(target)
+  labels, which = np.unique(name_ids, return_inverse=True)
+  tags = {}
+  for (tagger, label, conf) in zip(taggers.tolist(), which.tolist(),
+                                   confs.tolist()):
+    tags.setdefault(tagger, []).append((label, conf))
+  weight = np.zeros(len(labels))
+  evidence = np.zeros(len(labels))
+
+  # Bound on the strength error for the given amount of outstanding trust.
+  # Confidences lie within 0.8 of each other, so outstanding trust t can
+  # move an average with weight w by at most 0.8 * t / (w + t).
+  def error(outstanding):
+    present = weight > 0
+    if not present.any():
+      return 1.0 if outstanding > 0 and len(labels) else 0.0
+    return float((0.8 * outstanding / (weight[present] + outstanding)).max())
+
+  bounds = g.reach_bounds(hops)
+  (indptr, indices, coefs) = (g.indptr, g.indices, g.coefs)
+  residuals = {(source, 0): 1.0}
+  heap = [(-1.0, source, 0)]
+  outstanding = bounds[hops][source]
+  visited = set()
+  (steps, edges, reached) = (0, 0, 0)
+  while heap and outstanding > 0:
+
+    # Check the bound, and the time, every so often
+    steps += 1
+    if steps % 32 == 1 and (error(outstanding) <= epsilon or
+                            (until is not None and
+                             timeit.default_timer() > until)):
+      break
+
+    # Settle the largest residual. Stale heap entries are skipped.
+    (priority, node, depth) = heapq.heappop(heap)
+    r = residuals.pop((node, depth), None)
+    if r is None:
+      continue
+    visited.add(node)
+    reached = max(reached, depth)
+
+    # The residual's reach bound is spent: r on the node itself, the rest
+    # on the residuals it passes on.
+    outstanding -= r
+    if depth > 0 and node != source and node in tags:
+      for (label, conf) in tags[node]:
+        weight[label] += r
+        evidence[label] += r * conf
+
+    # Pass it on
+    if depth < hops:
+      lo, hi = indptr[node], indptr[node + 1]
+      edges += hi - lo
+      for (dst, coef) in zip(indices[lo:hi].tolist(), coefs[lo:hi].tolist()):
+        if coef:
+          key = (dst, depth + 1)
+          residuals[key] = residuals.get(key, 0.0) + r * coef * 0.25
+          heapq.heappush(heap, (-residuals[key], dst, depth + 1))
+
+  # Rounding can leave a little outstanding trust after a full expansion
+  if not heap:
+    outstanding = 0.0
+  stats.note(nodes=len(visited), edges=int(edges), hops=reached)
+  trusted = weight > 0
+  cloud = TagCloud(zip(g.names[labels[trusted]].tolist(),
+                       (evidence[trusted] / (10.0 * weight[trusted])).tolist()))
+  cloud.visited = len(visited)
+  cloud.error = error(outstanding)
+  cloud.complete = cloud.error <= epsilon
+  return cloud
+
+#
+# Estimates the tag cloud for the identity at index 'target' by sampling
+# random walks of 'hops' links out from 'source', using the numpy RandomState
+# 'rng'.
+#
+# A walker picks among the links out of where it is with probability
+# proportional to prop_coef, and its weight is multiplied by the total weight
+# of those links. The weight a walker arrives somewhere with is then, on
+# average, the trust that propagate() would place there, so each tag's
+# strength is estimated by the ratio of the weighted sums of confidence and
+# of trust over the taggers walked through. The cost depends on the number
+# of walks and hops, not on the size of the graph.
+#
+# Walks are taken in batches of common.sample_batch, until 'walks' have been
+# taken, every tag's 95% confidence interval is within 'epsilon' of its
+# estimate, or the timer passes 'until' (if given), whichever comes first.
+# Tags that no walk has reached are left out.
+#
+# The cloud carries the number of walks taken as 'walks', the (low, high)
+# confidence interval of each tag's strength as 'intervals', the widest
+# half-width of those as 'error', and whether that is within epsilon as
+# 'complete'.
+#
+def monte_carlo(g, source, target, hops, walks, epsilon, rng, until=None):
+
+  # Lay the target's tags out as a matrix of taggers by names, holding
+  # confidences. The source's own tags are givens, not results.
+  taggers, name_ids, confs = g.tags_for(target)
+  mine = taggers == source
+  (taggers, name_ids, confs) = (taggers[~mine], name_ids[~mine], confs[~mine])
+  labels, which = np.unique(name_ids, return_inverse=True)
+  people, row = np.unique(taggers, return_inverse=True)
+  given = np.zeros((len(people), len(labels)))
+  given[row, which] = 1.0
+  conf = np.zeros((len(people), len(labels)))
+  conf[row, which] = confs
+
+  # Sums over walks of each walk's confidence and trust totals per name (x
+  # and y), and of their squares and products, for the intervals
+  sums = np.zeros((5, len(labels)))
+  (taken, steps) = (0, 0)
+  while True:
+    batch = min(common.sample_batch, walks - taken)
+    x = np.zeros((batch, len(labels)))
+    y = np.zeros((batch, len(labels)))
+    walker = np.arange(batch)
+    nodes = np.repeat(source, batch)
+    weight = np.ones(batch)
+    for hop in range(hops):
+      (nodes, factor) = g.sample_links(nodes, rng)
+      steps += len(nodes)
+      weight = weight * factor
+      alive = weight > 0
+      (walker, nodes, weight) = (walker[alive], nodes[alive], weight[alive])
+      if not len(walker):
+        break
+      if len(people):
+        i = np.minimum(np.searchsorted(people, nodes), len(people) - 1)
+        hit = people[i] == nodes
+        (w, i) = (weight[hit][:, None], i[hit])
+        x[walker[hit]] += w * conf[i]
+        y[walker[hit]] += w * given[i]
+    sums += (x.sum(0), y.sum(0), (x * x).sum(0), (y * y).sum(0),
+             (x * y).sum(0))
+    taken += batch
+
+    # The delta method gives the variance of each ratio
+    (sx, sy, sxx, syy, sxy) = sums
+    seen = sy > 0
+    ratio = sx[seen] / sy[seen]
+    spread = sxx[seen] - 2 * ratio * sxy[seen] + ratio ** 2 * syy[seen]
+    half = 1.96 * np.sqrt(np.maximum(spread, 0.0)) / sy[seen] / 10.0
+    error = float(half.max()) if len(half) else 0.0
+    if taken >= walks or error <= epsilon or \
+       (until is not None and timeit.default_timer() > until):
+      break
+
+  stats.note(walks=taken, edges=steps, hops=hops)
+  names = g.names[labels[seen]].tolist()
+  strengths = (ratio / 10.0).tolist()
+  cloud = TagCloud(zip(names, strengths))
+  cloud.intervals = dict(
+    (name, (max(0.1, strength - h), min(0.9, strength + h)))
+    for (name, strength, h) in zip(names, strengths, half.tolist()))
+  cloud.walks = taken
+  cloud.error = error
+  cloud.complete = error <= epsilon
+  return cloud
+
 #
 # Generates a tag cloud about 'target' from the perspective of 'source'.
 #
 # The returned tag cloud is a dictionary mapping tag names to strength values.
 #
-def do_query(source, target):
+# If a deadline is given, in seconds, trust is propagated hop by hop until
+# it runs out, and the cloud is estimated from the hops covered. The cloud is
+# then a TagCloud, saying whether it covers every hop as 'complete', and how
+# many hops it does cover as 'hops'.
+#
+def do_query(source, target, hops=None, deadline=None):
+  return do_query_many(source, [target], hops, deadline)[0]
+
+#
+# Generates tag clouds about each of 'targets' from the perspective of
+# 'source', returning them in a list in the same order. Deadlines work as for
+# do_query().
+#
+# Queries with the default hop limit are answered from the cache of tag
+# clouds where possible, and failing that from precomputed results. The rest
+# are answered from the source's trust horizon (see horizon()), which is
+# computed at most once, however many targets there are.
+#
+def do_query_many(source, targets, hops=None, deadline=None):
+  until = None if deadline is None else timeit.default_timer() + deadline
+  with stats.measure('query'):
+    return _do_query_many(source, targets, hops, until)
+
+def _do_query_many(source, targets, hops, until):
+
+  # Check the cache
+  cached = hops is None or hops == common.query_hops
+  hops = common.query_hops if hops is None else hops
+  clouds = [None] * len(targets)
+  if cached:
+    clouds = [cache.clouds.get(source.id, target.id) for target in targets]
+  missing = [i for (i, cloud) in enumerate(clouds) if cloud is None]
+  if cached:
+    stats.note(cache_hits=len(targets) - len(missing),
+               cache_misses=len(missing))
+
+  # Use precomputed results where they're fresh, and propagate at most once
+  # for the rest. Identities the snapshot doesn't know about have no links or
+  # tags.
+  g = graph.snapshot() if missing else None
+  results = store.results()
+  if results is not None and not (missing and results.serves(g, hops)):
+    results = None
+  reach = None
+  covered = hops
+  partial = set()
+  for i in missing:
+    t = g.index(targets[i].id)
+    stored = results and results.trust(source.id)
+    estimate = False
+    if t is None:
+      clouds[i] = {}
+    elif stored is not None:
+      stats.note(store_hits=1)
+      clouds[i] = stored_cloud(g, stored, t)
+    else:
+      if reach is None:
+        (reach, covered, complete) = horizon(g, source.id, hops, until)
+      clouds[i] = stored_cloud(g, reach, t)
+      estimate = not complete
+
+    # Estimates aren't worth keeping
+    if estimate:
+      partial.add(i)
+    elif cached:
+      cache.clouds.put(source.id, targets[i].id, clouds[i])
+
+  if until is not None:
+    clouds = [TagCloud(cloud) for cloud in clouds]
+    for (i, cloud) in enumerate(clouds):
+      cloud.complete = i not in partial
+      cloud.hops = covered if i in partial else hops
+  return clouds
+
+#
+# Returns the trust horizon of the identity with primary key 'pk': the trust
+# it places in each identity within 'hops' hops, as sorted arrays of primary
+# keys and trust values, just like precomputed results. A query is then a
+# sparse dot product of the horizon with the target's tags (see
+# stored_cloud()).
+#
+# Horizons with the default hop limit are cached, and rebuilt on the next
+# query after a link change makes them stale. Otherwise, trust is propagated
+# from scratch, shared with concurrent queries from the same source, unless
+# the timer may pass 'until' (if given), in which case it's propagated as far
+# as it gets.
+#
+# Also returns the number of hops covered, and whether that was everything.
+#
+def horizon(g, pk, hops, until=None):
+
+  cached = hops == common.query_hops
+  if cached:
+    found = cache.horizons.get(pk, hops)
+    stats.note(horizon_hits=int(found is not None))
+    if found is not None:
+      return (found, hops, True)
+
+  # Identities the snapshot doesn't know about place no trust in anyone
+  s = g.index(pk)
+  (covered, complete) = (hops, True)
+  if s is None:
+    trust = np.zeros(len(g))
+  elif until is None:
+    trust = propagate_shared(g, pk, s, hops)
+  else:
+    (trust, covered, complete) = propagate_until(g, s, hops, until)
+
+  keep = np.flatnonzero(trust)
+  found = (g.ids[keep], trust[keep])
+  for array in found:
+    array.setflags(write=False)
+  if cached and complete:
+    cache.horizons.put(pk, hops, found)
+  return (found, covered, complete)
+
+#
+# Generates the tag cloud about 'target' from the perspective of 'source' as
+# do_query() does, but progressively: yields a TagCloud estimated from the
+# paths of up to 1, 2, ... links as each hop of propagation completes, ending
+# with the full cloud. The clouds carry the number of hops they cover as
+# 'hops', and whether they're the full cloud as 'complete'.
+#
+# Cached and precomputed clouds are yielded straight away, as the full cloud.
+# The time taken to yield the first cloud, and the last, are recorded in the
+# 'query_stream.first_ms' and 'query_stream.wall_ms' histograms.
+#
+# The clouds come from the snapshot 'g', if given, and otherwise from the
+# process-wide snapshot as of the first cloud. Getting that can go to the
+# database, so callers that consume the clouds outside of a request should
+# pass it in.
+#
+def stream_query(source, target, hops=None, g=None):
+
+  start = timeit.default_timer()
+  cached = hops is None or hops == common.query_hops
+  hops = common.query_hops if hops is None else hops
+  first = True
+  for (covered, cloud) in _stream_query(source, target, hops, cached, g):
+    elapsed = (timeit.default_timer() - start) * 1000.0
+    if first:
+      stats.histogram('query_stream.first_ms').add(elapsed)
+      first = False
+    if covered == hops:
+      stats.histogram('query_stream.wall_ms').add(elapsed)
+    cloud = TagCloud(cloud)
+    cloud.hops = covered
+    cloud.complete = covered == hops
+    yield cloud
+
+def _stream_query(source, target, hops, cached, g):
+
+  if cached:
+    cloud = cache.clouds.get(source.id, target.id)
+    if cloud is not None:
+      yield (hops, cloud)
+      return
+
+  # Identities the snapshot doesn't know about have no links or tags
+  g = graph.snapshot() if g is None else g
+  (s, t) = (g.index(source.id), g.index(target.id))
+  results = store.results()
+  stored = None
+  if results is not None and results.serves(g, hops):
+    stored = results.trust(source.id)
+  if s is None or t is None:
+    cloud = {}
+  elif stored is not None:
+    cloud = stored_cloud(g, stored, t)
+  else:
+    trust = np.zeros(len(g))
+    for (covered, total, edges) in propagate_hops(g, s, hops):
+      trust = total.copy()
+      trust[s] = 0.0
+      if covered < hops:
+        yield (covered, tag_cloud(g, trust, t))
+    cloud = tag_cloud(g, trust, t)
+
+  if cached:
+    cache.clouds.put(source.id, target.id, cloud)
+  yield (hops, cloud)
+
+#
+# Generates the tag cloud about 't' from stored results, which give the trust
+# placed in identities by primary key (see store.py).
+#
+def stored_cloud(g, stored, t):
+  (ids, trust) = stored
+  if not len(ids):
+    return {}
+  taggers, name_ids, confs = g.tags_for(t)
+  pks = g.ids[taggers]
+  i = np.minimum(np.searchsorted(ids, pks), len(ids) - 1)
+  weights = np.where(ids[i] == pks, trust[i], 0.0)
+  return aggregate(g, name_ids, confs, weights)
+
+#
+# Generates an approximate tag cloud about 'target' from the perspective of
+# 'source', expanding only as much of the graph as it takes to pin the tag
+# strengths down to within 'epsilon', or as much as it can before the
+# deadline, in seconds, if one is given. See best_first().
+#
+def do_query_bounded(source, target, epsilon=None, hops=None, deadline=None):
+  until = None if deadline is None else timeit.default_timer() + deadline
+  with stats.measure('query_bounded'):
+    return _do_query_bounded(source, target, epsilon, hops, until)
+
+def _do_query_bounded(source, target, epsilon, hops, until):
+
+  if epsilon is None:
+    epsilon = common.query_epsilon
+  if hops is None:
+    hops = common.query_hops
+
+  # Identities the snapshot doesn't know about have no links or tags
+  g = graph.snapshot()
+  (s, t) = (g.index(source.id), g.index(target.id))
+  if s is None or t is None:
+    cloud = TagCloud()
+    cloud.visited = 0
+    cloud.error = 0.0
+    cloud.complete = True
+    return cloud
+
+  return best_first(g, s, t, hops, epsilon, until)
 
-  return {'reliable' : 0.5}
+#
+# Estimates the tag cloud about 'target' from the perspective of 'source' by
+# sampling random walks, as many as 'walks', or as many as it takes to pin
+# the tag strengths down to within 'epsilon', or as many as it can before the
+# deadline, in seconds, if one is given. A seed makes the estimate
+# repeatable. See monte_carlo().
+#
+def do_query_sampled(source, target, walks=None, epsilon=None, hops=None,
+                     deadline=None, seed=None):
+  until = None if deadline is None else timeit.default_timer() + deadline
+  with stats.measure('query_sampled'):
+    return _do_query_sampled(source, target, walks, epsilon, hops, until,
+                             seed)
+
+def _do_query_sampled(source, target, walks, epsilon, hops, until, seed):
+
+  if walks is None:
+    walks = common.sample_walks
+  if epsilon is None:
+    epsilon = common.query_epsilon
+  if hops is None:
+    hops = common.query_hops
+
+  # Identities the snapshot doesn't know about have no links or tags
+  g = graph.snapshot()
+  (s, t) = (g.index(source.id), g.index(target.id))
+  if s is None or t is None:
+    cloud = TagCloud()
+    cloud.intervals = {}
+    cloud.walks = 0
+    cloud.error = 0.0
+    cloud.complete = True
+    return cloud
+
+  rng = np.random.RandomState(seed)
+  return monte_carlo(g, s, t, hops, walks, epsilon, rng, until)
+
+#
+# Looks up the tags that the active identity of 'user' has given each of the
+# agents in 'pairs', a list of (handle, service) tuples.
+#
+# Returns a dictionary mapping each pair to a dictionary of tag names and
+# confidences. This takes a single query, however many pairs there are, and
+# none if none of the agents have owners.
+#
+def givens(user, pairs):
+
+  result = dict((pair, {}) for pair in pairs)
+
+  # Tags are attached to the identities that own agents
+  owned = {}
+  for (pair, (pk, owner)) in agents.directory.lookup_many(pairs).items():
+    if owner is not None:
+      owned.setdefault(owner, []).append(pair)
+  if not owned:
+    return result
+
+  rows = Tag.objects.filter(tagset__target__in=list(owned),
+                            tagset__tagger__profile__user=user,
+                            tagset__tagger__is_active=True) \
+                    .values_list('tagset__target', 'name', 'confidence')
+  for (target, name, confidence) in rows:
+    for pair in owned[target]:
+      result[pair][name] = confidence
+  return result
+
+#
+# Drops all process-wide query state: the graph snapshot, cached results, the
+# open result store, the record of changes made by this process and the agent
+# directory.
+#
+def reset():
+  graph.reset()
+  cache.clear()
+  store.reset()
+  changes.reset()
+  agents.directory.clear()
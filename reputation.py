@@ -0,0 +1,53 @@
+#
+# Reputation of every identity from everyone's perspective.
+#
+# This is a periodic job rather than a query: it propagates trust from every
+# active identity, adds up the trust each identity receives, and replaces the
+# contents of the Reputation table with the totals, for ranking and for
+# spotting abuse. Sources are propagated from a block at a time (see
+# query.propagate_block()), with blocks sized to fit common.block_bytes.
+#
+
+import datetime
+import numpy as np
+from django.db import transaction
+from models import *
+import bulk
+import common
+import graph
+import query
+
+#
+# Computes the reputation of every identity and writes it to the Reputation
+# table, returning the number of rows written. 'block' is the number of
+# sources to propagate from at once, by default as many as fit in memory.
+#
+def compute(block=None):
+
+  g = graph.snapshot()
+  pks = Identity.objects.filter(is_active=True).values_list('id', flat=True)
+  sources = [i for i in (g.index(pk) for pk in pks) if i is not None]
+  if block is None:
+    block = query.block_size(g)
+
+  trust = np.zeros(len(g))
+  reach = np.zeros(len(g), dtype=np.int64)
+  for start in range(0, len(sources), block):
+    t = query.propagate_block(g, sources[start:start + block],
+                              common.query_hops)
+    trust += t.sum(axis=1)
+    reach += (t > 0).sum(axis=1)
+
+  computed = datetime.datetime.now()
+  reached = np.flatnonzero(reach)
+  _replace([Reputation(identity_id=int(g.ids[i]), trust=float(trust[i]),
+                       reach=int(reach[i]), computed=computed)
+            for i in reached])
+  return len(reached)
+
+# Replaces the contents of the Reputation table, so that readers see either
+# the old reputations or the new ones
+@transaction.commit_on_success
+def _replace(rows):
+  bulk.delete_all([Reputation])
+  bulk.insert(rows)
@@ -15,3 +15,25 @@ AUTH_PROFILE_MODULE = 'rainbeard.Profile'
 
 # Define the login URL
 LOGIN_URL='/login'
+
+# Set to True to report the measurements taken while handling each ajax
+# request in an X-Rainbeard-Stats response header
+RAINBEARD_STATS_HEADER = False
+
+# Directory holding precomputed query results (see precompute.py), or None
+# to compute every query on demand
+RAINBEARD_RESULT_STORE = None
+
+# Graph snapshot file (see graph.py), written by the snapshot management
+# command, or None to build the snapshot from the database
+RAINBEARD_GRAPH_SNAPSHOT = None
+
+# Directory for lock files, through which processes on the same host share
+# identical concurrent computations (see coalesce.py), or None to only share
+# them within a process
+RAINBEARD_COALESCE_DIR = None
+
+# Set to True to cache users' active identities across requests, in django's
+# cache. Whichever process changes an identity drops it from the cache, so
+# every process needs to share the same cache (e.g. memcached).
+RAINBEARD_CACHE_IDENTITIES = False
@@ -7,11 +7,6 @@ var gSuggestedTags = {trustworthy: {popularity: 9},
                       proactive: {popularity: 5},
                       altruistic: {popularity: 7}};
 
-var gGivenTags = {trustworthy: {strength: 5},
-                  proactive: {strength: 9},
-                  altruistic: {strength: 1},
-                  custom: {strength: 9}};
-
 // Converts from a numerical weight to a font size as a percentage.
 var gFontSizes = {1: '50%',
                   2: '63%',
@@ -122,14 +117,20 @@ var gTags = {
   // Loads the current given tags from the server
   loadGiven: function() {
 
-    // TODO - Load JSON
-    for (var name in gGivenTags)
-      this.given[name] = new Tag(name,
-                                 gGivenTags[name].strength,
-                                 'given');
+    var key = gContext.service + ':' + gContext.handle;
+    $.get('/ajax/givens/get',
+          {handle: gContext.handle, service: gContext.service},
+          function(data) {
 
-    // Sort
-    this.sortGiven();
+      // Add the tags
+      var tags = data.givens[key];
+      for (var name in tags)
+        gTags.given[name] = new Tag(name, tags[name], 'given');
+
+      // Sort and display
+      gTags.sortGiven();
+      gTags.refreshDisplay();
+    }, 'json');
   },
 
   // sorts the suggested tags by popularity
@@ -238,6 +239,59 @@ var gTags = {
   givenDirty: false
 };
 
+/*
+ * What others say: the tag cloud for the person being queried, as seen through
+ * the eyes of the people we trust. The server streams progressively better
+ * estimates as it works its way further out through the graph, and we redraw
+ * the cloud as each one arrives.
+ */
+var gRecon = {
+
+  // Starts streaming the cloud from the server
+  load: function() {
+
+    // Browsers without EventSource get the final cloud in one go
+    if (!window.EventSource) {
+      $.get('/ajax/query/many',
+            {handle: gContext.handle, service: gContext.service},
+            function(data) { gRecon.display(data.results[0]); }, 'json');
+      return;
+    }
+
+    var url = '/ajax/query/stream?' + $.param({handle: gContext.handle,
+                                               service: gContext.service});
+    var source = new EventSource(url);
+    source.onmessage = function(evt) {
+      var data = $.parseJSON(evt.data);
+      gRecon.display(data);
+
+      // Otherwise EventSource would reconnect and start over
+      if (data.complete)
+        source.close();
+    };
+    source.onerror = function() { source.close(); };
+  },
+
+  // Redraws the cloud. Strengths run from 0.1 to 0.9, like confidences.
+  display: function(data) {
+    var box = $('#tab-recon').empty();
+    var names = [];
+    for (var name in data.tags)
+      names.push(name);
+    names.sort();
+    for (var i = 0; i < names.length; ++i) {
+      var weight = Math.round(data.tags[names[i]] * 10);
+      box.append($('<span></span>').addClass('tag')
+                                   .css('font-size', gFontSizes[weight])
+                                   .text(names[i])
+                                   .append(' '));
+    }
+    if (!names.length)
+      box.text(data.complete ? 'Nobody you trust has said anything yet.'
+                             : 'Asking around...');
+  }
+};
+
 /*
  * Singleton mouseover popup menu handling code.
  *
@@ -430,6 +484,7 @@ $('document').ready(function() {
   // Load the initial state
   gTags.loadSuggested();
   gTags.loadGiven();
+  gRecon.load();
 
   // Bootstrap the display
   gTags.refreshDisplay();
@@ -0,0 +1,154 @@
+#
+# Lightweight instrumentation of the query path.
+#
+# Code that does work on behalf of a query runs inside measure(), which
+# collects the wall time and number of database queries, along with whatever
+# the code reports through note(). When it finishes, every measurement is
+# folded into a per-name histogram, from which percentiles can be read. All of
+# this is cheap enough to leave on all the time.
+#
+
+import math, threading, timeit
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection
+from django.db.backends import util
+
+#
+#
+# Histogram with logarithmically spaced buckets, each 'growth' times wider
+# than the last. Percentiles are accurate to within a bucket width.
+#
+#
+class Histogram(object):
+
+  def __init__(self, lo=0.001, hi=1e7, growth=1.1):
+    self.lo = lo
+    self.growth = growth
+    self.buckets = [0] * (int(math.log(hi / lo) / math.log(growth)) + 2)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self._lock = threading.Lock()
+
+  def add(self, value):
+
+    # Bucket 0 holds everything below 'lo'
+    if value < self.lo:
+      i = 0
+    else:
+      i = min(int(math.log(value / self.lo) / math.log(self.growth)) + 1,
+              len(self.buckets) - 1)
+    with self._lock:
+      self.buckets[i] += 1
+      self.count += 1
+      self.total += value
+      self.max = max(self.max, value)
+
+  # Estimates the value below which a fraction q of the values fall, as the
+  # upper edge of the bucket holding it.
+  def percentile(self, q):
+    if self.count == 0:
+      return 0.0
+    rank = q * self.count
+    seen = 0
+    for (i, n) in enumerate(self.buckets):
+      seen += n
+      if seen >= rank and n:
+        return min(self.lo * self.growth ** i, self.max)
+    return self.max
+
+  def summary(self):
+    return {'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5), 'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99), 'max': self.max}
+
+# Histograms, by name
+histograms = {}
+_histograms_lock = threading.Lock()
+
+def histogram(name):
+  h = histograms.get(name)
+  if h is None:
+    with _histograms_lock:
+      h = histograms.setdefault(name, Histogram())
+  return h
+
+# Drops all recorded measurements
+def clear():
+  with _histograms_lock:
+    histograms.clear()
+
+# Summaries of all histograms, by name
+def summary():
+  return dict((name, h.summary()) for (name, h) in histograms.items())
+
+#
+# Measurements in progress, innermost last, per thread.
+#
+
+_local = threading.local()
+
+def _active():
+  if not hasattr(_local, 'stack'):
+    _local.stack = []
+  return _local.stack
+
+# Adds to the counters of every measurement in progress. Outside of measure(),
+# this does nothing.
+def note(**counts):
+  for record in _active():
+    for (key, value) in counts.items():
+      record[key] = record.get(key, 0) + value
+
+# Cursor wrapper that counts queries against the measurements in progress
+class CountingCursorWrapper(util.CursorWrapper):
+
+  def execute(self, *args, **kwargs):
+    note(db_queries=1)
+    return self.cursor.execute(*args, **kwargs)
+
+  def executemany(self, *args, **kwargs):
+    note(db_queries=1)
+    return self.cursor.executemany(*args, **kwargs)
+
+#
+# Measures the enclosed block under the given name, yielding the dictionary
+# of counters being collected. On the way out, the wall time is added as
+# 'wall_ms', and every counter is added to the histogram named
+# '<name>.<counter>'.
+#
+@contextmanager
+def measure(name):
+
+  # Count database queries by wrapping the cursors handed out in the
+  # meantime, on top of any debug wrapping that would happen anyway.
+  stack = _active()
+  if not stack:
+    saved = (connection.use_debug_cursor,
+             connection.__dict__.get('make_debug_cursor'))
+    wrap = connection.make_debug_cursor
+    if not (connection.use_debug_cursor or
+            (connection.use_debug_cursor is None and settings.DEBUG)):
+      wrap = lambda cursor: util.CursorWrapper(cursor, connection)
+    connection.make_debug_cursor = (
+      lambda cursor: CountingCursorWrapper(wrap(cursor), connection))
+    connection.use_debug_cursor = True
+
+  record = {'db_queries': 0}
+  stack.append(record)
+  start = timeit.default_timer()
+  try:
+    yield record
+  finally:
+    record['wall_ms'] = (timeit.default_timer() - start) * 1000.0
+    stack.pop()
+    if not stack:
+      connection.use_debug_cursor = saved[0]
+      if saved[1] is None:
+        del connection.make_debug_cursor
+      else:
+        connection.make_debug_cursor = saved[1]
+    for (key, value) in record.items():
+      histogram(name + '.' + key).add(value)
@@ -0,0 +1,378 @@
+#
+# On-disk store of precomputed query results.
+#
+# For each source identity, the store holds the trust it places in every
+# identity that has tagged anybody, as a sparse vector of identity primary
+# keys and trust values. That's all it takes to build the source's tag cloud
+# about any target, so a stored source can be queried without propagating.
+#
+# The store is a directory holding a manifest and a number of chunk files.
+# The manifest lists the sources in order, along with the taggers whose trust
+# is stored, and chunk i holds the results for sources i * chunk_size up to
+# (i + 1) * chunk_size. Chunks are written independently and atomically, so an
+# interrupted precomputation can pick up where it left off (see
+# precompute.py).
+#
+# The manifest also records the graph version the results were computed at
+# (see changes.py). A store is only used while it's at least as recent as the
+# process's snapshot of the graph. The stored results are kept fresh as the
+# graph changes, by pushing the exact change in trust into the sources
+# affected (see the signal handlers below). Updated results are held in
+# memory, on top of the chunks.
+#
+# That only works for changes made by the process itself. When the snapshot
+# catches up with changes made by other processes that affect the results,
+# the store falls behind it, as it does for good once the process restarts,
+# until the precomputation is run again.
+#
+
+import json, os, threading
+from collections import OrderedDict
+import numpy as np
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, pre_delete, \
+                                     post_delete
+from models import *
+import changes
+import graph
+
+#
+#
+# Access to a result store.
+#
+#
+class ResultStore(object):
+
+  # Number of chunks kept in memory
+  max_chunks = 64
+
+  def __init__(self, path):
+    self.path = path
+    with open(os.path.join(path, 'manifest.json')) as f:
+      manifest = json.load(f)
+    self.chunk_size = manifest['chunk_size']
+    self.hops = manifest['hops']
+    self.version = manifest.get('version', 0)
+    self.sources = np.array(manifest['sources'], dtype=np.int32)
+    self.taggers = np.array(sorted(manifest['taggers']), dtype=np.int32)
+    self._order = np.argsort(self.sources)
+    self._chunks = OrderedDict()
+    self._rows = {}
+    self._applied = set()
+    self._lock = threading.Lock()
+
+    # Any trust over a path of at most 'hops' links is at least this much, so
+    # anything less is rounding error.
+    self.epsilon = 0.5 * 0.25 ** self.hops
+
+  # Writes the manifest for a new store of results propagated over 'hops'
+  # hops at graph version 'version', creating the directory if necessary.
+  @staticmethod
+  def create(path, sources, taggers, chunk_size, hops, version):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    write_atomic(os.path.join(path, 'manifest.json'),
+                 lambda f: json.dump({'chunk_size': chunk_size, 'hops': hops,
+                                      'version': version,
+                                      'sources': list(sources),
+                                      'taggers': list(taggers)}, f))
+
+  # Returns whether the store can answer queries over 'hops' hops, given the
+  # snapshot 'g'. Results that are behind the snapshot are missing changes.
+  def serves(self, g, hops):
+    return self.hops == hops and self.version >= g.version
+
+  # Notes that the change with the given version in the change log has been
+  # applied to the results
+  def applied(self, version):
+    if version is not None:
+      with self._lock:
+        self._applied.add(version)
+
+  #
+  # Advances the version of the results over 'entries', the changes read
+  # from the log after version 'since' by the snapshot 'g', as long as each
+  # was either applied to the results or can't affect them. Otherwise, the
+  # results stay behind the snapshot.
+  #
+  def caught_up(self, g, since, entries):
+    with self._lock:
+      if self.version < since:
+        return
+      self._applied.difference_update(
+        [v for v in self._applied if v <= self.version])
+      for e in entries:
+        if e.pk <= self.version:
+          continue
+        if e.pk not in self._applied and not self._unaffected(g, e):
+          return
+        self._applied.discard(e.pk)
+        self.version = e.pk
+
+  # Returns whether a change can't affect the results. Only links carry
+  # trust, and tags only matter when they're from a tagger that isn't stored.
+  def _unaffected(self, g, e):
+    if e.kind == 'tagset' or (e.kind == 'tag' and e.deleted):
+      return True
+    if e.kind == 'tag':
+      tagset = g.tagset(e.src)
+      return tagset is None or bool(self.covers(g.ids[tagset[0]]))
+    return False
+
+  # Number of chunks the sources are split into
+  def chunk_count(self):
+    return (len(self.sources) + self.chunk_size - 1) // self.chunk_size
+
+  def chunk_path(self, i):
+    return os.path.join(self.path, 'chunk-%06d.npz' % i)
+
+  # Returns the sparse trust vector of a source as sorted arrays of identity
+  # primary keys and trust values, or None if the source isn't stored.
+  def trust(self, source):
+
+    row = self._rows.get(source)
+    if row is not None:
+      return row
+    i = np.searchsorted(self.sources, source, sorter=self._order)
+    if i == len(self.sources) or self.sources[self._order[i]] != source:
+      return None
+    position = int(self._order[i])
+    chunk = self._chunk(position // self.chunk_size)
+    if chunk is None:
+      return None
+
+    j = position % self.chunk_size
+    lo, hi = chunk['indptr'][j], chunk['indptr'][j + 1]
+    return (chunk['ids'][lo:hi], chunk['trust'][lo:hi])
+
+  # Loads a chunk, or returns None if it hasn't been computed
+  def _chunk(self, i):
+    with self._lock:
+      chunk = self._chunks.pop(i, None)
+      if chunk is None:
+        if not os.path.exists(self.chunk_path(i)):
+          return None
+        with open(self.chunk_path(i), 'rb') as f:
+          chunk = dict(np.load(f).items())
+        while len(self._chunks) >= self.max_chunks:
+          self._chunks.popitem(last=False)
+      self._chunks[i] = chunk
+      return chunk
+
+  # Returns a boolean mask of which of the identities 'pks' have their trust
+  # stored.
+  def covers(self, pks):
+    return np.isin(pks, self.taggers)
+
+  #
+  # Changes the stored trust vector of a source, by adding 'values' to the
+  # trust in the identities 'pks', or replacing it if 'add' is false. Sources
+  # that aren't stored are left alone.
+  #
+  def patch(self, source, pks, values, add=True):
+
+    row = self.trust(source)
+    if row is None:
+      return
+    (ids, trust) = row
+    merged = np.union1d(ids, pks)
+    result = np.zeros(len(merged))
+    result[np.searchsorted(merged, ids)] = trust
+    if add:
+      result[np.searchsorted(merged, pks)] += values
+    else:
+      result[np.searchsorted(merged, pks)] = values
+    keep = result >= self.epsilon
+    self._rows[source] = (merged[keep].astype(np.int32), result[keep])
+
+  #
+  # Brings the stored results up to date with a change of 'delta' in the
+  # weight of the link from identity u to identity w (the change in prop_coef,
+  # divided by 4). 'into_src' is the trust that each identity placed in u over
+  # paths of exactly 0 to hops - 1 links before the change, as returned by
+  # Graph.trust_in() but keyed by primary key. 'from_dst' is the trust that w
+  # places in each identity over such paths after it, as returned by
+  # Graph.trust_from().
+  #
+  # Every path that gains or loses weight runs over the changed link. Taking
+  # the last time a path passes through u before crossing the link, the total
+  # change in the trust that s places in v is
+  #
+  #   delta * sum(j = 0 .. hops - 1) into_src[j][s] * from_dst[<= hops - 1 - j][v]
+  #
+  # where from_dst[<= m] sums from_dst over path lengths 0 to m. This only
+  # touches the sources that can reach u and the identities w can reach, so
+  # the cost is in proportion to the size of that neighbourhood, not the
+  # graph.
+  #
+  def update_link(self, g, into_src, from_dst, delta):
+
+    # Identities whose trust changes, restricted to the ones stored
+    columns = np.unique(np.concatenate([nodes for (nodes, _) in from_dst]))
+    columns = columns[self.covers(g.ids[columns])]
+    after = np.zeros((self.hops, len(columns)))
+    for (i, (nodes, values)) in enumerate(from_dst):
+      present = np.isin(nodes, columns)
+      after[i, np.searchsorted(columns, nodes[present])] = values[present]
+    after = np.cumsum(after, axis=0)[::-1]
+
+    # Sources that can reach u, with the trust they place in it by path length
+    rows = np.unique(np.concatenate([pks for (pks, _) in into_src]))
+    before = np.zeros((len(rows), self.hops))
+    for (j, (pks, values)) in enumerate(into_src):
+      before[np.searchsorted(rows, pks), j] = values
+
+    changes = delta * before.dot(after)
+    pks = g.ids[columns]
+    for (source, change) in zip(rows.tolist(), changes):
+
+      # Sources place no trust in themselves
+      others = pks != source
+      self.patch(source, pks[others], change[others])
+
+  #
+  # Starts storing the trust placed in identity v, given the trust that each
+  # identity places in it over paths of exactly 0 to hops links, as returned
+  # by Graph.trust_in(). This is needed when v tags somebody for the first
+  # time.
+  #
+  def add_tagger(self, g, v, into):
+
+    rows = np.unique(np.concatenate([nodes for (nodes, _) in into[1:]]))
+    trust = np.zeros(len(rows))
+    for (nodes, values) in into[1:]:
+      trust[np.searchsorted(rows, nodes)] += values
+    pk = int(g.ids[v])
+    for (source, value) in zip(g.ids[rows].tolist(), trust.tolist()):
+      if source != pk:
+        self.patch(source, [pk], [value], add=False)
+    self.taggers = np.union1d(self.taggers, [pk]).astype(np.int32)
+
+#
+# The process-wide store, at the path given by the RAINBEARD_RESULT_STORE
+# setting. Until a precomputation has written a manifest there, there is no
+# store.
+#
+
+_results = None
+
+# Returns the process-wide store, or None if there isn't one.
+def results():
+  global _results
+  path = getattr(settings, 'RAINBEARD_RESULT_STORE', None)
+  if _results is None and path and \
+     os.path.exists(os.path.join(path, 'manifest.json')):
+    _results = ResultStore(path)
+  return _results
+
+# Closes the process-wide store. The next call to results() reopens it.
+def reset():
+  global _results
+  _results = None
+  _pending.link = None
+
+#
+# Writes a file by writing to a temporary name and renaming it into place, so
+# that readers never see it half written. 'write' is called with the open
+# file.
+#
+def write_atomic(path, write):
+  temp = '%s.%d.tmp' % (path, os.getpid())
+  with open(temp, 'wb') as f:
+    write(f)
+  os.rename(temp, path)
+
+#
+# Writes a chunk of results. 'results' is a list of (ids, trust) pairs for
+# consecutive sources.
+#
+def write_chunk(path, results):
+  ids = [np.zeros(0, np.int32)] + [r[0] for r in results]
+  trust = [np.zeros(0, np.float32)] + [r[1] for r in results]
+  indptr = np.cumsum([len(r) for r in ids])
+  write_atomic(path, lambda f: np.savez(
+    f, indptr=indptr.astype(np.int64),
+    ids=np.concatenate(ids).astype(np.int32),
+    trust=np.concatenate(trust).astype(np.float32)))
+
+#
+# Signal handlers to keep the process-wide store fresh. The change in trust
+# from a link change depends on the graph both before and after it, so the
+# part that depends on the graph before is worked out before the change is
+# saved, and the rest after.
+#
+# NB: As with the snapshot, only changes made in this process are seen, and
+# updated results only last as long as the process does. The changes are
+# marked as applied, so that the store can keep up with the snapshot when it
+# reads them back from the change log.
+#
+
+# The link being changed by each thread, as ((src, dst), old prop_coef,
+# trust placed in the source). Saves that fail never get to post_save, so
+# each pre_save starts by dropping whatever an earlier one left behind.
+_pending = threading.local()
+
+def _link_changing(sender, instance, **kwargs):
+  _pending.link = None
+  store = results()
+  if store is None:
+    return
+
+  # Nobody can reach an identity that the snapshot doesn't know about yet
+  g = graph.snapshot()
+  u = g.index(instance.src_id)
+  if u is None:
+    return
+  w = g.index(instance.dst_id)
+  old = 0 if w is None else g.coef(u, w)
+
+  # Indices can be renumbered in the meantime, so keep primary keys
+  into_src = [(g.ids[nodes], values)
+              for (nodes, values) in g.trust_in(u, store.hops - 1)]
+  _pending.link = ((instance.src_id, instance.dst_id), old, into_src)
+
+def _link_changed(sender, instance, **kwargs):
+  (entry, _pending.link) = (getattr(_pending, 'link', None), None)
+  if entry is not None and entry[0] != (instance.src_id, instance.dst_id):
+    entry = None
+  store = results()
+  if store is None:
+    return
+  store.applied(changes.last_written())
+  if entry is None:
+    return
+  (key, old, into_src) = entry
+  new = 0 if kwargs['signal'] is post_delete else instance.prop_coef
+  if new != old:
+    g = graph.snapshot()
+    from_dst = g.trust_from(g.index(instance.dst_id), store.hops - 1)
+    store.update_link(g, into_src, from_dst, (new - old) * 0.25)
+
+def _tag_saved(sender, instance, **kwargs):
+  store = results()
+  if store is None:
+    return
+  store.applied(changes.last_written())
+  g = graph.snapshot()
+  tagset = g.tagset(instance.tagset_id)
+  if tagset is not None and not store.covers(g.ids[tagset[0]]):
+    store.add_tagger(g, tagset[0], g.trust_in(tagset[0], store.hops))
+
+pre_save.connect(_link_changing, sender=ConfidantLink,
+                 dispatch_uid='rainbeard.store.link')
+pre_delete.connect(_link_changing, sender=ConfidantLink,
+                   dispatch_uid='rainbeard.store.link')
+post_save.connect(_link_changed, sender=ConfidantLink,
+                  dispatch_uid='rainbeard.store.link')
+post_delete.connect(_link_changed, sender=ConfidantLink,
+                    dispatch_uid='rainbeard.store.link')
+post_save.connect(_tag_saved, sender=Tag,
+                  dispatch_uid='rainbeard.store.tag')
+
+# Keeps up with the changes the snapshot reads back from the log. The store
+# isn't opened for this, since it's opened at the version in its manifest.
+def _caught_up(sender, since, entries, **kwargs):
+  if _results is not None and entries is not None:
+    _results.caught_up(kwargs['graph'], since, entries)
+
+graph.caught_up.connect(_caught_up, dispatch_uid='rainbeard.store.caught_up')
@@ -0,0 +1,92 @@
+#
+# Generation of synthetic trust graphs, for benchmarking.
+#
+
+import numpy as np
+from django.contrib.auth.models import User
+from models import *
+import bulk, changes
+
+# Distribution of prop_coefs on generated links, from 0 to 4 quarters
+coef_weights = [0.05, 0.15, 0.3, 0.3, 0.2]
+
+#
+# Populates the database with 'n' activated users, each with a default
+# identity that owns an email agent, and returns the list of their identities'
+# primary keys.
+#
+# Confidant degrees follow a power law (a Pareto distribution with the given
+# exponent, scaled to 'mean_degree'), with links wired up at random between
+# degree stubs. Every confidant relationship gets its pair of links, each with
+# its own prop_coef.
+#
+# Each identity tags 'tagsets' others on average, preferring well-connected
+# targets. Tag names are drawn from a vocabulary of 'vocabulary' names with
+# Zipf-distributed popularity.
+#
+# Usernames are the prefix followed by a number, and email handles are the
+# username at example.com. Generation is deterministic for a given seed.
+#
+def generate(n, seed=0, prefix='synth', mean_degree=8, exponent=2.0,
+             tagsets=4, vocabulary=500):
+
+  rng = np.random.RandomState(seed)
+
+  # Users, profiles and identities, a chunk at a time to bound memory use
+  identities = []
+  chunk = 10000
+  for start in range(0, n, chunk):
+    names = ['%s%d' % (prefix, i) for i in range(start, min(n, start + chunk))]
+    users = [User(username=name, email=name + '@example.com', password='!',
+                  is_active=True) for name in names]
+    bulk.insert(users)
+    profiles = [Profile(user_id=u.pk) for u in users]
+    bulk.insert(profiles)
+    chunk_ids = [Identity(label='default', profile_id=p.pk, is_active=True)
+                 for p in profiles]
+    bulk.insert(chunk_ids)
+    bulk.insert([Agent(handle=u.email, service='email', owner_id=i.pk)
+                 for (u, i) in zip(users, chunk_ids)])
+    identities.extend(i.pk for i in chunk_ids)
+  ids = np.array(identities, dtype=np.int64)
+
+  # Confidant pairs, from shuffled degree stubs. Self-pairs and repeats are
+  # dropped.
+  xmin = mean_degree * (exponent - 1) / exponent
+  degrees = np.minimum((rng.pareto(exponent, n) + 1) * xmin, n - 1)
+  stubs = np.repeat(np.arange(n), np.round(degrees).astype(np.int64))
+  rng.shuffle(stubs)
+  pairs = stubs[:len(stubs) // 2 * 2].reshape(-1, 2)
+  pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+  pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+  src = np.concatenate((pairs[:, 0], pairs[:, 1]))
+  dst = np.concatenate((pairs[:, 1], pairs[:, 0]))
+  coefs = rng.choice(len(coef_weights), size=len(src), p=coef_weights)
+  bulk.insert_rows(ConfidantLink, ['src_id', 'dst_id', 'prop_coef'],
+                   zip(ids[src].tolist(), ids[dst].tolist(), coefs.tolist()))
+
+  # Tagsets, aimed at targets in proportion to their degree
+  popularity = np.bincount(src, minlength=n) + 1.0
+  taggers = rng.randint(0, n, size=n * tagsets)
+  targets = rng.choice(n, size=n * tagsets, p=popularity / popularity.sum())
+  pairs = np.unique(np.column_stack((taggers, targets)), axis=0)
+  pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+  start = bulk.next_pk(TagSet)
+  tagset_ids = np.arange(start, start + len(pairs))
+  bulk.insert_rows(TagSet, ['id', 'tagger_id', 'target_id'],
+                   zip(tagset_ids.tolist(), ids[pairs[:, 0]].tolist(),
+                       ids[pairs[:, 1]].tolist()))
+
+  # Tags, one or more per tagset, without repeating a name within a tagset
+  counts = 1 + rng.poisson(1.0, size=len(pairs))
+  owners = np.repeat(tagset_ids, counts)
+  names = np.minimum(rng.zipf(1.5, size=len(owners)), vocabulary)
+  tags = np.unique(np.column_stack((owners, names)), axis=0)
+  confidences = rng.choice([1, 3, 5, 7, 9], size=len(tags))
+  bulk.insert_rows(Tag, ['tagset_id', 'name', 'confidence'],
+                   zip(tags[:, 0].tolist(),
+                       ['tag%d' % name for name in tags[:, 1].tolist()],
+                       confidences.tolist()))
+  changes.record_reload()
+
+  return identities
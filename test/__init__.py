@@ -1,2 +1,4 @@
 # Test files need to go here to be run
-__all__ = ['account', 'markup', 'query']
+__all__ = ['account', 'agents', 'ajax', 'benchmark', 'cache', 'changes',
+           'coalesce', 'graph', 'markup', 'middleware', 'precompute', 'query',
+           'reputation', 'stats']
@@ -1,7 +1,11 @@
+import os, tempfile
+from StringIO import StringIO
 from unittest import TestLoader, TestSuite
 from django.test import TestCase
 from django.test.client import Client
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
 from rainbeard import account
 from rainbeard.models import *
 from . import util
@@ -167,6 +171,144 @@ class UIAccountTestcase(TestCase):
     self.assertEqual(response.templates[0].name, 'rainbeard/templates/login.html')
     self.assertEqual(len(response.context['form'].non_field_errors()), 1)
 
+# Register accounts in bulk
+class BulkAccountTestcase(TestCase):
+
+  def setUp(self):
+    util.make_user('alice')
+    account.register_user('bob', 'bobpass', 'bob@example.com', False)
+
+  def rows(self, n):
+    return [('user%d' % i, 'pass%d' % i, 'user%d@example.com' % i)
+            for i in range(n)]
+
+  def test_register(self):
+    (claims, failures) = account.register_users(self.rows(20), batch_size=8)
+    self.assertEqual((len(claims), failures), (20, []))
+    self.assertEqual(len(set(c.ckey for c in claims)), 20)
+
+    # The accounts work like any other once claimed
+    self.assertFalse(User.objects.get(username='user3').is_active)
+    agent = account.do_claim(claims[3].ckey)
+    self.assertEqual(agent.owner.profile.user.username, 'user3')
+    user = User.objects.get(username='user3')
+    self.assertTrue(user.is_active)
+    self.assertTrue(user.check_password('pass3'))
+
+  def test_batch_queries(self):
+
+    # A batch takes the same number of queries however big it is
+    def run(n, prefix):
+      rows = [(prefix + u, p, prefix + e) for (u, p, e) in self.rows(n)]
+      account.register_users(rows)
+    run(1, 'a')
+    self.assertNumQueries(14, lambda: run(10, 'b'))
+    self.assertNumQueries(14, lambda: run(100, 'c'))
+
+  def test_failures(self):
+    rows = self.rows(3) + [
+      ('alice', 'pass', 'alice2@example.com'),  # Username taken
+      ('user0', 'pass', 'other@example.com'),   # Username repeated
+      ('carol', 'pass', 'alice@example.com'),   # Email claimed
+      ('dave', 'pass', 'not an email'),
+      ('bad name', 'pass', 'bad@example.com'),
+      ('erin', '', 'erin@example.com'),
+      None,
+      ('frank', 'pass', 'bob@example.com')]     # Email unclaimed, so fine
+    (claims, failures) = account.register_users(rows)
+    self.assertEqual([i for (i, error) in failures], [3, 4, 5, 6, 7, 8, 9])
+    self.assertEqual(sorted(c.owner.profile.user.username for c in claims),
+                     ['frank', 'user0', 'user1', 'user2'])
+    self.assertEqual(Agent.objects.filter(handle='bob@example.com').count(), 1)
+
+  def test_do_claims(self):
+    (claims, failures) = account.register_users(self.rows(30))
+    alice = User.objects.get(username='alice').get_profile().active_identity()
+    rival = account.request_claim(alice, 'user0@example.com', 'email', True)
+    other = account.request_claim(alice, 'alice', 'facebook', True)
+    keys = [c.ckey for c in claims] + [rival.ckey, other.ckey, 'nonsense']
+    outcomes = account.do_claims(keys)
+
+    # The first claim on an agent wins, and the rest are dropped
+    self.assertEqual(outcomes[rival.ckey], None)
+    self.assertEqual(outcomes['nonsense'], None)
+    self.assertEqual(PendingClaim.objects.count(), 1)
+    for c in claims:
+      agent = Agent.objects.get(pk=outcomes[c.ckey])
+      self.assertEqual((agent.handle, agent.owner_id), (c.handle, c.owner_id))
+    self.assertEqual(Agent.objects.get(pk=outcomes[other.ckey]).owner_id,
+                     alice.id)
+
+    # Users are activated by claims on their own email addresses only
+    self.assertEqual(User.objects.filter(username__startswith='user',
+                                         is_active=True).count(), 30)
+    self.assertFalse(User.objects.get(username='bob').is_active)
+
+    # Claims on agents that are missing or somebody else's are left alone,
+    # as they are one at a time
+    bob = User.objects.get(username='bob').get_profile().active_identity()
+    taken = account.request_claim(alice, 'taken', 'facebook', True)
+    gone = account.request_claim(alice, 'gone', 'facebook', True)
+    Agent.objects.filter(handle='taken').update(owner=bob)
+    Agent.objects.filter(handle='gone').delete()
+    self.assertEqual(account.do_claims([taken.ckey, gone.ckey]),
+                     {taken.ckey: None, gone.ckey: None})
+    self.assertEqual(account.do_claim(taken.ckey), None)
+    self.assertEqual(account.do_claim(gone.ckey), None)
+    self.assertEqual(PendingClaim.objects.filter(pk__in=[taken.pk, gone.pk])
+                                         .count(), 2)
+    self.assertEqual(Agent.objects.get(handle='taken').owner_id, bob.id)
+
+    # Queries don't depend on the number of keys
+    (claims, failures) = account.register_users(
+      [('x' + u, p, 'x' + e) for (u, p, e) in self.rows(50)])
+    keys = [c.ckey for c in claims]
+    self.assertNumQueries(6, lambda: account.do_claims(keys[:5]))
+
+    # Owners are set by one UPDATE statement, and claims dropped by one DELETE
+    (saved, connection.use_debug_cursor) = (connection.use_debug_cursor, True)
+    try:
+      del connection.queries[:]
+      account.do_claims(keys[5:])
+      statements = [q['sql'] for q in connection.queries]
+    finally:
+      connection.use_debug_cursor = saved
+    self.assertEqual(len(statements), 6)
+    updates = [sql for sql in statements if sql.startswith('UPDATE')]
+    deletes = [sql for sql in statements if sql.startswith('DELETE')]
+    self.assertEqual(len(updates), 2)
+    self.assertTrue(any('CASE' in sql for sql in updates))
+    self.assertEqual(len(deletes), 1)
+    self.assertEqual(deletes[0].count(' OR '), 44)
+
+  def test_command(self):
+    (fd, path) = tempfile.mkstemp(suffix='.csv')
+    with os.fdopen(fd, 'w') as f:
+      f.write('email,username,password\n')
+      f.write('carol@example.com,carol,carolpass\n')
+      f.write('alice@example.com,alice2,pass\n')
+    (out, err) = (StringIO(), StringIO())
+    try:
+      call_command('register_users', path, stdout=out, stderr=err)
+    finally:
+      os.remove(path)
+    self.assertEqual(out.getvalue(), 'Registered 1 accounts, 1 failed.\n')
+    self.assertTrue(err.getvalue().startswith('Row 2: '))
+    self.assertEqual(User.objects.filter(username='carol').count(), 1)
+    self.assertEqual(User.objects.filter(username='alice2').count(), 0)
+
+    (fd, path) = tempfile.mkstemp(suffix='.jsonl')
+    with os.fdopen(fd, 'w') as f:
+      f.write('{"username": "dave", "password": "x", "email": "d@example.com"}\n')
+      f.write('not json\n')
+    try:
+      call_command('register_users', path, stdout=StringIO(),
+                   stderr=StringIO())
+    finally:
+      os.remove(path)
+    self.assertEqual(User.objects.filter(username='dave').count(), 1)
+
 def suite():
   return TestSuite([TestLoader().loadTestsFromTestCase(SimpleAccountTestcase),
-                    TestLoader().loadTestsFromTestCase(UIAccountTestcase)])
+                    TestLoader().loadTestsFromTestCase(UIAccountTestcase),
+                    TestLoader().loadTestsFromTestCase(BulkAccountTestcase)])
@@ -0,0 +1,98 @@
+from unittest import TestLoader, TestSuite
+from django.test import TestCase
+from rainbeard.models import *
+from rainbeard import account, agents, bulk, query
+from . import util
+
+
+class BloomFilterTestcase(TestCase):
+
+  def test_membership(self):
+    bloom = agents.BloomFilter(1000, 0.01)
+    keys = ['email:user%d@example.com' % i for i in range(1000)]
+    for key in keys:
+      bloom.add(key)
+
+    # No false negatives, and about as many false positives as asked for
+    self.assertTrue(all(key in bloom for key in keys))
+    others = sum('email:other%d@example.com' % i in bloom for i in range(10000))
+    self.assertTrue(others < 300)
+
+class DirectoryTestcase(TestCase):
+
+  def setUp(self):
+    query.reset()
+    self.alice = util.make_user('alice')
+    self.identity = self.alice.get_profile().active_identity()
+    self.directory = agents.directory
+
+  def test_lookup(self):
+    pair = ('alice@example.com', 'email')
+    agent = Agent.objects.get(handle=pair[0], service=pair[1])
+    self.assertEqual(self.directory.lookup(*pair), (agent.id, self.identity.id))
+
+    # Known agents are cached, and unknown ones never reach the database
+    self.assertNumQueries(0, lambda: self.directory.lookup(*pair))
+    self.assertNumQueries(0, lambda: self.directory.lookup('nobody', 'email'))
+    self.assertEqual(self.directory.lookup('nobody', 'email'), None)
+    self.assertNumQueries(0, lambda: self.directory.lookup_many(
+      [('nobody%d' % i, 'facebook') for i in range(100)] + [pair]))
+    self.assertTrue(self.directory.stats()['filtered'] >= 100)
+
+  def test_claims(self):
+
+    # Requesting a claim creates the agent, and claiming it sets its owner
+    self.assertEqual(self.directory.lookup('alice', 'facebook'), None)
+    claim = account.request_claim(self.identity, 'alice', 'facebook',
+                                  quiet=True)
+    (pk, owner) = self.directory.lookup('alice', 'facebook')
+    self.assertEqual(owner, None)
+    account.do_claim(claim.ckey)
+    self.assertEqual(self.directory.lookup('alice', 'facebook'),
+                     (pk, self.identity.id))
+
+    # Deleted agents are forgotten
+    Agent.objects.get(pk=pk).delete()
+    self.assertEqual(self.directory.lookup('alice', 'facebook'), None)
+
+  def test_other_processes(self):
+
+    # Agents written without signals, as by other processes, aren't seen
+    # until the directory times out, but claims on them still work
+    self.directory.may_exist('alice@example.com', 'email')
+    bulk.insert([Agent(handle='alice', service='facebook')])
+    self.assertEqual(self.directory.lookup('alice', 'facebook'), None)
+    account.request_claim(self.identity, 'alice', 'facebook', quiet=True)
+    self.assertEqual(Agent.objects.filter(handle='alice').count(), 1)
+    self.directory._expires = 0
+    self.assertEqual(self.directory.lookup('alice', 'facebook')[1], None)
+
+    # Likewise for their owners
+    Agent.objects.filter(handle='alice').update(owner=self.identity)
+    self.assertEqual(self.directory.lookup('alice', 'facebook')[1], None)
+    self.directory._expires = 0
+    self.assertEqual(self.directory.lookup('alice', 'facebook')[1],
+                     self.identity.id)
+
+    # Catching up adds the new agents to the filter, rather than rebuilding it
+    bloom = self.directory._filter
+    self.directory._expires = 0
+    self.assertNumQueries(1, self.directory.may_exist, 'nobody', 'email')
+    self.assertTrue(self.directory._filter is bloom)
+    self.assertEqual(self.directory._last,
+                     Agent.objects.get(handle='alice').id)
+
+  def test_growth(self):
+
+    # The filter is rebuilt when it fills up, without losing anybody
+    self.directory.may_exist('alice@example.com', 'email')
+    capacity = self.directory._filter.capacity
+    for i in range(capacity):
+      Agent(handle='agent%d' % i, service='facebook').save()
+    self.assertTrue(self.directory._filter is None)
+    self.assertTrue(self.directory.may_exist('agent0', 'facebook'))
+    self.assertTrue(self.directory._filter.capacity > capacity)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(BloomFilterTestcase),
+                    TestLoader().loadTestsFromTestCase(DirectoryTestcase)])
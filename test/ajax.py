@@ -0,0 +1,221 @@
+from unittest import TestLoader, TestSuite
+from django.test import TestCase
+from django.test.client import Client
+from django.utils import simplejson as json
+from rainbeard.models import *
+from rainbeard import account, cache, graph, query, stats
+from . import util
+
+
+class QueryManyTestcase(TestCase):
+
+  def setUp(self):
+
+    # Alice trusts bob, who has opinions about charlie and dave
+    query.reset()
+    self.alice = util.make_user('alice')
+    self.bob = util.make_user('bob')
+    self.charlie = util.make_user('charlie')
+    self.dave = util.make_user('dave')
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    util.make_tags(self.bob, self.dave, {'reliable': 1})
+    self.c = Client()
+    self.c.login(username='alice', password='alicepass')
+
+  def post(self, url, data):
+    response = self.c.post(url, data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    return json.loads(response.content)
+
+  def test_do_query_many(self):
+    identity = lambda user: user.get_profile().active_identity()
+    clouds = query.do_query_many(identity(self.alice),
+                                 [identity(self.dave), identity(self.charlie),
+                                  identity(self.bob)])
+    self.assertAlmostEqual(clouds[0]['reliable'], 0.1)
+    self.assertAlmostEqual(clouds[1]['reliable'], 0.9)
+    self.assertEqual(clouds[2], {})
+
+  def test_endpoint(self):
+    results = self.post('/ajax/query/many',
+                        {'handle': ['charlie@example.com', 'dave@example.com',
+                                    'nobody@example.com'],
+                         'service': ['email', 'email', 'email']})['results']
+    self.assertEqual([r['handle'] for r in results],
+                     ['charlie@example.com', 'dave@example.com',
+                      'nobody@example.com'])
+    self.assertAlmostEqual(results[0]['tags']['reliable'], 0.9)
+    self.assertAlmostEqual(results[1]['tags']['reliable'], 0.1)
+    self.assertEqual(results[2]['tags'], {})
+
+  def test_deadline(self):
+    results = self.post('/ajax/query/many',
+                        {'handle': 'charlie@example.com', 'service': 'email',
+                         'deadline': '1000'})['results']
+    self.assertTrue(results[0]['complete'])
+    self.assertAlmostEqual(results[0]['tags']['reliable'], 0.9)
+    self.assertTrue('error' in self.post('/ajax/query/many',
+                                         {'handle': 'charlie@example.com',
+                                          'service': 'email',
+                                          'deadline': 'soon'}))
+
+  def test_stream(self):
+    response = self.c.get('/ajax/query/stream',
+                          {'handle': 'charlie@example.com', 'service': 'email'})
+    self.assertEqual(response['Content-Type'], 'text/event-stream')
+    events = [json.loads(line[len('data: '):])
+              for line in response.content.split('\n\n') if line]
+    self.assertEqual([(e['hops'], e['complete']) for e in events],
+                     [(1, False), (2, False), (3, True)])
+    self.assertAlmostEqual(events[-1]['tags']['reliable'], 0.9)
+
+    # The clouds are sent after the request has finished, so they're worked
+    # out without going to the database
+    cache.clear()
+    graph._due = 0
+    response = self.c.get('/ajax/query/stream',
+                          {'handle': 'charlie@example.com', 'service': 'email'})
+    graph._due = 0
+    content = []
+    self.assertNumQueries(0, lambda: content.append(response.content))
+    self.assertEqual(content[0].count('data: '), 3)
+
+    # Nobody has claimed nobody, so there's just the one empty cloud
+    response = self.c.get('/ajax/query/stream',
+                          {'handle': 'nobody@example.com', 'service': 'email'})
+    self.assertEqual(response.content.count('data: '), 1)
+    self.assertTrue('error' in json.loads(
+      self.c.get('/ajax/query/stream', {'handle': 'charlie@example.com'})
+            .content))
+
+  def test_etag(self):
+    get = lambda **headers: self.c.get('/ajax/query/many',
+                                       {'handle': 'charlie@example.com',
+                                        'service': 'email'},
+                                       HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                       **headers)
+    response = get()
+    etag = response['ETag']
+    results = json.loads(response.content)['results']
+    self.assertAlmostEqual(results[0]['tags']['reliable'], 0.9)
+
+    # Asking again gets a 304, without querying
+    stats.clear()
+    response = get(HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 304)
+    self.assertEqual(response['ETag'], etag)
+    self.assertFalse('query.wall_ms' in stats.summary())
+    self.assertEqual(stats.summary()['ajax.query_many.not_modified']['max'], 1)
+
+    # Changes that don't reach the cloud leave the ETag alone
+    util.make_tags(self.charlie, self.dave, {'funny': 3})
+    util.make_confidants(self.charlie, self.dave, 4, 4)
+    self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    # Once the graph changes, the cloud is sent again
+    util.make_tags(self.dave, self.charlie, {'funny': 3})
+    response = get(HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+
+    # Changes made by another process are seen once the snapshot catches up
+    # with them, which is before the ETag is worked out, so a new ETag never
+    # comes with an old cloud
+    etag = response['ETag']
+    tag = Tag.objects.get(tagset__tagger__profile__user=self.bob,
+                          tagset__target__profile__user=self.charlie,
+                          name='reliable')
+    Tag.objects.filter(pk=tag.pk).update(confidence=3)
+    GraphChange(kind='tag', object_id=tag.pk, src=tag.tagset_id,
+                name='reliable', value=3).save()
+    graph._due = 0
+    response = get(HTTP_IF_NONE_MATCH=etag)
+    self.assertEqual(response.status_code, 200)
+    self.assertNotEqual(response['ETag'], etag)
+    results = json.loads(response.content)['results']
+    self.assertAlmostEqual(results[0]['tags']['reliable'], 0.3)
+
+    # Estimates and POSTs don't get ETags
+    self.assertFalse(self.c.get('/ajax/query/many',
+                                {'handle': 'charlie@example.com',
+                                 'service': 'email', 'deadline': '1000'},
+                                HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                           .has_header('ETag'))
+    self.assertFalse(self.c.post('/ajax/query/many',
+                                 {'handle': 'charlie@example.com',
+                                  'service': 'email'},
+                                 HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+                           .has_header('ETag'))
+
+  def test_bad_params(self):
+    self.assertTrue('error' in self.post('/ajax/query/many',
+                                         {'handle': 'charlie@example.com'}))
+    self.assertTrue('error' in self.post('/ajax/query/many',
+                                         {'handle': 'charlie@example.com',
+                                          'service': 'myspace'}))
+
+class GivensTestcase(TestCase):
+
+  def setUp(self):
+
+    # Alice has opinions about bob and charlie. Bob claims a second agent.
+    query.reset()
+    self.alice = util.make_user('alice')
+    self.bob = util.make_user('bob')
+    self.charlie = util.make_user('charlie')
+    util.make_tags(self.alice, self.bob, {'reliable': 9, 'funny': 3})
+    util.make_tags(self.alice, self.charlie, {'reliable': 1})
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    claim = account.request_claim(self.bob.get_profile().active_identity(),
+                                  'bobby', 'facebook', quiet=True)
+    account.do_claim(claim.ckey)
+    self.c = Client()
+    self.c.login(username='alice', password='alicepass')
+
+  def test_one_query(self):
+    pairs = [('bob@example.com', 'email'), ('bobby', 'facebook'),
+             ('charlie@example.com', 'email'), ('nobody', 'facebook')]
+    givens = {}
+    def run():
+      givens.update(query.givens(self.alice, pairs))
+
+    # Once the agents have been looked up, it's a single query
+    run()
+    self.assertNumQueries(1, run)
+    self.assertEqual(givens, {('bob@example.com', 'email'): {'reliable': 9,
+                                                              'funny': 3},
+                              ('bobby', 'facebook'): {'reliable': 9,
+                                                      'funny': 3},
+                              ('charlie@example.com', 'email'): {'reliable': 1},
+                              ('nobody', 'facebook'): {}})
+
+  def test_endpoint(self):
+    response = self.c.post('/ajax/givens/get',
+                           {'handle': ['bob@example.com', 'nobody'],
+                            'service': ['email', 'facebook']},
+                           HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    self.assertEqual(json.loads(response.content),
+                     {'givens': {'email:bob@example.com': {'reliable': 9,
+                                                           'funny': 3},
+                                 'facebook:nobody': {}}})
+
+  def test_etag(self):
+    data = {'handle': 'charlie@example.com', 'service': 'email'}
+    get = lambda **headers: self.c.get('/ajax/givens/get', data,
+                                       HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                                       **headers)
+    etag = get()['ETag']
+    self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    # The ETag depends on who's asking, and about whom
+    c = Client()
+    c.login(username='bob', password='bobpass')
+    self.assertNotEqual(c.get('/ajax/givens/get', data,
+                              HTTP_X_REQUESTED_WITH='XMLHttpRequest')['ETag'],
+                        etag)
+    data['handle'] = 'bob@example.com'
+    self.assertNotEqual(get()['ETag'], etag)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(QueryManyTestcase),
+                    TestLoader().loadTestsFromTestCase(GivensTestcase)])
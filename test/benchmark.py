@@ -0,0 +1,68 @@
+from unittest import TestLoader, TestSuite
+from StringIO import StringIO
+from django.test import TestCase
+from django.utils import simplejson as json
+from rainbeard.models import *
+from rainbeard import benchmark, query, synthetic
+
+
+class SyntheticTestcase(TestCase):
+
+  def setUp(self):
+    query.reset()
+    self.ids = synthetic.generate(200, seed=1)
+
+  def test_accounts(self):
+    self.assertEqual(len(self.ids), 200)
+    self.assertEqual(Identity.objects.filter(is_active=True).count(), 200)
+    self.assertEqual(Agent.objects.filter(owner__isnull=False).count(), 200)
+    identity = Identity.objects.get(pk=self.ids[7])
+    self.assertEqual(identity.profile.user.username, 'synth7')
+
+  def test_links(self):
+
+    # Links come in pairs, and follow the validators
+    links = set(ConfidantLink.objects.values_list('src', 'dst'))
+    self.assertTrue(len(links) > 200)
+    self.assertEqual(links, set((d, s) for (s, d) in links))
+    for coef in ConfidantLink.objects.values_list('prop_coef', flat=True):
+      validate_prop_coef(coef)
+
+  def test_tags(self):
+    self.assertTrue(Tag.objects.count() > 200)
+    for confidence in Tag.objects.values_list('confidence', flat=True):
+      validate_confidence(confidence)
+
+    # Popular names come first
+    self.assertTrue(Tag.objects.filter(name='tag1').count() >
+                    Tag.objects.filter(name='tag10').count())
+
+  def test_deterministic(self):
+    tags = list(Tag.objects.values_list('tagset__tagger', 'tagset__target',
+                                        'name', 'confidence'))
+    benchmark.clear()
+    self.assertEqual(synthetic.generate(200, seed=1), self.ids)
+    self.assertEqual(list(Tag.objects.values_list('tagset__tagger',
+                                                  'tagset__target', 'name',
+                                                  'confidence')), tags)
+
+class BenchmarkTestcase(TestCase):
+
+  def test_run(self):
+    out = StringIO()
+    benchmark.run(out, sizes=[50], queries=3, accounts=2, label='test')
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    self.assertEqual(set(r['benchmark'] for r in records),
+                     set(['snapshot_load', 'snapshot_open', 'do_query',
+                          'do_query_horizon', 'do_query_cached',
+                          'do_query_sampled', 'do_query_many',
+                          'register_user', 'do_claim',
+                          'register_users', 'do_claims',
+                          'ajax_query_many', 'ajax_givens']))
+    for r in records:
+      self.assertEqual((r['label'], r['identities']), ('test', 50))
+      self.assertTrue(r['p50_ms'] <= r['p95_ms'] <= r['max_ms'])
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(SyntheticTestcase),
+                    TestLoader().loadTestsFromTestCase(BenchmarkTestcase)])
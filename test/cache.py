@@ -0,0 +1,114 @@
+from unittest import TestLoader, TestSuite
+from django.test import TestCase
+from rainbeard.models import *
+from rainbeard import common, query, cache
+from . import util
+
+
+class CloudCacheTestcase(TestCase):
+
+  def test_lru(self):
+    c = cache.CloudCache(2, 1 << 20)
+    c.put(1, 2, {'reliable': 0.5})
+    c.put(1, 3, {})
+    self.assertEqual(c.get(1, 2), {'reliable': 0.5})
+    c.put(1, 4, {})
+
+    # (1, 3) was the least recently used
+    self.assertEqual(c.get(1, 3), None)
+    self.assertEqual(c.get(1, 2), {'reliable': 0.5})
+    self.assertEqual(len(c), 2)
+    stats = c.stats()
+    self.assertEqual((stats['hits'], stats['misses'], stats['evictions']),
+                     (2, 1, 1))
+
+  def test_bytes(self):
+    c = cache.CloudCache(100, 2 * cache.cloud_size({'reliable': 0.5}))
+    for target in range(3):
+      c.put(1, target, {'reliable': 0.5})
+    self.assertEqual(len(c), 2)
+    self.assertEqual(c.bytes, 2 * cache.cloud_size({'reliable': 0.5}))
+
+  def test_copies(self):
+
+    # Callers can't modify what's cached
+    c = cache.CloudCache(100, 1 << 20)
+    c.put(1, 2, {'reliable': 0.5})
+    c.get(1, 2)['reliable'] = 0.9
+    self.assertEqual(c.get(1, 2), {'reliable': 0.5})
+
+class InvalidationTestcase(TestCase):
+
+  def setUp(self):
+
+    # Alice and bob are confidants, as are charlie and dave. Frank keeps to
+    # himself. Everybody wants to know about eve.
+    query.reset()
+    self.users = dict((name, util.make_user(name))
+                      for name in ('alice', 'bob', 'charlie', 'dave', 'eve',
+                                   'frank'))
+    util.make_confidants(self.users['alice'], self.users['bob'], 4, 4)
+    util.make_confidants(self.users['charlie'], self.users['dave'], 4, 4)
+    for source in ('alice', 'charlie', 'frank'):
+      for target in ('bob', 'eve'):
+        self.query(source, target)
+
+  def identity(self, name):
+    return self.users[name].get_profile().active_identity()
+
+  def query(self, source, target):
+    return query.do_query(self.identity(source), self.identity(target))
+
+  def cached(self, source, target):
+    return cache.clouds.get(self.identity(source).id,
+                            self.identity(target).id) is not None
+
+  def test_hit(self):
+    self.assertTrue(self.cached('alice', 'eve'))
+    hits = cache.clouds.hits
+    self.query('alice', 'eve')
+    self.assertEqual(cache.clouds.hits, hits + 1)
+
+  def test_tag(self):
+
+    # Bob's tags about eve only matter to alice's view of eve
+    util.make_tags(self.users['bob'], self.users['eve'], {'reliable': 9})
+    self.assertFalse(self.cached('alice', 'eve'))
+    self.assertTrue(self.cached('alice', 'bob'))
+    self.assertTrue(self.cached('charlie', 'eve'))
+    self.assertAlmostEqual(self.query('alice', 'eve')['reliable'], 0.9)
+
+  def test_link(self):
+
+    # Linking dave and bob changes what everybody but frank can see
+    util.make_tags(self.users['bob'], self.users['eve'], {'reliable': 9})
+    self.query('alice', 'eve')
+    util.make_confidants(self.users['dave'], self.users['bob'], 4, 4)
+    self.assertTrue(self.cached('frank', 'eve'))
+    self.assertFalse(self.cached('alice', 'eve'))
+    self.assertFalse(self.cached('charlie', 'eve'))
+    self.assertFalse(self.cached('charlie', 'bob'))
+    self.assertAlmostEqual(self.query('charlie', 'eve')['reliable'], 0.9)
+
+  def horizon(self, source):
+    return cache.horizons.get(self.identity(source).id, common.query_hops)
+
+  def test_horizon(self):
+
+    # Tags don't touch horizons, but links do, like clouds
+    util.make_tags(self.users['bob'], self.users['eve'], {'reliable': 9})
+    self.assertNotEqual(self.horizon('alice'), None)
+    util.make_confidants(self.users['dave'], self.users['bob'], 4, 4)
+    self.assertNotEqual(self.horizon('frank'), None)
+    self.assertEqual(self.horizon('alice'), None)
+    self.assertEqual(self.horizon('charlie'), None)
+
+    # The next query rebuilds them
+    self.assertAlmostEqual(self.query('charlie', 'eve')['reliable'], 0.9)
+    (ids, trust) = self.horizon('charlie')
+    self.assertEqual(ids.tolist(), sorted(self.identity(name).id
+                                          for name in ('alice', 'bob', 'dave')))
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(CloudCacheTestcase),
+                    TestLoader().loadTestsFromTestCase(InvalidationTestcase)])
@@ -0,0 +1,146 @@
+import os, shutil, tempfile
+from unittest import TestLoader, TestSuite
+from django.conf import settings
+from django.test import TestCase
+from rainbeard.models import *
+from rainbeard import cache, changes, common, graph, query
+from . import util
+
+
+class ChangeLogTestcase(TestCase):
+
+  def setUp(self):
+    query.reset()
+    self.alice = util.make_user('alice')
+    self.bob = util.make_user('bob')
+    self.charlie = util.make_user('charlie')
+
+  def identity(self, user):
+    return user.get_profile().active_identity()
+
+  def query(self, source, target):
+    return query.do_query(self.identity(source), self.identity(target))
+
+  def test_log(self):
+
+    # Each change moves the version on by one
+    start = changes.current_version()
+    util.make_confidants(self.alice, self.bob, 4, 2)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    self.assertEqual(changes.current_version(), start + 4)
+    entries = changes.since(start)
+    self.assertEqual([e.pk for e in entries], range(start + 1, start + 5))
+    self.assertEqual([(e.kind, e.deleted) for e in entries],
+                     [('link', False), ('link', False), ('tagset', False),
+                      ('tag', False)])
+    (a, b) = (self.identity(self.alice).id, self.identity(self.bob).id)
+    self.assertEqual((entries[0].src, entries[0].dst, entries[0].value),
+                     (a, b, 4))
+    self.assertEqual((entries[3].name, entries[3].value), ('reliable', 9))
+    self.assertEqual(len(changes.since(start, limit=3)), 3)
+
+    # Deleting a tagset deletes its tags too, and both are logged
+    version = changes.current_version()
+    TagSet.objects.all().delete()
+    self.assertEqual(sorted((e.kind, e.deleted)
+                            for e in changes.since(version)),
+                     [('tag', True), ('tagset', True)])
+
+  def test_catch_up(self):
+
+    # A snapshot saved early catches up with the changes made since
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    directory = tempfile.mkdtemp()
+    saved = settings.RAINBEARD_GRAPH_SNAPSHOT
+    try:
+      settings.RAINBEARD_GRAPH_SNAPSHOT = os.path.join(directory, 'graph')
+      graph.Graph.load().save(settings.RAINBEARD_GRAPH_SNAPSHOT)
+      util.make_tags(self.bob, self.charlie, {'reliable': 9})
+      tag = Tag.objects.get()
+      tag.confidence = 5
+      tag.save()
+      query.reset()
+      g = graph.snapshot()
+      self.assertEqual(g.version, changes.current_version())
+      self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'],
+                             0.5)
+
+      # Bulk changes mean starting over
+      changes.record_reload()
+      query.reset()
+      self.assertFalse(graph.Graph.open(settings.RAINBEARD_GRAPH_SNAPSHOT)
+                                  .catch_up())
+      g = graph.snapshot()
+      self.assertEqual(g.version, changes.current_version())
+      self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'],
+                             0.5)
+    finally:
+      settings.RAINBEARD_GRAPH_SNAPSHOT = saved
+      shutil.rmtree(directory)
+
+  def test_refresh(self):
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'],
+                           0.9)
+    (a, c) = (self.identity(self.alice).id, self.identity(self.charlie).id)
+
+    # Catching up with our own changes leaves the cache alone
+    graph.refresh()
+    self.assertNotEqual(cache.clouds.get(a, c), None)
+    self.assertEqual(graph.snapshot().version, changes.current_version())
+
+    # Changes made by another process, without signals, are seen when the
+    # snapshot is next due to catch up
+    tag = Tag.objects.get()
+    Tag.objects.filter(pk=tag.pk).update(confidence=5)
+    GraphChange(kind='tag', object_id=tag.pk, src=tag.tagset_id,
+                name='reliable', value=5).save()
+    graph._due = 0
+    self.assertEqual(graph.snapshot().version, changes.current_version())
+    self.assertEqual(cache.clouds.get(a, c), None)
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'],
+                           0.5)
+
+    # Likewise for links, which also drop horizons
+    link = ConfidantLink.objects.get(src=a)
+    ConfidantLink.objects.filter(pk=link.pk).update(prop_coef=2)
+    GraphChange(kind='link', object_id=link.pk, src=link.src_id,
+                dst=link.dst_id, value=2).save()
+    graph.refresh()
+    self.assertEqual(cache.horizons.get(a, common.query_hops), None)
+    self.assertEqual(graph.snapshot().coef(graph.snapshot().index(a),
+                                           graph.snapshot().index(link.dst_id)),
+                     2)
+
+    # Bulk changes reload the snapshot
+    old = graph.snapshot()
+    changes.record_reload()
+    self.assertFalse(graph.refresh() is old)
+    self.assertEqual(len(cache.clouds), 0)
+
+    # Receivers may catch the snapshot up themselves
+    versions = []
+    def receiver(sender, **kwargs):
+      versions.append(graph.refresh().version)
+    graph.caught_up.connect(receiver)
+    try:
+      GraphChange(kind='link', object_id=link.pk, src=link.src_id,
+                  dst=link.dst_id, value=2).save()
+      graph.refresh()
+    finally:
+      graph.caught_up.disconnect(receiver)
+    self.assertEqual(versions, [changes.current_version()])
+
+  def test_batches(self):
+    g = graph.Graph.load()
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9, 'funny': 1})
+    self.assertTrue(g.catch_up(batch=2))
+    self.assertEqual(g.version, changes.current_version())
+    g.sync()
+    self.assertEqual(len(g.coefs), 2)
+    self.assertEqual(len(g.tag_ids), 2)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(ChangeLogTestcase)])
@@ -0,0 +1,147 @@
+import fcntl, os, shutil, tempfile, threading, time
+import numpy as np
+from unittest import TestLoader, TestSuite
+from django.conf import settings
+from django.test import TestCase
+from rainbeard import cache, coalesce, graph, query, stats
+from . import util
+
+
+class SingleFlightTestcase(TestCase):
+
+  def test_shared(self):
+
+    # Callers arriving while the first is computing wait for its result
+    flights = coalesce.SingleFlight()
+    (started, release) = (threading.Event(), threading.Event())
+    runs = []
+    def compute():
+      runs.append(None)
+      started.set()
+      release.wait()
+      return [1, 2]
+    results = []
+    leader = threading.Thread(target=lambda:
+                              results.append(flights.do('key', compute)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda:
+                                  results.append(flights.do('key', compute)))
+                 for i in range(4)]
+    for thread in followers:
+      thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in [leader] + followers:
+      thread.join()
+    self.assertEqual(len(runs), 1)
+    self.assertEqual(len(results), 5)
+    self.assertTrue(all(result is results[0] for result in results))
+
+    # Once it's done, the next caller computes afresh
+    self.assertEqual(flights.do('key', lambda: 3), 3)
+
+  def test_failure(self):
+
+    # The failure goes to the leader, and the followers compute for themselves
+    flights = coalesce.SingleFlight()
+    (started, release) = (threading.Event(), threading.Event())
+    def fail():
+      started.set()
+      release.wait()
+      raise ValueError()
+    errors = []
+    def lead():
+      try:
+        flights.do('key', fail)
+      except ValueError:
+        errors.append(None)
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    results = []
+    follower = threading.Thread(target=lambda:
+                                results.append(flights.do('key', lambda: 2)))
+    follower.start()
+    time.sleep(0.1)
+    release.set()
+    leader.join()
+    follower.join()
+    self.assertEqual((len(errors), results), (1, [2]))
+    self.assertEqual(flights._calls, {})
+
+class AcrossProcessesTestcase(TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.saved = settings.RAINBEARD_COALESCE_DIR
+    settings.RAINBEARD_COALESCE_DIR = self.directory
+    query.reset()
+
+  def tearDown(self):
+    settings.RAINBEARD_COALESCE_DIR = self.saved
+    shutil.rmtree(self.directory)
+
+  def test_recent(self):
+
+    # A recent result for the same version is picked up rather than computed
+    compute = lambda: {'x': np.arange(3)}
+    coalesce.across_processes('test', 1, compute)
+    with stats.measure('test') as counts:
+      result = coalesce.across_processes('test', 1, lambda: self.fail())
+    self.assertEqual(result['x'].tolist(), [0, 1, 2])
+    self.assertEqual(counts['coalesced'], 1)
+
+    # Results for other versions, or that are too old, aren't
+    other = lambda: {'x': np.arange(2)}
+    self.assertEqual(coalesce.across_processes('test', 2, other)['x'].size, 2)
+    self.assertEqual(
+      coalesce.across_processes('test', 2, compute, window=-1)['x'].size, 3)
+
+  def test_cleanup(self):
+    compute = lambda: {'x': np.arange(3)}
+    path = os.path.join(self.directory, 'test')
+    coalesce.across_processes('test', 2, compute)
+
+    # Results from older versions are removed when they're found
+    self.assertEqual(coalesce._recent(path + '.npz', 1, 10), None)
+    self.assertTrue(os.path.exists(path + '.npz'))
+    self.assertEqual(coalesce._recent(path + '.npz', 3, 10), None)
+    self.assertFalse(os.path.exists(path + '.npz'))
+
+    # Results and locks that have fallen out of the window are swept away,
+    # but not locks that are held
+    coalesce.across_processes('test', 2, compute)
+    coalesce.across_processes('other', 2, compute)
+    old = time.time() - 60
+    for name in os.listdir(self.directory):
+      os.utime(os.path.join(self.directory, name), (old, old))
+    with open(path + '.lock', 'a') as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      coalesce._swept = 0
+      coalesce._sweep(1)
+    self.assertEqual(os.listdir(self.directory), ['test.lock'])
+
+  def test_query(self):
+
+    # Queries come out the same through the shared results
+    (alice, bob, charlie) = [util.make_user(name)
+                             for name in ('alice', 'bob', 'charlie')]
+    util.make_confidants(alice, charlie, 4, 4)
+    util.make_tags(charlie, bob, {'reliable': 9})
+    (a, b) = [user.get_profile().active_identity() for user in (alice, bob)]
+    self.assertAlmostEqual(query.do_query(a, b)['reliable'], 0.9)
+    cache.clear()
+    with stats.measure('test') as counts:
+      self.assertAlmostEqual(query.do_query(a, b)['reliable'], 0.9)
+    self.assertEqual(counts['coalesced'], 1)
+
+    # Shared results are labelled with the version of the snapshot that
+    # computed them
+    with np.load(os.path.join(self.directory,
+                              'propagate-%d-%d.npz' % (a.id, 3))) as f:
+      self.assertEqual(int(f['version']), graph.snapshot().version)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(SingleFlightTestcase),
+                    TestLoader().loadTestsFromTestCase(AcrossProcessesTestcase)])
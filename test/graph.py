@@ -0,0 +1,163 @@
+import os, shutil, tempfile
+from unittest import TestLoader, TestSuite
+from django.conf import settings
+from django.test import TestCase
+import numpy as np
+from rainbeard.models import *
+from rainbeard import query, graph
+from . import util
+
+
+class SnapshotTestcase(TestCase):
+
+  def setUp(self):
+
+    # Create some users and load the snapshot before anything is linked
+    query.reset()
+    self.alice = util.make_user('alice')
+    self.bob = util.make_user('bob')
+    self.charlie = util.make_user('charlie')
+    self.g = graph.snapshot()
+
+  def identity(self, user):
+    return user.get_profile().active_identity()
+
+  def query(self, source, target):
+    return query.do_query(self.identity(source), self.identity(target))
+
+  def test_compact(self):
+    util.make_confidants(self.alice, self.bob, 4, 2)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    self.g.sync()
+    self.assertEqual(self.g.indices.dtype, np.int32)
+    self.assertEqual(self.g.coefs.dtype, np.uint8)
+    self.assertEqual(self.g.tag_conf.dtype, np.uint8)
+    self.assertEqual(self.g.tag_name_id.dtype, np.int32)
+    self.assertEqual(len(self.g.coefs), 2)
+
+  def test_incremental(self):
+
+    # Changes are picked up without reloading the snapshot
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'], 0.9)
+    self.assertTrue(graph.snapshot() is self.g)
+
+    # Edits
+    tag = Tag.objects.get(name='reliable')
+    tag.confidence = 3
+    tag.save()
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'], 0.3)
+    link = ConfidantLink.objects.get(src=self.identity(self.alice))
+    link.prop_coef = 0
+    link.save()
+    self.assertEqual(self.query(self.alice, self.charlie), {})
+
+    # Deletions
+    link.prop_coef = 4
+    link.save()
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'], 0.3)
+    TagSet.objects.all().delete()
+    self.assertEqual(self.query(self.alice, self.charlie), {})
+    self.assertEqual(len(self.g.tag_ids), 0)
+    self.assertEqual(len(self.g.tagset_ids), 0)
+    ConfidantLink.objects.all().delete()
+    self.g.sync()
+    self.assertEqual(len(self.g.coefs), 0)
+
+  def test_names(self):
+
+    # Each name is stored once, and keeps its id as tags come and go
+    util.make_tags(self.alice, self.charlie, {'reliable': 9, 'funny': 3})
+    util.make_tags(self.bob, self.charlie, {'reliable': 7})
+    self.g.sync()
+    self.assertEqual(sorted(self.g.names.tolist()), ['funny', 'reliable'])
+    reliable = self.g.intern(['reliable'])[0]
+    self.assertEqual(self.g.names[reliable], 'reliable')
+    Tag.objects.filter(name='reliable').delete()
+    util.make_tags(self.bob, self.alice, {'honest': 5, 'reliable': 5})
+    self.g.sync()
+    self.assertEqual(len(self.g.names), 3)
+    self.assertEqual(self.g.intern(['reliable'])[0], reliable)
+    (taggers, name_ids, confs) = self.g.tags_for(
+      self.g.index(self.identity(self.alice).id))
+    self.assertEqual(sorted(self.g.names[name_ids].tolist()),
+                     ['honest', 'reliable'])
+
+  def test_new_identity(self):
+
+    # Users created after the snapshot was loaded join the graph
+    dave = util.make_user('dave')
+    util.make_confidants(self.alice, dave, 4, 4)
+    util.make_tags(dave, self.charlie, {'reliable': 7})
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'], 0.7)
+
+  def test_no_sql(self):
+
+    # Between catching up with the change log, queries don't touch the
+    # database
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+    (a, c) = (self.identity(self.alice), self.identity(self.charlie))
+    graph.refresh()
+    self.assertNumQueries(0, lambda: query.do_query(a, c))
+
+  def test_walks(self):
+    util.make_confidants(self.alice, self.bob, 4, 2)
+    util.make_confidants(self.bob, self.charlie, 3, 1)
+    (a, b, c) = [self.g.index(self.identity(u).id)
+                 for u in (self.alice, self.bob, self.charlie)]
+    self.assertEqual(self.g.coef(a, b), 4)
+    self.assertEqual(self.g.coef(a, c), 0)
+
+    # Walking out of alice, and into charlie, both sum to propagation
+    trust = query.propagate(self.g, a, 3)
+    total = np.zeros(len(self.g))
+    for (nodes, values) in self.g.trust_from(a, 3)[1:]:
+      total[nodes] += values
+    total[a] = 0.0
+    self.assertTrue(np.allclose(total, trust))
+    into = sum(values[nodes == a].sum()
+               for (nodes, values) in self.g.trust_in(c, 3)[1:])
+    self.assertAlmostEqual(into, trust[c])
+
+  def test_file(self):
+    util.make_confidants(self.alice, self.bob, 4, 2)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9, 'funny': 3})
+    self.g.sync()
+    directory = tempfile.mkdtemp()
+    saved = settings.RAINBEARD_GRAPH_SNAPSHOT
+    try:
+      settings.RAINBEARD_GRAPH_SNAPSHOT = os.path.join(directory, 'graph')
+      self.g.save(settings.RAINBEARD_GRAPH_SNAPSHOT)
+      graph.reset()
+      g = graph.snapshot()
+    finally:
+      settings.RAINBEARD_GRAPH_SNAPSHOT = saved
+      shutil.rmtree(directory)
+
+    # The arrays come back as they were, mapped from the file
+    for name in ('ids', 'indptr', 'indices', 'coefs', 'tagset_ids',
+                 'tagset_tagger', 'tagset_target', 'tag_ids', 'tag_tagger',
+                 'tag_name_id', 'tag_conf', 'tag_ptr', 'names'):
+      (a, b) = (getattr(g, name), getattr(self.g, name))
+      self.assertEqual((a.dtype, a.tolist()), (b.dtype, b.tolist()))
+    self.assertFalse(g.coefs.flags.writeable)
+    self.assertAlmostEqual(self.query(self.alice, self.charlie)['reliable'], 0.9)
+
+    # Changes are folded in as usual
+    util.make_confidants(self.alice, self.charlie, 1, 1)
+    g.sync()
+    self.assertEqual(len(g.coefs), 4)
+
+  def test_bad_file(self):
+    (fd, path) = tempfile.mkstemp()
+    try:
+      os.write(fd, b'not a snapshot')
+      os.close(fd)
+      self.assertRaises(ValueError, graph.Graph.open, path)
+    finally:
+      os.remove(path)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(SnapshotTestcase)])
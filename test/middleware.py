@@ -0,0 +1,55 @@
+from unittest import TestLoader, TestSuite
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from rainbeard.models import *
+from rainbeard import middleware
+from . import util
+
+
+class ActiveIdentityTestcase(TestCase):
+
+  def setUp(self):
+    self.alice = util.make_user('alice')
+    self.default = self.alice.get_profile().active_identity()
+    self.other = Identity(label='other', profile=self.alice.get_profile())
+    self.other.save()
+    self.saved = settings.RAINBEARD_CACHE_IDENTITIES
+    cache.clear()
+
+  def tearDown(self):
+    settings.RAINBEARD_CACHE_IDENTITIES = self.saved
+    cache.clear()
+
+  def request(self, user):
+    request = RequestFactory().get('/')
+    request.user = user
+    middleware.ActiveIdentityMiddleware().process_request(request)
+    return request
+
+  def test_once_per_request(self):
+    request = self.request(self.alice)
+    self.assertNumQueries(1, lambda: request.identity.id)
+    self.assertNumQueries(0, lambda: request.identity.label)
+    self.assertEqual(request.identity.id, self.default.id)
+
+    # Every request looks again, so switches are seen straight away
+    self.other.activate()
+    self.assertEqual(self.request(self.alice).identity.id, self.other.id)
+    self.assertEqual(self.request(AnonymousUser()).identity, None)
+
+  def test_cached(self):
+    settings.RAINBEARD_CACHE_IDENTITIES = True
+    self.assertEqual(self.request(self.alice).identity.id, self.default.id)
+    request = self.request(self.alice)
+    self.assertNumQueries(0, lambda: request.identity.id)
+    self.assertEqual(request.identity.label, 'default')
+
+    # Switching identities drops the cached one
+    Identity.objects.get(pk=self.other.pk).activate()
+    self.assertEqual(self.request(self.alice).identity.id, self.other.id)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(ActiveIdentityTestcase)])
@@ -0,0 +1,185 @@
+import os, shutil, tempfile
+from unittest import TestLoader, TestSuite
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models.signals import pre_save
+from django.test import TestCase
+from rainbeard.models import *
+from rainbeard import cache, changes, graph, precompute, query, stats, store
+from . import util
+
+
+class PrecomputeTestcase(TestCase):
+
+  def setUp(self):
+
+    # A chain of confidants, alice -> bob -> charlie -> dave, with everybody
+    # tagging eve.
+    query.reset()
+    self.users = dict((name, util.make_user(name))
+                      for name in ('alice', 'bob', 'charlie', 'dave', 'eve'))
+    util.make_confidants(self.users['alice'], self.users['bob'], 4, 2)
+    util.make_confidants(self.users['bob'], self.users['charlie'], 3, 4)
+    util.make_confidants(self.users['charlie'], self.users['dave'], 2, 1)
+    util.make_tags(self.users['bob'], self.users['eve'], {'reliable': 9})
+    util.make_tags(self.users['charlie'], self.users['eve'],
+                   {'reliable': 3, 'honest': 7})
+    util.make_tags(self.users['dave'], self.users['eve'], {'funny': 5})
+
+    self.path = tempfile.mkdtemp()
+    self.saved = settings.RAINBEARD_RESULT_STORE
+    settings.RAINBEARD_RESULT_STORE = self.path
+
+  def tearDown(self):
+    settings.RAINBEARD_RESULT_STORE = self.saved
+    shutil.rmtree(self.path)
+    query.reset()
+
+  def identity(self, name):
+    return self.users[name].get_profile().active_identity()
+
+  def clouds(self):
+    names = sorted(self.users)
+    return dict(((s, t), query.do_query(self.identity(s), self.identity(t)))
+                for s in names for t in names if s != t)
+
+  def assertCloudsEqual(self, a, b):
+    self.assertEqual(sorted(a), sorted(b))
+    for key in a:
+      self.assertEqual(sorted(a[key]), sorted(b[key]))
+      for name in a[key]:
+        self.assertAlmostEqual(a[key][name], b[key][name], places=5)
+
+  def test_matches_live(self):
+    live = self.clouds()
+    self.assertEqual(precompute.precompute(self.path, processes=2,
+                                           chunk_size=2), 3)
+
+    # Every query is answered from the store, with the same results
+    query.reset()
+    with stats.measure('test') as record:
+      stored = self.clouds()
+    self.assertEqual(record.get('store_hits'), len(stored))
+    self.assertFalse(record.get('nodes'))
+    self.assertCloudsEqual(stored, live)
+
+  def test_behind(self):
+    precompute.precompute(self.path, processes=1)
+    version = changes.current_version()
+    self.assertEqual(store.results().version, version)
+
+    # After a change the store never saw, and a restart, it isn't used
+    changes.record_reload()
+    query.reset()
+    with stats.measure('test') as record:
+      self.clouds()
+    self.assertFalse(record.get('store_hits'))
+    self.assertFalse(store.results().serves(graph.snapshot(), 3))
+
+  def test_other_processes(self):
+    precompute.precompute(self.path, processes=1)
+    results = store.results()
+
+    # Tags from stored taggers don't matter to the store, but links do
+    tag = Tag.objects.filter(tagset__tagger=self.identity('bob'))[0]
+    Tag.objects.filter(pk=tag.pk).update(confidence=3)
+    GraphChange(kind='tag', object_id=tag.pk, src=tag.tagset_id,
+                name=tag.name, value=3).save()
+    graph.refresh()
+    self.assertTrue(results.serves(graph.snapshot(), 3))
+    link = ConfidantLink.objects.get(src=self.identity('alice'))
+    ConfidantLink.objects.filter(pk=link.pk).update(prop_coef=1)
+    GraphChange(kind='link', object_id=link.pk, src=link.src_id,
+                dst=link.dst_id, value=1).save()
+    graph.refresh()
+    self.assertFalse(results.serves(graph.snapshot(), 3))
+
+  def test_resume(self):
+    precompute.precompute(self.path, processes=1, chunk_size=2)
+    results = store.ResultStore(self.path)
+    os.remove(results.chunk_path(1))
+
+    # Only the missing chunk is recomputed, unless asked to restart
+    self.assertEqual(precompute.precompute(self.path, processes=1), 1)
+    self.assertTrue(os.path.exists(results.chunk_path(1)))
+    self.assertEqual(precompute.precompute(self.path, processes=1), 0)
+    self.assertEqual(precompute.precompute(self.path, processes=1,
+                                           chunk_size=4, restart=True), 2)
+
+    # Once the graph has changed, resuming starts over
+    os.remove(results.chunk_path(1))
+    util.make_confidants(self.users['dave'], self.users['alice'], 1, 1)
+    self.assertEqual(precompute.precompute(self.path, processes=1,
+                                           chunk_size=4), 2)
+    self.assertEqual(store.ResultStore(self.path).version,
+                     graph.snapshot().version)
+
+  # Checks that every stored trust vector matches a fresh propagation, and
+  # that queries from stored sources are answered from the store.
+  def assertFresh(self):
+
+    # The store keeps up with the snapshot as it reads our changes back
+    g = graph.refresh()
+    results = store.results()
+    sources = [name for name in self.users
+               if results.trust(self.identity(name).id) is not None]
+    for name in sources:
+      pk = self.identity(name).id
+      trust = query.propagate(g, g.index(pk), results.hops)
+      covered = results.covers(g.ids) & (trust > 0)
+      (ids, stored) = results.trust(pk)
+      self.assertEqual(ids.tolist(), g.ids[covered].tolist())
+      for (a, b) in zip(stored, trust[covered]):
+        self.assertAlmostEqual(a, b, places=5)
+
+    live = {}
+    for (s, t) in self.clouds():
+      (i, j) = (g.index(self.identity(s).id), g.index(self.identity(t).id))
+      live[(s, t)] = query.tag_cloud(g, query.propagate(g, i, 3), j)
+    cache.clouds.clear()
+    with stats.measure('test') as record:
+      stored = self.clouds()
+    self.assertEqual(record.get('store_hits'),
+                     len([s for (s, t) in stored if s in sources]))
+    self.assertCloudsEqual(stored, live)
+
+  def test_incremental(self):
+    precompute.precompute(self.path, processes=1)
+    self.assertFresh()
+
+    # Changing, adding and removing links
+    link = ConfidantLink.objects.get(src=self.identity('alice'),
+                                     dst=self.identity('bob'))
+    link.prop_coef = 1
+    link.save()
+    self.assertFresh()
+
+    # A save that fails after pre_save leaves nothing behind for the next
+    pre_save.send(sender=ConfidantLink, instance=link)
+    ConfidantLink(src=self.identity('charlie'), dst=self.identity('alice'),
+                  prop_coef=2).save()
+    self.assertFresh()
+    ConfidantLink(src=self.identity('dave'), dst=self.identity('alice'),
+                  prop_coef=3).save()
+    self.assertFresh()
+    ConfidantLink.objects.get(src=self.identity('charlie'),
+                              dst=self.identity('dave')).delete()
+    self.assertFresh()
+
+    # Alice's trust isn't stored until she tags somebody
+    self.assertFalse(store.results().covers(self.identity('alice').id))
+    util.make_tags(self.users['alice'], self.users['eve'], {'funny': 1})
+    self.assertTrue(store.results().covers(self.identity('alice').id))
+    self.assertFresh()
+
+    # A new identity, linked in from the middle
+    util.make_user('frank')
+    self.users['frank'] = User.objects.get(username='frank')
+    util.make_confidants(self.users['bob'], self.users['frank'], 4, 4)
+    util.make_tags(self.users['frank'], self.users['eve'], {'reliable': 1})
+    self.assertFresh()
+
+def suite():
+  s = TestSuite()
+  s.addTest(TestLoader().loadTestsFromTestCase(PrecomputeTestcase))
+  return s
@@ -1,7 +1,7 @@
 from unittest import TestLoader, TestSuite
 from django.test import TestCase
 from rainbeard.models import *
-from rainbeard import query
+from rainbeard import cache, common, graph, query
 from . import util
 
 
@@ -9,16 +9,222 @@ class SimpleQueryTestcase(TestCase):
 
   def setUp(self):
 
+    # Start from a fresh snapshot of the graph
+    query.reset()
+
     # Create two basic user accounts with email addresses
     self.alice = util.make_user('alice')
     self.bob = util.make_user('bob')
 
+  def query(self, source, target, **kwargs):
+    return query.do_query(source.get_profile().active_identity(),
+                          target.get_profile().active_identity(), **kwargs)
+
   def test_basic(self):
 
-    # Dummy query, for now.
-    results = query.do_query(self.alice.get_profile().active_identity(),
-                             self.bob.get_profile().active_identity())
-    self.assertEqual(results['reliable'], 0.5)
+    # Nobody has said anything, so there's nothing to report.
+    self.assertEqual(self.query(self.alice, self.bob), {})
+
+  def test_direct(self):
+
+    # Alice fully trusts charlie, who says bob is reliable.
+    charlie = util.make_user('charlie')
+    util.make_confidants(self.alice, charlie, 4, 4)
+    util.make_tags(charlie, self.bob, {'reliable': 9, 'funny': 1})
+    results = self.query(self.alice, self.bob)
+    self.assertAlmostEqual(results['reliable'], 0.9)
+    self.assertAlmostEqual(results['funny'], 0.1)
+
+  def test_weighted(self):
+
+    # Alice trusts charlie fully and dave half as much. They disagree.
+    charlie = util.make_user('charlie')
+    dave = util.make_user('dave')
+    util.make_confidants(self.alice, charlie, 4, 4)
+    util.make_confidants(self.alice, dave, 2, 4)
+    util.make_tags(charlie, self.bob, {'reliable': 9})
+    util.make_tags(dave, self.bob, {'reliable': 1})
+    results = self.query(self.alice, self.bob)
+    self.assertAlmostEqual(results['reliable'], (9 + 0.5 * 1) / 15.0)
+
+  def test_own_tags(self):
+
+    # Alice's own tags are givens, and don't show up in her results.
+    charlie = util.make_user('charlie')
+    util.make_confidants(self.alice, charlie, 4, 4)
+    util.make_tags(self.alice, self.bob, {'reliable': 9})
+    self.assertEqual(self.query(self.alice, self.bob), {})
+
+  def test_untrusted(self):
+
+    # Alice has a zero coefficient on charlie.
+    charlie = util.make_user('charlie')
+    util.make_confidants(self.alice, charlie, 0, 4)
+    util.make_tags(charlie, self.bob, {'reliable': 9})
+    self.assertEqual(self.query(self.alice, self.bob), {})
+
+  def test_hops(self):
+
+    # Alice reaches dave through charlie.
+    charlie = util.make_user('charlie')
+    dave = util.make_user('dave')
+    util.make_confidants(self.alice, charlie, 4, 4)
+    util.make_confidants(charlie, dave, 2, 4)
+    util.make_tags(dave, self.bob, {'reliable': 7})
+    self.assertEqual(self.query(self.alice, self.bob, hops=1), {})
+    results = self.query(self.alice, self.bob, hops=2)
+    self.assertAlmostEqual(results['reliable'], 0.7)
+
+  def test_horizon(self):
+
+    # Alice trusts charlie fully, and dave through him at half that
+    charlie = util.make_user('charlie')
+    dave = util.make_user('dave')
+    util.make_confidants(self.alice, charlie, 4, 4)
+    util.make_confidants(charlie, dave, 2, 4)
+    (a, c, d) = [user.get_profile().active_identity()
+                 for user in (self.alice, charlie, dave)]
+    g = graph.snapshot()
+    ((ids, trust), hops, complete) = query.horizon(g, a.id, 2)
+    self.assertEqual((ids.tolist(), hops, complete), ([c.id, d.id], 2, True))
+    self.assertAlmostEqual(trust[0], 1.0)
+    self.assertAlmostEqual(trust[1], 0.5)
+
+    # Only horizons over the default hop limit are cached
+    self.assertEqual(cache.horizons.get(a.id, 2), None)
+    (found, hops, complete) = query.horizon(g, a.id, common.query_hops)
+    self.assertTrue(cache.horizons.get(a.id, common.query_hops) is found)
+    self.assertRaises(ValueError, found[1].__setitem__, 0, 0.0)
+
+class BoundedQueryTestcase(TestCase):
+
+  def setUp(self):
+
+    # Alice has a few confidants, who have confidants of their own. They all
+    # have something to say about zed.
+    query.reset()
+    self.alice = util.make_user('alice')
+    self.zed = util.make_user('zed')
+    for (i, coef) in enumerate((4, 3, 1)):
+      friend = util.make_user('friend%d' % i)
+      util.make_confidants(self.alice, friend, coef, 4)
+      util.make_tags(friend, self.zed, {'reliable': 2 * i + 3})
+      for j in range(12):
+        other = util.make_user('other%d_%d' % (i, j))
+        util.make_confidants(friend, other, 1, 4)
+        util.make_tags(other, self.zed, {'reliable': 9, 'funny': 1})
+
+  def identity(self, user):
+    return user.get_profile().active_identity()
+
+  def test_exact(self):
+
+    # With no slack, the result is exact
+    exact = query.do_query(self.identity(self.alice), self.identity(self.zed))
+    cloud = query.do_query_bounded(self.identity(self.alice),
+                                   self.identity(self.zed), epsilon=0.0)
+    self.assertEqual(set(cloud), set(exact))
+    for name in exact:
+      self.assertAlmostEqual(cloud[name], exact[name])
+    self.assertEqual(cloud.error, 0.0)
+
+  def test_bounded(self):
+    exact = query.do_query(self.identity(self.alice), self.identity(self.zed))
+    full = query.do_query_bounded(self.identity(self.alice),
+                                  self.identity(self.zed), epsilon=0.0)
+    cloud = query.do_query_bounded(self.identity(self.alice),
+                                   self.identity(self.zed), epsilon=0.2)
+    self.assertTrue(cloud.visited < full.visited)
+    self.assertTrue(cloud.error <= 0.2)
+    for name in cloud:
+      self.assertTrue(abs(cloud[name] - exact[name]) <= cloud.error)
+
+  def test_deadline(self):
+
+    # With no time at all, only alice's own confidants are heard from
+    (alice, zed) = (self.identity(self.alice), self.identity(self.zed))
+    cloud = query.do_query(alice, zed, deadline=0)
+    self.assertEqual((cloud.complete, cloud.hops), (False, 1))
+    self.assertEqual(set(cloud), set(['reliable']))
+    self.assertAlmostEqual(cloud['reliable'],
+                           (4 * 0.3 + 3 * 0.5 + 1 * 0.7) / 8.0)
+
+    # Targets the snapshot doesn't know about aren't estimates
+    unknown = Identity(id=alice.id + 1000)
+    (cloud, other) = query.do_query_many(alice, [zed, unknown], deadline=0)
+    self.assertFalse(cloud.complete)
+    self.assertEqual((other, other.complete, other.hops), ({}, True, 3))
+
+    # Estimates aren't cached, and with enough time the result is exact
+    exact = query.do_query(alice, zed)
+    self.assertTrue('funny' in exact)
+    cloud = query.do_query(alice, zed, deadline=60)
+    self.assertEqual((cloud.complete, cloud.hops), (True, 3))
+    self.assertEqual(cloud, exact)
+
+  def test_deadline_bounded(self):
+    (alice, zed) = (self.identity(self.alice), self.identity(self.zed))
+    cloud = query.do_query_bounded(alice, zed, epsilon=0.0, deadline=0)
+    self.assertFalse(cloud.complete)
+    self.assertTrue(cloud.error > 0.0)
+    cloud = query.do_query_bounded(alice, zed, epsilon=0.0, deadline=60)
+    self.assertTrue(cloud.complete)
+
+  def test_stream(self):
+
+    # Estimates arrive hop by hop, the first from alice's own confidants
+    (alice, zed) = (self.identity(self.alice), self.identity(self.zed))
+    clouds = list(query.stream_query(alice, zed))
+    self.assertEqual([(c.hops, c.complete) for c in clouds],
+                     [(1, False), (2, False), (3, True)])
+    self.assertEqual(set(clouds[0]), set(['reliable']))
+    self.assertAlmostEqual(clouds[0]['reliable'],
+                           (4 * 0.3 + 3 * 0.5 + 1 * 0.7) / 8.0)
+
+    # The last is the full cloud, which is cached
+    self.assertEqual(clouds[-1], query.do_query(alice, zed))
+    clouds = list(query.stream_query(alice, zed))
+    self.assertEqual([(c.hops, c.complete) for c in clouds], [(3, True)])
+
+  def test_sampled(self):
+
+    # With enough walks, the estimate is close, and the exact strengths are
+    # within the intervals
+    (alice, zed) = (self.identity(self.alice), self.identity(self.zed))
+    exact = query.do_query(alice, zed)
+    cloud = query.do_query_sampled(alice, zed, walks=20000, epsilon=0.0,
+                                   seed=0)
+    self.assertEqual(cloud.walks, 20000)
+    self.assertFalse(cloud.complete)
+    self.assertEqual(set(cloud), set(exact))
+    for name in exact:
+      self.assertAlmostEqual(cloud[name], exact[name], delta=0.02)
+      (lo, hi) = cloud.intervals[name]
+      self.assertTrue(lo <= exact[name] <= hi)
+      self.assertTrue(hi - lo <= 2 * cloud.error + 1e-9)
+
+    # Sampling stops as soon as the intervals are narrow enough, or time is
+    # up, but always takes one batch
+    cloud = query.do_query_sampled(alice, zed, epsilon=0.5, seed=0)
+    self.assertEqual(cloud.walks, common.sample_batch)
+    self.assertTrue(cloud.complete)
+    cloud = query.do_query_sampled(alice, zed, epsilon=0.0, deadline=0,
+                                   seed=0)
+    self.assertEqual(cloud.walks, common.sample_batch)
+
+    # Nothing to learn about somebody nobody has tagged
+    cloud = query.do_query_sampled(zed, alice, seed=0)
+    self.assertEqual(cloud, {})
+    self.assertEqual(cloud.error, 0.0)
+
+  def test_untagged(self):
+
+    # Nothing to learn about somebody nobody has tagged
+    cloud = query.do_query_bounded(self.identity(self.zed),
+                                   self.identity(self.alice))
+    self.assertEqual(cloud, {})
+    self.assertEqual(cloud.error, 0.0)
 
 def suite():
-  return TestSuite([TestLoader().loadTestsFromTestCase(SimpleQueryTestcase)])
+  return TestSuite([TestLoader().loadTestsFromTestCase(SimpleQueryTestcase),
+                    TestLoader().loadTestsFromTestCase(BoundedQueryTestcase)])
@@ -0,0 +1,84 @@
+from unittest import TestLoader, TestSuite
+from django.test import TestCase
+import numpy as np
+from rainbeard.models import *
+from rainbeard import graph, query, reputation
+from . import util
+
+
+class ReputationTestcase(TestCase):
+
+  def setUp(self):
+
+    # A chain of confidants, alice -> bob -> charlie -> dave, and eve, whom
+    # nobody trusts
+    query.reset()
+    self.users = dict((name, util.make_user(name))
+                      for name in ('alice', 'bob', 'charlie', 'dave', 'eve'))
+    util.make_confidants(self.users['alice'], self.users['bob'], 4, 2)
+    util.make_confidants(self.users['bob'], self.users['charlie'], 3, 4)
+    util.make_confidants(self.users['charlie'], self.users['dave'], 2, 1)
+
+  def identity(self, name):
+    return self.users[name].get_profile().active_identity()
+
+  def test_block(self):
+
+    # Each column is the propagation from one source
+    g = graph.snapshot()
+    sources = [g.index(self.identity(name).id)
+               for name in ('alice', 'charlie', 'eve')]
+    block = query.propagate_block(g, sources, 3)
+    self.assertEqual(block.shape, (len(g), 3))
+    for (column, s) in enumerate(sources):
+      self.assertTrue(np.allclose(block[:, column], query.propagate(g, s, 3)))
+    self.assertTrue(query.block_size(g, 1) == 1)
+    self.assertTrue(query.block_size(g, 10 ** 6) > 1)
+
+  def test_exact(self):
+
+    # Integer propagation gives the trust in whole units of 4^-hops
+    g = graph.snapshot()
+    sources = [g.index(self.identity(name).id) for name in ('alice', 'dave')]
+    self.assertEqual(query.exact_dtype(g, 3), np.int32)
+    exact = query.propagate_exact(g, sources, 3, np.int32)
+    self.assertEqual(exact.dtype, np.int32)
+    for (column, s) in enumerate(sources):
+      self.assertEqual(exact[:, column].tolist(),
+                       (query.propagate(g, s, 3) * 64).tolist())
+
+    # Larger sums need more bits, and blocks fall back to floating point when
+    # even 64 aren't enough
+    self.assertEqual(query.exact_dtype(g, 12), np.int64)
+    self.assertEqual(query.exact_dtype(g, 40), None)
+    block = query.propagate_block(g, sources, 40)
+    self.assertTrue(np.allclose(block[:, 0],
+                                query.propagate(g, sources[0], 40)))
+
+  def test_compute(self):
+
+    # Everybody but eve is trusted by somebody
+    self.assertEqual(reputation.compute(block=2), 4)
+    g = graph.snapshot()
+    expected = sum(query.propagate(g, g.index(self.identity(name).id), 3)
+                   for name in self.users)
+    for row in Reputation.objects.all():
+      self.assertAlmostEqual(row.trust, expected[g.index(row.identity_id)])
+    self.assertEqual(Reputation.objects.get(identity=self.identity('bob'))
+                                       .reach, 3)
+    self.assertFalse(Reputation.objects.filter(identity=self.identity('eve'))
+                                       .exists())
+
+    # Recomputing replaces the table, whatever the block size
+    ranking = list(Reputation.objects.order_by('-trust')
+                                     .values_list('identity', 'trust'))
+    self.assertEqual(reputation.compute(), 4)
+    again = list(Reputation.objects.order_by('-trust')
+                                   .values_list('identity', 'trust'))
+    self.assertEqual([pk for (pk, trust) in again],
+                     [pk for (pk, trust) in ranking])
+    for ((a, x), (b, y)) in zip(ranking, again):
+      self.assertAlmostEqual(x, y)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(ReputationTestcase)])
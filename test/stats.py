@@ -0,0 +1,99 @@
+from unittest import TestLoader, TestSuite
+from django.conf import settings
+from django.test import TestCase
+from django.test.client import Client
+from django.contrib.auth.models import User
+from django.utils import simplejson as json
+from rainbeard.models import *
+from rainbeard import query, stats
+from . import util
+
+
+class HistogramTestcase(TestCase):
+
+  def test_percentiles(self):
+    h = stats.Histogram()
+    for value in range(1, 101):
+      h.add(value)
+    summary = h.summary()
+    self.assertEqual(summary['count'], 100)
+    self.assertAlmostEqual(summary['mean'], 50.5)
+    self.assertEqual(summary['max'], 100)
+    for (q, value) in ((0.5, 50), (0.95, 95), (0.99, 99)):
+      self.assertTrue(value <= h.percentile(q) <= value * 1.1)
+
+  def test_zero(self):
+    h = stats.Histogram()
+    h.add(0)
+    self.assertEqual(h.percentile(0.5), 0)
+
+class MeasureTestcase(TestCase):
+
+  def setUp(self):
+    query.reset()
+    stats.clear()
+    self.alice = util.make_user('alice')
+    self.bob = util.make_user('bob')
+    self.charlie = util.make_user('charlie')
+    util.make_confidants(self.alice, self.bob, 4, 4)
+    util.make_tags(self.bob, self.charlie, {'reliable': 9})
+
+  def identity(self, user):
+    return user.get_profile().active_identity()
+
+  def test_db_queries(self):
+    with stats.measure('test') as record:
+      User.objects.count()
+      with stats.measure('inner') as inner:
+        User.objects.count()
+    self.assertEqual(record['db_queries'], 2)
+    self.assertEqual(inner['db_queries'], 1)
+    self.assertEqual(stats.histograms['test.db_queries'].max, 2)
+
+    # Counting stops on the way out
+    User.objects.count()
+    self.assertEqual(record['db_queries'], 2)
+
+  def test_query(self):
+    (a, c) = (self.identity(self.alice), self.identity(self.charlie))
+    query.do_query(a, c)
+    query.do_query(a, c)
+    summary = stats.summary()
+    self.assertEqual(summary['query.wall_ms']['count'], 2)
+    self.assertEqual(summary['query.cache_misses']['max'], 1)
+    self.assertEqual(summary['query.cache_hits']['max'], 1)
+    self.assertEqual(summary['query.nodes']['max'], 2)
+    self.assertEqual(summary['query.edges']['max'], 3)
+    self.assertEqual(summary['query.hops']['max'], 3)
+
+  def test_endpoint(self):
+
+    # Only staff get to see the numbers
+    client = Client()
+    client.login(username='alice', password='alicepass')
+    self.assertEqual(client.get('/stats').status_code, 302)
+    User.objects.filter(username='alice').update(is_staff=True)
+    query.do_query(self.identity(self.alice), self.identity(self.charlie))
+    result = json.loads(client.get('/stats').content)
+    self.assertEqual(result['histograms']['query.wall_ms']['count'], 1)
+    self.assertEqual(result['cache']['misses'], 1)
+
+  def test_header(self):
+    client = Client()
+    client.login(username='alice', password='alicepass')
+    post = lambda: client.post('/ajax/query/many',
+                               {'handle': 'charlie@example.com',
+                                'service': 'email'},
+                               HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+    self.assertFalse(post().has_header('X-Rainbeard-Stats'))
+    settings.RAINBEARD_STATS_HEADER = True
+    try:
+      record = json.loads(post()['X-Rainbeard-Stats'])
+    finally:
+      settings.RAINBEARD_STATS_HEADER = False
+    self.assertEqual(record['cache_hits'], 1)
+    self.assertTrue(record['db_queries'] > 0)
+
+def suite():
+  return TestSuite([TestLoader().loadTestsFromTestCase(HistogramTestcase),
+                    TestLoader().loadTestsFromTestCase(MeasureTestcase)])
@@ -11,3 +11,23 @@ def make_user(name):
   account.register_user(name, password, email, False)
   account.do_claim(PendingClaim.objects.get(handle=email, service='email').ckey)
   return User.objects.get(username=name)
+
+# Utility to make two users confidants of each other.
+#
+# 'coef' is the propagation coefficient a places on information from b, and
+# 'back' the one b places on information from a.
+def make_confidants(a, b, coef, back):
+  a = a.get_profile().active_identity()
+  b = b.get_profile().active_identity()
+  ConfidantLink(src=a, dst=b, prop_coef=coef).save()
+  ConfidantLink(src=b, dst=a, prop_coef=back).save()
+
+# Utility to tag a user on behalf of another.
+#
+# 'tags' is a dictionary mapping tag names to confidence values.
+def make_tags(tagger, target, tags):
+  tagset = TagSet(tagger=tagger.get_profile().active_identity(),
+                  target=target.get_profile().active_identity())
+  tagset.save()
+  for name, confidence in tags.items():
+    Tag(name=name, confidence=confidence, tagset=tagset).save()
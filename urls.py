@@ -17,4 +17,7 @@ urls = patterns('',
          url(r'^login(/.*)?$', views.login_view),
          url(r'^/?$', views.main_view),
          url(r'^query/?$', views.query_view),
-         url(r'^ajax/givens/get?$', ajax.get_givens))
+         url(r'^stats/?$', views.stats_view),
+         url(r'^ajax/givens/get?$', ajax.get_givens),
+         url(r'^ajax/query/many/?$', ajax.query_many),
+         url(r'^ajax/query/stream/?$', ajax.query_stream))
@@ -1,6 +1,7 @@
 from django import forms
 from django.core.validators import *
 from django.contrib.auth.models import User
+import common
 
 #
 # Validators for various bits of user input
@@ -31,17 +32,27 @@ def validate_prop_coef(coef):
     raise ValidationError('Invalid Propagation Coefficient')
 
 
+# Query deadlines, in whole milliseconds
+def validate_deadline(deadline):
+  if not deadline.isdigit() or int(deadline) == 0:
+    raise ValidationError('Invalid deadline')
+
+
 # Validate an ajax request post
 #
-# Throws an error if it doesn't recognize one of the parameters
+# Throws an error if it doesn't recognize one of the parameters. Parameters
+# may be given multiple times.
 def validate_ajax_params(params):
-  for key,value in params.items():
-    if key == 'handle':
-      validate_handle(value)
-    elif key == 'service':
-      validate_service(value)
-    else:
-      raise ValidationError('Unknown POST parameter')
+  for key,values in params.lists():
+    for value in values:
+      if key == 'handle':
+        validate_handle(value)
+      elif key == 'service':
+        validate_service(value)
+      elif key == 'deadline':
+        validate_deadline(value)
+      else:
+        raise ValidationError('Unknown POST parameter')
 
 
 # Validate a new username to make sure it doesn't exist.
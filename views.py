@@ -2,8 +2,9 @@ from django.http import HttpResponse
 from django.shortcuts import render_to_response, redirect
 from django.conf import settings
 from django.contrib.auth import authenticate,login,logout
-from django.contrib.auth.decorators import login_required
-import account
+from django.contrib.auth.decorators import login_required, user_passes_test
+from django.utils import simplejson as json
+import account, agents, cache, stats
 
 def register_view(request):
 
@@ -88,3 +89,14 @@ def query_view(request):
              'handle' : handle,
              'picsrc' : picsrc};
   return render_to_response('rainbeard/templates/query.html', context)
+
+# Reports query measurements and cache counters, for staff only
+@user_passes_test(lambda u: u.is_staff)
+def stats_view(request):
+
+  return HttpResponse(json.dumps({'histograms': stats.summary(),
+                                  'cache': cache.clouds.stats(),
+                                  'horizons': cache.horizons.stats(),
+                                  'agents': agents.directory.stats()},
+                                 sort_keys=True),
+                      mimetype='application/json')